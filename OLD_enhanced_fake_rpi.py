@@ -9,359 +9,3827 @@ from datetime import datetime
 import subprocess
 import shlex
 import sys
-import json, multiprocessing
+import collections
+import asyncio
+import functools
+import hashlib
+import http.server
+import inspect
+import io
+import queue
+import mmap
+import math
+import os
+import random
+import re
+import socket
+import struct
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as futures_wait
 
 # --- config (direct, no env vars) ---
 PYTHON_BIN = sys.executable  # use same interpreter as main program
 
 RPI_TO_PARTS_PATH= r"/home/username/ur2-common-code/rpi-to-parts/splitted"
 
-SCRIPT_PY = {
-    "prepare":{
-        "path": f"{RPI_TO_PARTS_PATH}/ur2_prepare.py",
-        "timeout": 1200,  # 20 min  
+# Test pipeline, one entry per stage. "per_cycle" stages run every cycle once the stages
+# in "after" (same cycle) are done; stages whose dependencies are met run concurrently,
+# up to PIPELINE_MAX_PARALLEL per test. Stages with a "title" are reported to the
+# frontend as run_stage 1..N in this order. "image" = publish a capture when done,
+# "retries" = extra attempts after a failure, "timeout" in seconds, "resources" = RESOURCES
+# the stage occupies while it runs.
+# SCRIPT_PY, PROCESS_STAGES and PER_CYCLE_STEPS are derived from this.
+PIPELINE = {
+    "prepare": {
+        "script": "ur2_prepare.py",
+        "title": "Sample Preparation",
+        "timeout": 1200,  # 20 min
+        "resources": ["pumps"],
     },
-    "heat":{
-        "path": f"{RPI_TO_PARTS_PATH}/ur2_heat.py",
+    "heat": {
+        "script": "ur2_heat.py",  # background for the whole test, see HEAT_BACKEND
+        "resources": ["heater"],
     },
-    "dissolution":{
-        "path": f"{RPI_TO_PARTS_PATH}/ur2_dissolution.py",
+    "dissolution": {
+        "script": "ur2_dissolution.py",
+        "title": "Dissolution",
+        "per_cycle": True,
+        "resources": ["pumps"],
     },
-    "dilution":{
-        "path": f"{RPI_TO_PARTS_PATH}/ur2_dilution.py",
+    "dilution": {
+        "script": "ur2_dilution.py",
+        "title": "Filtration & Dilution",
+        "per_cycle": True,
+        "after": ["dissolution"],
+        "resources": ["pumps"],
     },
-    # "color_agents":{
-    #     "path": f"{RPI_TO_PARTS_PATH}/ur2_coloragents.py",
-    #     "args":[],
-    # },
-    "aluminum":{
-        "path": f"{RPI_TO_PARTS_PATH}/ur2_aluminum.py",
-        "args":[],
+    "color_agents": {
+        "script": "ur2_coloragents.py",
+        "title": "Color Agent Addition",
+        "per_cycle": True,
+        "after": ["dilution"],
+        "enabled": False,
+        "resources": ["pumps"],
     },
-    "silicon":{
-        "path": f"{RPI_TO_PARTS_PATH}/ur2_silicon.py",
-        "args":[],
+    "aluminum": {
+        "script": "ur2_aluminum.py",
+        "title": "Aluminum Concentration Analysis",
+        "per_cycle": True,
+        "after": ["color_agents"],  # disabled stages pass their own dependencies on
+        "image": True,
+        "resources": ["camera"],
     },
+    "silicon": {
+        "script": "ur2_silicon.py",
+        "title": "Silicon Concentration Analysis",
+        "per_cycle": True,
+        "after": ["color_agents"],
+        "image": True,
+        "resources": ["camera"],
+    },
+}
+PIPELINE_MAX_PARALLEL = 2  # 1 = strictly sequential
+
+# Instruments shared by all tests on this Pi (units of each). A stage waits until every
+# resource PIPELINE lists for it is free; the heater is held for the whole test.
+RESOURCES = {"heater": 4, "pumps": 1, "camera": 1}
+RESOURCE_MAX_BYPASS = 3  # later stages that may overtake a waiting one before it reserves
+
+
+# MQTT Configuration
+# prod URL
+# BROKER = "04e8fe793a8947ad8eda947204522088.s1.eu.hivemq.cloud"
+# testing url
+BROKER = "69fd2157960d4f39950410b17ba9d85c.s1.eu.hivemq.cloud"
+PORT = 8883
+USERNAME = "ur2gglab"
+PASSWORD = "Ur2gglab"
+
+
+# Topics
+TEST_PUB_TOPIC = 'ur2/test/init'  # Listen for commands from frontend
+TEST_SUB_TOPIC = 'ur2/test/stage'  # Send responses to frontend
+TEST_BATCH_TOPIC = TEST_SUB_TOPIC + '/batch'  # Several tests' status updates in one envelope
+TEST_LIST_TOPIC = 'ur2/test/active'  # Reply to {"command": "list"} with every active test
+FORMAT_HELLO_TOPIC = 'ur2/test/format/hello'  # Clients announce the status encodings they accept
+FORMAT_REPLY_TOPIC = 'ur2/test/format/'  # + clientId, the encoding chosen for that client
+CONFIRMATION_TOPIC = 'ur2/test/confirm'  # Handle user confirmations
+IMAGE_TOPIC = 'ur2/test/image'  # New topic for sending images
+PROGRESS_TOPIC = 'ur2/test/progress'  # Live script output lines
+HEAT_TELEMETRY_TOPIC = 'ur2/test/heat'  # Decimated heater temperatures
+TIMING_TOPIC = 'ur2/test/timing'  # Per-test stage timing summary when a test ends
+IMAGE_MANIFEST_TOPIC = IMAGE_TOPIC + '/manifest'  # chunked transfer: one manifest per image
+IMAGE_CHUNK_TOPIC = IMAGE_TOPIC + '/chunk'  # chunked transfer: header + bytes
+IMAGE_RESEND_TOPIC = IMAGE_TOPIC + '/resend'  # receiver asks for missing chunks
+IMAGE_REQUEST_TOPIC = IMAGE_TOPIC + '/request'  # client asks for a specific variant (e.g. full resolution)
+ANALYSIS_TOPIC = IMAGE_TOPIC + '/analysis'  # colorimetric numbers + image metadata per capture
+ARCHIVE_REQUEST_TOPIC = 'ur2/archive/request'  # history queries ({"clientId", "query", ...})
+ARCHIVE_REPLY_TOPIC = 'ur2/archive/reply/'  # + clientId, one reply per request
+
+# How long a test waits for the user after each cycle (seconds, None = forever)
+CONFIRMATION_TIMEOUT = None
+
+# "thread" = one daemon thread per test, "asyncio" = all tests as coroutines on one event loop
+ORCHESTRATOR_MODE = "thread"
+ASYNC_BLOCKING_WORKERS = 4  # thread pool for blocking calls (image reads) in asyncio mode
+
+# Status publishing: updates for the same test landing within the window are
+# coalesced (only the latest is sent), optionally batched across tests into one
+# envelope on TEST_BATCH_TOPIC. Window 0 and no batching = publish immediately.
+STATUS_COALESCE_WINDOW = 0.0
+STATUS_BATCH = False
+STATUS_QOS = 0
+STATUS_PRIORITY_QOS = 1  # terminal states and confirmation requests
+
+# Outbox: status, image and timing publishes are spooled to SQLite while the link is
+# down (a newer message for the same test/cycle/stage replaces the older one) and
+# replayed on reconnect at a capped rate. Past the caps the oldest non-priority
+# messages are evicted; terminal states and confirmation requests are kept.
+OUTBOX_PATH = "fake_rpi_outbox.db"  # None = in memory only (lost on restart)
+OUTBOX_MAX_ROWS = 20000
+OUTBOX_MAX_BYTES = 64 * 1024 * 1024
+OUTBOX_REPLAY_BATCH = 100
+OUTBOX_REPLAY_INFLIGHT = 20      # replayed messages not yet completed
+OUTBOX_REPLAY_PER_SECOND = 200
+
+# Status wire format: "json" = JSON on TEST_SUB_TOPIC only, one of STATUS_FORMATS =
+# only that encoding on TEST_SUB_TOPIC/<format> (no JSON), "negotiated" = JSON plus
+# whatever binary formats clients asked for on FORMAT_HELLO_TOPIC (mixed fleets).
+# Binary encodings in order of preference, and how long a negotiation lasts without a new hello
+STATUS_FORMAT = "json"
+STATUS_FORMATS = ["struct", "msgpack", "cbor"]
+FORMAT_CLIENT_TTL = 3600
+
+# Image transfer: "raw" = one payload on IMAGE_TOPIC/raw (what the frontend reads today),
+# "chunked" = manifest + sequenced chunks that the receiver can re-request
+IMAGE_TRANSFER_MODE = "raw"
+IMAGE_CHUNK_SIZE = 16 * 1024
+IMAGE_MAX_INFLIGHT_CHUNKS = 8  # unacked QoS 1 chunks before the sender waits
+IMAGE_CHUNK_QOS = 1
+IMAGE_TRANSFERS_KEPT = 32  # recent transfers that can still be resent
+
+# Image variants: which one send_img_to_web ships on IMAGE_TOPIC/raw
+# ("original" = file bytes as today), variant sizes (max side px, JPEG quality),
+# encoded-variant cache cap and how long a send waits for encoding before
+# falling back to the original
+IMAGE_SEND_VARIANT = "original"
+IMAGE_VARIANTS = {
+    "preview": (640, 75),
+    "thumbnail": (160, 60),
+}
+IMAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+IMAGE_VARIANT_WAIT = 5.0
+
+# Latest-image index: rescan interval when inotify is unavailable, and the
+# filename pattern that ties a capture to a test/cycle (e.g. T42_cycle3_al.png)
+IMAGE_INDEX_POLL_SECONDS = 30
+IMAGE_RUN_PATTERN = re.compile(r"^(?P<test_id>.+)_cycle(?P<cycle>\d+)[_.]")
+
+# Image stages: "memory" = frames go from the stage (shared memory for real scripts)
+# through a bounded queue to encode/publish workers, "files" = the newest file in the
+# capture directory is read back after the stage. CAPTURE_PERSIST saves a copy to disk
+# in the background in memory mode (off by default, nothing prunes the capture
+# directories; chunked transfers always write theirs). The last CAPTURE_RECENT_FRAMES
+# originals stay in memory so image requests can fetch them (and their variants)
+# without a copy on disk. A full queue drops a frame after CAPTURE_PUT_TIMEOUT
+# (announced on IMAGE_TOPIC with "dropped": true). Panel analysis runs on its own
+# CAPTURE_ANALYSIS_WORKERS threads so it never holds up publishing.
+CAPTURE_MODE = "memory"
+CAPTURE_QUEUE_SIZE = 8
+CAPTURE_WORKERS = 2
+CAPTURE_ANALYSIS_WORKERS = 1
+CAPTURE_PUT_TIMEOUT = 2.0
+CAPTURE_PERSIST = False
+CAPTURE_RECENT_FRAMES = 16
+CAPTURE_SHM_BYTES = 16 * 1024 * 1024
+
+# Panel analysis (needs NumPy + Pillow): regions as (x0, y0, x1, y1) fractions of the
+# image, and per material the channel whose absorbance log10(blank/sample) is mapped
+# to a concentration by linear interpolation between (absorbance, concentration) points
+ANALYSIS_ENABLED = True
+ANALYSIS_REGIONS = {
+    "sample": (0.3, 0.3, 0.7, 0.7),
+    "blank": (0.05, 0.05, 0.95, 0.15),
 }
+ANALYSIS_CALIBRATION = {
+    "aluminum": {"channel": "G", "unit": "mg/L", "points": [(0.0, 0.0), (0.1, 0.05), (0.3, 0.2), (0.6, 0.5)]},
+    "silicon": {"channel": "R", "unit": "mg/L", "points": [(0.0, 0.0), (0.15, 0.5), (0.45, 2.0), (0.9, 5.0)]},
+}
+
+# Stage script output kept in memory (per stream) and max chars per line
+STAGE_OUTPUT_TAIL_LINES = 50
+STAGE_LINE_MAX_CHARS = 500
+
+# Heater: "simulated" = thermal model, "script" = SCRIPT_PY["heat"] in a subprocess per test.
+# All heaters are driven from one scheduler thread ticking every HEAT_TICK_SECONDS;
+# each tick advances the model by HEAT_TICK_SECONDS * HEAT_TIME_SCALE simulated seconds.
+HEAT_BACKEND = "simulated"
+HEAT_SETPOINT_C = 60.0
+HEAT_AMBIENT_C = 22.0
+HEAT_TICK_SECONDS = 0.25
+HEAT_TIME_SCALE = 1.0
+HEAT_MAX_STEP_SECONDS = 1.0  # integration sub-step, keeps fast replays stable
+HEAT_TELEMETRY_SECONDS = 5   # simulated seconds between telemetry samples per heater
+# Lumped thermal model: C dT/dt = u * max_power - loss * (T - ambient),
+# with a proportional controller u = clip(gain * (setpoint - T), 0, 1)
+HEAT_PARAMS = {
+    "ambient_c": HEAT_AMBIENT_C,
+    "capacity_j_per_k": 800.0,
+    "max_power_w": 150.0,
+    "loss_w_per_k": 2.0,
+    "gain_per_k": 0.2,
+}
+
+# Prometheus-style metrics on http://METRICS_HOST:METRICS_PORT/metrics (port 0 = off)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+# Logging: records go through a bounded queue to a writer thread (console + rotating
+# JSON-lines file), so callers never block on stdout/SD card I/O. When the queue is
+# full new records are dropped and counted. Noisy keys are rate-limited (records/second).
+LOG_QUEUE_SIZE = 10000
+LOG_FILE = "fake_rpi.log"  # None = console only
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LOG_RATE_LIMITS = {"on_publish": 5, "on_log": 5, "fleet_connect": 5, "fleet_message": 5, "ingest_drop": 5}
+
+# Command ingestion: on_message only queues messages (a full queue drops them) for one
+# dispatcher thread; image requests/resends run on INGEST_WORKERS threads. Starts past
+# MAX_CONCURRENT_TESTS or the "start" rate get run_status "busy". Rates are
+# kind -> (messages per second, burst); confirmations and stop/list are never limited.
+INGEST_QUEUE_SIZE = 1000
+INGEST_WORKERS = 2
+MAX_CONCURRENT_TESTS = 8
+COMMAND_RATE_LIMITS = {
+    "start": (2, 10),
+    "image_request": (5, 10),
+    "resend": (10, 20),
+    "format_hello": (5, 10),
+    "archive": (5, 10),
+}
+
+# Checkpoint journal: test starts, finished stages and confirmations are appended here
+# so a restarted simulator resumes unfinished tests instead of starting over
+CHECKPOINT_PATH = "fake_rpi_journal.jsonl"  # None = no checkpointing
+CHECKPOINT_FSYNC = True
+CHECKPOINT_COMPACT_BYTES = 256 * 1024
+
+# Run archive: every run's status events, images and timing, kept in SQLite for the
+# history queries on ARCHIVE_REQUEST_TOPIC and http://METRICS_HOST:METRICS_PORT/runs
+ARCHIVE_PATH = "fake_rpi_archive.db"  # None = in memory only
+ARCHIVE_QUEUE_SIZE = 10000
+ARCHIVE_MAX_RUNS = 5000
+ARCHIVE_PAGE_SIZE = 50
+ARCHIVE_PAGE_MAX = 500
+
+# Simulation knobs (the benchmark shortens these)
+SIMULATED_SCRIPT_SECONDS = 3
+SIMULATE_HEAT = True
+SIMULATE_IMAGES = True
+
+# Embedded broker stand-in (--local-broker) for air-gapped runs and the load benchmark
+LOCAL_BROKER_HOST = "127.0.0.1"
+LOCAL_BROKER_PORT = 1883
+LOAD_BENCH_HISTORY = "bench_history.jsonl"  # one JSON line per load benchmark run
+LOAD_BENCH_TOLERANCE = 0.2  # flag metrics more than 20% worse than the last comparable run
+
+# Fleet mode (--fleet N): N virtual devices in one process. Each gets its own client id
+# and the usual topics under FLEET_TOPIC_ROOT/<device id>/ (ur2/test/init ->
+# ur2/fleet/ur2-sim-0001/test/init); all sockets and test pipelines share one event loop.
+FLEET_TOPIC_ROOT = "ur2/fleet"
+FLEET_CLIENT_PREFIX = "ur2-sim-"
+FLEET_CONNECTS_PER_SECOND = 50  # stagger connects so the broker isn't hit all at once
+FLEET_STAGE_SECONDS = {"prepare": 5.0, "dissolution": 3.0, "dilution": 3.0, "aluminum": 3.0, "silicon": 3.0}
+FLEET_STAGE_JITTER = 0.2        # +/- fraction applied to every stage duration
+FLEET_FAILURE_RATE = 0.0        # probability that a stage fails (test ends with "error")
+FLEET_DISCONNECT_RATE = 0.0     # probability per stage that the device drops its connection
+FLEET_CONFIRM_SECONDS = None    # devices answer their own confirmations after this delay (None = wait for the frontend)
+FLEET_AUTO_START_SECONDS = None # idle devices start a test on their own every N seconds (None = only on command)
+FLEET_STATS_SECONDS = 10
+FLEET_SEED = None               # fixed seed makes durations and injected failures repeatable
+
+# Global variables
+client = None
+
+###################################
+
+
+class AsyncLogger:
+    """
+    Queue-backed logger. log() only builds a tuple and enqueues it; one
+    writer thread formats records, prints them and appends them as JSON
+    lines to a size-rotated file. Memory is bounded by LOG_QUEUE_SIZE.
+    """
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE, path=LOG_FILE):
+        self._queue = queue.Queue(maxsize)
+        self.path = path
+        self._file = None
+        self._rate = {}  # rate key -> [window start, count in window, suppressed]
+        self._rate_lock = threading.Lock()
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="ur2-log", daemon=True)
+        self._thread.start()
+
+    def _allow(self, key):
+        """Token-per-second limiter; returns (allowed, suppressed since last allowed)"""
+        limit = LOG_RATE_LIMITS.get(key)
+        if not limit:
+            return True, 0
+        now = time.monotonic()
+        with self._rate_lock:
+            state = self._rate.setdefault(key, [now, 0, 0])
+            if now - state[0] >= 1.0:
+                state[0], state[1] = now, 0
+            if state[1] >= limit:
+                state[2] += 1
+                return False, 0
+            state[1] += 1
+            suppressed, state[2] = state[2], 0
+            return True, suppressed
+
+    def log(self, message, level="info", rate_key=None, **context):
+        if rate_key:
+            allowed, suppressed = self._allow(rate_key)
+            if not allowed:
+                return
+            if suppressed:
+                message = f"{message} (+{suppressed} similar suppressed)"
+        try:
+            self._queue.put_nowait((time.time(), level, message, context))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_file(self, line):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(line + "\n")
+        if self._file.tell() >= LOG_FILE_MAX_BYTES:
+            self._file.close()
+            self._file = None
+            for i in range(LOG_FILE_BACKUPS - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+
+    def _run(self):
+        reported_drops = 0
+        while True:
+            item = self._queue.get()
+            if item is None:  # flush marker
+                if self._file:
+                    self._file.flush()
+                sys.stdout.flush()
+                self._queue.task_done()
+                continue
+            ts, level, message, context = item
+            if self.dropped != reported_drops:
+                message = f"{message} ({self.dropped - reported_drops} log records dropped, queue full)"
+                reported_drops = self.dropped
+            stamp = datetime.fromtimestamp(ts)
+            try:
+                print(f"[{stamp.strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+                if self.path:
+                    record = {"ts": stamp.isoformat(timespec="milliseconds"), "level": level, "msg": message}
+                    record.update({k: v for k, v in context.items() if v is not None})
+                    self._write_file(json.dumps(record, default=str))
+            except Exception:
+                pass  # logging must never take the writer down
+            self._queue.task_done()
+
+    def flush(self, timeout=5):
+        """Wait until everything queued so far has been written"""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+logger = AsyncLogger()
+
+
+def log_message(message, test_id=None, cycle=None, stage=None, level="info", rate_key=None):
+    """Queue a timestamped log message (structured fields go to the log file)"""
+    logger.log(message, level=level, rate_key=rate_key, test_id=test_id, cycle=cycle, stage=stage)
+
+
+def now_iso():
+    return datetime.now().isoformat()
+
+# --- metrics ---
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense"""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)  # last = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Histograms, counters and callback gauges, rendered as Prometheus text"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = collections.Counter()  # (name, labels) -> value
+        self._gauges = {}      # name -> (help, fn returning number or {labels: number})
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, help="", **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+                self._help.setdefault(name, help)
+            hist.observe(value)
+
+    def inc(self, name, amount=1, help="", **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += amount
+            self._help.setdefault(name, help)
+
+    def gauge(self, name, fn, help=""):
+        self._gauges[name] = (help, fn)
+
+    @staticmethod
+    def _fmt_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            hists = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            hists = [(k, list(h.counts), h.sum, h.count) for k, h in hists]
+            counters = sorted(self._counters.items())
+        seen = set()
+        for (name, labels), counts, total, count in hists:
+            if name not in seen:
+                seen.add(name)
+                lines += [f"# HELP {name} {self._help.get(name, '')}", f"# TYPE {name} histogram"]
+            running = 0
+            for bound, n in zip([*METRICS_BUCKETS, "+Inf"], counts):
+                running += n
+                lines.append(f"{name}_bucket{self._fmt_labels(labels, [('le', bound)])} {running}")
+            lines.append(f"{name}_sum{self._fmt_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._fmt_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines += [f"# HELP {name} {self._help.get(name, '')}", f"# TYPE {name} counter"]
+            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for name, (help, fn) in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                log_message(f"metrics: gauge {name} failed: {e}")
+                continue
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            if isinstance(value, dict):
+                for labels, v in value.items():
+                    lines.append(f"{name}{self._fmt_labels(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def instrumented(kind, labels, per_test=True):
+    """
+    Time every call into histogram ur2_<kind>_seconds and counter
+    ur2_<kind>_total{outcome}. `labels` maps the bound call arguments to
+    label values. With per_test, the duration is also added to the
+    calling test's record for its timing summary.
+    """
+    metric = f"ur2_{kind}_seconds"
+
+    def deco(fn):
+        sig = inspect.signature(fn)
+
+        def record(args, kwargs, elapsed, outcome):
+            try:
+                bound = sig.bind(*args, **kwargs).arguments
+            except TypeError:
+                bound = {}
+            label_values = labels(bound)
+            metrics.observe(metric, elapsed, help=f"Duration of {kind} calls", **label_values)
+            metrics.inc(f"ur2_{kind}_total", help=f"{kind} calls by outcome", outcome=outcome, **label_values)
+            if per_test:
+                test = active_tests.get(bound.get("test_id"))
+                if test is not None:
+                    test.add_timing(kind, "/".join(str(v) for v in label_values.values()),
+                                    bound.get("cycle", bound.get("cycle_number")), elapsed)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = await fn(*args, **kwargs)
+                    outcome = "ok"
+                    return result
+                finally:
+                    record(args, kwargs, time.perf_counter() - t0, outcome)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = fn(*args, **kwargs)
+                    outcome = "ok"
+                    return result
+                finally:
+                    record(args, kwargs, time.perf_counter() - t0, outcome)
+        return wrapper
+    return deco
+
+
+_stage_labels = lambda a: {"stage": a.get("name")}
+_image_labels = lambda a: {"material": a.get("material")}
+_pub_labels = lambda a: {"status": a.get("fields", {}).get("run_status")}
+_confirm_labels = lambda a: {}
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path == "/runs" or path.startswith("/runs/"):
+            self._archive(path, query)
+            return
+        if path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self._reply(body, "text/plain; version=0.0.4")
+
+    def _archive(self, path, query):
+        """/runs?testId=&status=&since=&until=&limit=&cursor= and /runs/<runId>"""
+        from urllib.parse import parse_qsl
+
+        request = dict(parse_qsl(query))
+        if path != "/runs":
+            request.update(query="run", runId=path[len("/runs/"):])
+        try:
+            result = get_archive().query(request)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if result.get("run", True) is None:
+            self.send_error(404)
+            return
+        self._reply(json.dumps(result).encode(), "application/json")
+
+    def _reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a log line
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics (and the /runs archive) from a daemon thread; returns the server or None"""
+    if not port:
+        return None
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        log_message(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="ur2-metrics", daemon=True).start()
+    log_message(f"Metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# --- status wire formats ---
+# Binary formats carry a version byte, run_status as a small int (0 = not in the
+# table, the name is then sent as text) and the timestamp as epoch milliseconds.
+STATUS_WIRE_VERSION = 1
+RUN_STATUS_CODES = {name: code for code, name in enumerate([
+    "started", "running", "cycle_start", "waiting_confirmation", "completed",
+    "failed", "error", "stopped", "already_running", "queued", "busy",
+], start=1)}
+RUN_STATUS_NAMES = {code: name for name, code in RUN_STATUS_CODES.items()}
+
+# version, status code, timestamp ms, run_stage, cycle (-1 = none),
+# then length-prefixed utf-8 testId, message and status name (other fields are dropped)
+STATUS_STRUCT = struct.Struct("!BBqhh")
+_STR_LEN = struct.Struct("!H")
+# short integer keys for the msgpack/cbor maps
+_K_VERSION, _K_TEST, _K_STATUS, _K_TS, _K_STAGE, _K_CYCLE, _K_MESSAGE, _K_EXTRA = range(8)
+_STATUS_FIELDS = {"testId", "timestamp", "run_status", "run_stage", "cycle", "message"}
+
+
+def _load_codec(name):
+    """msgpack/cbor2 module, or None if not installed"""
+    try:
+        if name == "msgpack":
+            import msgpack
+            return msgpack
+        if name == "cbor":
+            import cbor2
+            return cbor2
+    except ImportError:
+        return None
+    return None
+
+
+def _ts_ms(payload):
+    ts = payload.get("timestamp")
+    return int(datetime.fromisoformat(ts).timestamp() * 1000) if ts else 0
+
+
+def _pack_str(value):
+    raw = (value or "").encode()[:0xFFFF]
+    return _STR_LEN.pack(len(raw)) + raw
+
+
+def _unpack_str(buf, offset):
+    (n,) = _STR_LEN.unpack_from(buf, offset)
+    offset += _STR_LEN.size
+    return buf[offset:offset + n].decode(), offset + n
+
+
+def encode_status(payload, fmt):
+    """Encode a pub() payload in one of STATUS_FORMATS (or "json")"""
+    if fmt == "json":
+        return json.dumps(payload).encode()
+    status = payload.get("run_status")
+    code = RUN_STATUS_CODES.get(status, 0)
+    stage = payload.get("run_stage")
+    cycle = payload.get("cycle")
+    if fmt == "struct":
+        return b"".join((
+            STATUS_STRUCT.pack(STATUS_WIRE_VERSION, code, _ts_ms(payload),
+                               -1 if stage is None else stage, -1 if cycle is None else cycle),
+            _pack_str(str(payload.get("testId") or "")),
+            _pack_str(payload.get("message")),
+            _pack_str(status if code == 0 else None),
+        ))
+    record = {_K_VERSION: STATUS_WIRE_VERSION, _K_TEST: payload.get("testId"),
+              _K_STATUS: code or status, _K_TS: _ts_ms(payload)}
+    if stage is not None:
+        record[_K_STAGE] = stage
+    if cycle is not None:
+        record[_K_CYCLE] = cycle
+    if payload.get("message") is not None:
+        record[_K_MESSAGE] = payload["message"]
+    extra = {k: v for k, v in payload.items() if k not in _STATUS_FIELDS}
+    if extra:
+        record[_K_EXTRA] = extra
+    codec = _load_codec(fmt)
+    if codec is None:
+        raise ValueError(f"status format {fmt!r} not available")
+    return codec.packb(record) if fmt == "msgpack" else codec.dumps(record)
+
+
+def decode_status(data, fmt):
+    """Inverse of encode_status (timestamp comes back as epoch ms in "ts_ms")"""
+    if fmt == "json":
+        return json.loads(data)
+    if fmt == "struct":
+        version, code, ts_ms, stage, cycle = STATUS_STRUCT.unpack_from(data)
+        offset = STATUS_STRUCT.size
+        test_id, offset = _unpack_str(data, offset)
+        message, offset = _unpack_str(data, offset)
+        status_name, offset = _unpack_str(data, offset)
+        out = {"v": version, "testId": test_id, "ts_ms": ts_ms,
+               "run_status": RUN_STATUS_NAMES.get(code, status_name)}
+        if stage >= 0:
+            out["run_stage"] = stage
+        if cycle >= 0:
+            out["cycle"] = cycle
+        if message:
+            out["message"] = message
+        return out
+    codec = _load_codec(fmt)
+    record = codec.unpackb(data, strict_map_key=False) if fmt == "msgpack" else codec.loads(data)
+    status = record.get(_K_STATUS)
+    out = {"v": record.get(_K_VERSION), "testId": record.get(_K_TEST), "ts_ms": record.get(_K_TS),
+           "run_status": RUN_STATUS_NAMES.get(status, status) if isinstance(status, int) else status}
+    for key, name in ((_K_STAGE, "run_stage"), (_K_CYCLE, "cycle"), (_K_MESSAGE, "message")):
+        if key in record:
+            out[name] = record[key]
+    out.update(record.get(_K_EXTRA, {}))
+    return out
+
+
+class FormatNegotiator:
+    """
+    Tracks which binary status formats have live subscribers. A client sends
+    {"clientId", "formats": [...]} on FORMAT_HELLO_TOPIC and gets back the
+    first format both sides support plus its topic; an empty list says bye.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}  # clientId -> (format, expires_at)
+
+    def hello(self, client_id, formats):
+        if STATUS_FORMAT != "negotiated":
+            chosen = STATUS_FORMAT  # fixed on this device, the client has to follow
+        else:
+            usable = [f for f in STATUS_FORMATS if f in (formats or []) and (f == "struct" or _load_codec(f))]
+            chosen = usable[0] if usable else "json"
+        with self._lock:
+            if chosen == "json":
+                self._clients.pop(client_id, None)
+            else:
+                self._clients[client_id] = (chosen, time.monotonic() + FORMAT_CLIENT_TTL)
+        return {
+            "clientId": client_id,
+            "format": chosen,
+            "version": STATUS_WIRE_VERSION,
+            "topic": TEST_SUB_TOPIC if chosen == "json" else f"{TEST_SUB_TOPIC}/{chosen}",
+            "run_status_codes": RUN_STATUS_CODES,
+        }
+
+    def active_formats(self):
+        now = time.monotonic()
+        with self._lock:
+            for cid in [c for c, (_, exp) in self._clients.items() if exp < now]:
+                del self._clients[cid]
+            return {fmt for fmt, _ in self._clients.values()}
+
+
+format_negotiator = FormatNegotiator()
+
+
+# --- active test registry ---
+class TestRecord:
+    """State of one running test, updated from every pub()"""
+
+    __slots__ = ("test_id", "run_id", "start_time", "started_at", "status", "stage", "cycle",
+                 "stage_started_at", "heat", "timings")
+
+    def __init__(self, test_id):
+        self.test_id = test_id
+        self.run_id = uuid.uuid4().hex  # tells this run apart from a restart under the same test id
+        self.start_time = datetime.now()
+        self.started_at = time.monotonic()
+        self.status = "starting"
+        self.stage = 0
+        self.cycle = None
+        self.stage_started_at = self.started_at
+        self.heat = None         # heater handle while the test holds one
+        self.timings = []        # (kind, name, cycle, seconds) from instrumented calls
+
+    def add_timing(self, kind, name, cycle, seconds):
+        self.timings.append((kind, name, cycle, seconds))
+
+    def timing_summary(self):
+        """Per-stage totals plus a per-cycle breakdown of the instrumented calls"""
+        totals = {}
+        cycles = {}
+        for kind, name, cycle, seconds in self.timings:
+            key = name if kind == "stage" else kind
+            agg = totals.setdefault(key, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            agg["count"] += 1
+            agg["total_s"] += seconds
+            agg["max_s"] = max(agg["max_s"], seconds)
+            if cycle is not None:
+                per = cycles.setdefault(cycle, {})
+                per[key] = round(per.get(key, 0.0) + seconds, 3)
+        for agg in totals.values():
+            agg["avg_s"] = round(agg["total_s"] / agg["count"], 3)
+            agg["total_s"] = round(agg["total_s"], 3)
+            agg["max_s"] = round(agg["max_s"], 3)
+        return {
+            "testId": self.test_id,
+            "final_status": self.status,
+            "total_s": round(time.monotonic() - self.started_at, 3),
+            "stages": totals,
+            "cycles": [dict(cycle=c, **v) for c, v in sorted(cycles.items())],
+            "timestamp": now_iso(),
+        }
+
+    def snapshot(self):
+        stage_name = PROCESS_STAGES[self.stage - 1] if 1 <= self.stage <= len(PROCESS_STAGES) else None
+        now = time.monotonic()
+        return {
+            "testId": self.test_id,
+            "run_status": self.status,
+            "run_stage": self.stage,
+            "stage_name": stage_name,
+            "cycle": self.cycle,
+            "start_time": self.start_time.isoformat(),
+            "elapsed_s": round(now - self.started_at, 1),
+            "stage_elapsed_s": round(now - self.stage_started_at, 1),
+            "heating": self.heat is not None and not self.heat.failed,
+            "heat_failed": self.heat is not None and self.heat.failed,
+        }
+
+
+class TestRegistry:
+    """
+    Active tests keyed by id. Writers take one of `stripes` locks chosen by
+    test id, so the MQTT thread and test threads only contend per test;
+    readers (`in`, get, snapshot) don't lock at all.
+    """
+
+    def __init__(self, stripes=16):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._records = {}
+
+    def _lock(self, test_id):
+        return self._locks[hash(test_id) % len(self._locks)]
+
+    def add(self, test_id):
+        """Register a test; returns None if it is already active"""
+        with self._lock(test_id):
+            if test_id in self._records:
+                return None
+            record = self._records[test_id] = TestRecord(test_id)
+            return record
+
+    def remove(self, test_id, record=None):
+        """
+        Unregister a test; safe to call twice, returns the record or None.
+        With `record`, only removes that exact run (not a restart under the same id).
+        """
+        with self._lock(test_id):
+            if record is not None and self._records.get(test_id) is not record:
+                return None
+            return self._records.pop(test_id, None)
+
+    def get(self, test_id):
+        return self._records.get(test_id)
+
+    def note_status(self, payload):
+        """Fold a status payload into the test's record (O(1))"""
+        record = self._records.get(payload.get("testId"))
+        if record is None or payload.get("run_status") in REPLY_STATUSES:
+            return
+        with self._lock(record.test_id):
+            if "run_status" in payload:
+                record.status = payload["run_status"]
+            stage = payload.get("run_stage")
+            if stage is not None and stage != record.stage:
+                record.stage = stage
+                record.stage_started_at = time.monotonic()
+            if "cycle" in payload:
+                record.cycle = payload["cycle"]
+
+    def set_heat(self, test_id, handle):
+        record = self._records.get(test_id)
+        if record is not None:
+            with self._lock(test_id):
+                record.heat = handle
+
+    def snapshot(self, test_id):
+        record = self._records.get(test_id)
+        return record.snapshot() if record else None
+
+    def snapshots(self):
+        return [r.snapshot() for r in list(self._records.values())]
+
+    def ids(self):
+        return list(self._records)
+
+    def clear(self):
+        for test_id in self.ids():
+            self.remove(test_id)
+
+    def __contains__(self, test_id):
+        return test_id in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+
+active_tests = TestRegistry()
+
+
+TERMINAL_STATUSES = {"completed", "error", "stopped", "failed"}
+REPLY_STATUSES = {"already_running", "busy"}  # answers to a start command, not the run's own state
+PRIORITY_STATUSES = TERMINAL_STATUSES | {"waiting_confirmation", "already_running"}
+
+
+# --- durable outbox ---
+class Outbox:
+    """
+    Store-and-forward for publishes. While the link is up and nothing is
+    spooled, publish() goes straight to the client; priority messages are
+    written to SQLite first and only deleted once paho reports them sent
+    (PUBACK for QoS 1). Otherwise durable messages are spooled, a newer
+    message with the same key replacing the older one, and a replay thread
+    drains the spool in id order at a capped rate after reconnecting.
+    Non-durable messages (live output, telemetry) are dropped while offline.
+    """
+
+    def __init__(self, path=OUTBOX_PATH):
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE,
+            topic TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            qos INTEGER NOT NULL,
+            priority INTEGER NOT NULL,
+            created REAL NOT NULL)""")
+        self.rows, self.bytes = self._db.execute(
+            "SELECT count(*), coalesce(sum(length(payload)), 0) FROM outbox").fetchone()
+        self._awaiting = {}  # row id -> MQTTMessageInfo of a publish not yet completed
+        self._wake = threading.Event()
+        self.stats = collections.Counter()
+        self._thread = threading.Thread(target=self._run, name="ur2-outbox", daemon=True)
+        self._thread.start()
+        if self.rows:
+            log_message(f"Outbox: {self.rows} messages ({self.bytes} bytes) left from last run, replaying on connect")
+
+    @staticmethod
+    def _online():
+        return client is not None and client.is_connected()
+
+    def backlog(self):
+        """Spooled messages not yet handed to the client"""
+        with self._lock:
+            return self.rows - len(self._awaiting)
+
+    def publish(self, topic, payload, qos=0, key=None, priority=False, durable=True):
+        """Send now if possible, else spool (durable) or drop. Returns False if dropped."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if self._online() and not self.backlog():
+            if priority:
+                with self._lock:  # the replay thread must not pick the row up in between
+                    row = self._spool(topic, payload, qos, key, priority)
+                    info = client.publish(topic, payload, qos=qos)
+                    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                        self._awaiting[row] = info
+                        self.stats["sent"] += 1
+                self._wake.set()
+                return True  # if the publish failed the spooled row is replayed
+            if client.publish(topic, payload, qos=qos).rc == mqtt.MQTT_ERR_SUCCESS:
+                self.stats["sent"] += 1
+                return True
+        if not durable:
+            self.stats["dropped_offline"] += 1
+            return False
+        self._spool(topic, payload, qos, key, priority)
+        self._wake.set()
+        return True
+
+    def _spool(self, topic, payload, qos, key, priority):
+        with self._lock:
+            if key is not None:
+                old = self._db.execute("SELECT id, priority FROM outbox WHERE key = ?", (key,)).fetchone()
+                if old is not None:
+                    self._delete([old[0]])
+                    priority = priority or bool(old[1])
+                    self.stats["deduped"] += 1
+            row = self._db.execute(
+                "INSERT INTO outbox (key, topic, payload, qos, priority, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, topic, payload, qos, int(priority), time.time())).lastrowid
+            self.rows += 1
+            self.bytes += len(payload)
+            self.stats["spooled"] += 1
+            self._enforce_limits()
+            return row
+
+    def _delete(self, ids):
+        if not ids:
+            return
+        marks = ",".join("?" * len(ids))
+        count, size = self._db.execute(
+            f"SELECT count(*), coalesce(sum(length(payload)), 0) FROM outbox WHERE id IN ({marks})", ids).fetchone()
+        self._db.execute(f"DELETE FROM outbox WHERE id IN ({marks})", ids)
+        self.rows -= count
+        self.bytes -= size
+
+    def _enforce_limits(self):
+        """Backpressure: evict the oldest non-priority messages beyond the row/byte caps"""
+        while self.rows > OUTBOX_MAX_ROWS or self.bytes > OUTBOX_MAX_BYTES:
+            ids = [r[0] for r in self._db.execute(
+                "SELECT id FROM outbox WHERE priority = 0 ORDER BY id LIMIT 100") if r[0] not in self._awaiting]
+            if not ids:
+                self.stats["over_limit"] += 1  # only priority messages left, keep them
+                return
+            self._delete(ids)
+            self.stats["evicted"] += len(ids)
+
+    def _reap(self):
+        with self._lock:
+            done = [row for row, info in self._awaiting.items() if info.is_published()]
+            for row in done:
+                del self._awaiting[row]
+            self._delete(done)
+
+    def _replay(self):
+        """Hand spooled rows to the client in order, capped in flight and per second"""
+        while self._online():
+            self._reap()
+            with self._lock:
+                budget = min(OUTBOX_REPLAY_BATCH, OUTBOX_REPLAY_INFLIGHT - len(self._awaiting))
+                if budget <= 0:
+                    batch = None
+                else:
+                    skip = list(self._awaiting)
+                    batch = self._db.execute(
+                        f"SELECT id, topic, payload, qos FROM outbox WHERE id NOT IN ({','.join('?' * len(skip))}) "
+                        "ORDER BY id LIMIT ?", (*skip, budget)).fetchall()
+            if batch is None:
+                time.sleep(0.01)
+                continue
+            if not batch:
+                return
+            for row, topic, payload, qos in batch:
+                info = client.publish(topic, payload, qos=qos)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    return  # link dropped again, wait for the next connect
+                with self._lock:
+                    self._awaiting[row] = info
+                self.stats["replayed"] += 1
+            time.sleep(len(batch) / OUTBOX_REPLAY_PER_SECOND)
+
+    def _run(self):
+        while True:
+            self._wake.wait(0.2 if self._awaiting else None)
+            self._wake.clear()
+            self._reap()
+            if self.backlog() and self._online():
+                self._replay()
+
+    def wake(self):
+        """Called on (re)connect"""
+        self._wake.set()
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        with self._lock:
+            stats.update(rows=self.rows, bytes=self.bytes, awaiting=len(self._awaiting))
+        return stats
+
+
+outbox = None  # opened on first use by get_outbox(), not at import
+outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    global outbox
+    with outbox_lock:
+        if outbox is None:
+            outbox = Outbox()
+        return outbox
+
+
+def status_key(payload):
+    """Outbox dedupe key: one spooled status per (testId, cycle, stage)"""
+    return f"status|{payload.get('testId')}|{payload.get('cycle')}|{payload.get('run_stage')}"
+
+
+class StatusPublisher:
+    """
+    Publish pipeline behind pub(). Non-priority updates wait up to
+    `window` seconds so a newer update for the same test can replace them;
+    due updates from several tests can go out as one batch envelope.
+    Terminal states and confirmation requests are never coalesced.
+    """
+
+    def __init__(self, window=None, batch=None):
+        self.window = STATUS_COALESCE_WINDOW if window is None else window
+        self.batch = STATUS_BATCH if batch is None else batch
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()  # test_id -> [due, payload]
+        self._thread = None
+        self.stats = collections.Counter()
+
+    def submit(self, payload):
+        test_id = payload.get("testId")
+        status = payload.get("run_status")
+        if status in PRIORITY_STATUSES:
+            with self._cond:
+                queued = self._pending.pop(test_id, None)
+            if queued is not None:
+                if status in TERMINAL_STATUSES:
+                    self.stats["coalesced"] += 1  # superseded by the final state
+                else:
+                    self._send([queued[1]])  # keep order ahead of the prompt
+            self._send([payload], qos=STATUS_PRIORITY_QOS)
+            return
+        if self.window <= 0 and not self.batch:
+            self._send([payload])
+            return
+        with self._cond:
+            queued = self._pending.get(test_id)
+            if queued is not None:
+                queued[1] = payload
+                self.stats["coalesced"] += 1
+            else:
+                self._pending[test_id] = [time.monotonic() + self.window, payload]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ur2-status", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _send(self, payloads, qos=STATUS_QOS):
+        priority = qos == STATUS_PRIORITY_QOS
+        if STATUS_FORMAT not in ("json", "negotiated"):
+            for payload in payloads:  # the selected binary format replaces JSON entirely
+                get_outbox().publish(f"{TEST_SUB_TOPIC}/{STATUS_FORMAT}", encode_status(payload, STATUS_FORMAT), qos=qos,
+                               key=status_key(payload), priority=priority)
+                self.stats["published"] += 1
+            return
+        binary = format_negotiator.active_formats() if STATUS_FORMAT == "negotiated" else ()
+        if self.batch and len(payloads) > 1:
+            get_outbox().publish(TEST_BATCH_TOPIC, json.dumps({"count": len(payloads), "updates": payloads}),
+                           qos=qos, priority=priority)
+            self.stats["published"] += 1
+            self.stats["batched"] += len(payloads) - 1
+            for fmt in binary:
+                for payload in payloads:
+                    get_outbox().publish(f"{TEST_SUB_TOPIC}/{fmt}", encode_status(payload, fmt), qos=qos, durable=False)
+            return
+        for payload in payloads:
+            get_outbox().publish(TEST_SUB_TOPIC, json.dumps(payload), qos=qos, key=status_key(payload), priority=priority)
+            self.stats["published"] += 1
+            for fmt in binary:
+                get_outbox().publish(f"{TEST_SUB_TOPIC}/{fmt}", encode_status(payload, fmt), qos=qos, durable=False)
+
+    def _take_due(self, force=False):
+        now = time.monotonic()
+        due = [tid for tid, (deadline, _) in self._pending.items() if force or deadline <= now]
+        return [self._pending.pop(tid)[1] for tid in due]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                payloads = self._take_due()
+                if not payloads:
+                    next_due = min(deadline for deadline, _ in self._pending.values())
+                    self._cond.wait(max(0.0, next_due - time.monotonic()))
+                    continue
+            self._send(payloads)
+
+    def flush(self):
+        """Send everything still waiting in the window"""
+        with self._cond:
+            payloads = self._take_due(force=True)
+        if payloads:
+            self._send(payloads)
+
+    def snapshot(self):
+        """Counters, with "saved" = messages that never hit the broker"""
+        stats = dict(self.stats)
+        stats["saved"] = stats.get("coalesced", 0) + stats.get("batched", 0)
+        with self._cond:
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+status_publisher = StatusPublisher()
+
+
+@instrumented("publish", _pub_labels, per_test=False)
+def pub(test_id, **fields):
+    payload = {"testId": test_id, "timestamp": now_iso(), **fields}
+    active_tests.note_status(payload)
+    record = active_tests.get(test_id)
+    get_archive().record_status(payload, run=record.run_id if record is not None else None)
+    status_publisher.submit(payload)
+
+def image_dir(material):
+    """Capture directory for a material"""
+    if material == 'aluminum':
+        return 'test_img/al'
+    elif material == 'silicon':
+        return 'test_img/si'
+    # Fallback to general test_img directory
+    return 'test_img'
+
+
+def find_image(test_id=None, cycle=None, material=None, fallback=True):
+    """
+    Pick the capture for a test/cycle, or (with fallback) the newest one
+    for the material. A fallback file is only tagged with the test/cycle
+    if no other run has claimed it.
+    """
+    img_dir = image_dir(material)
+
+    # Prefer the capture named for this test/cycle, otherwise the newest file
+    index = get_image_index(img_dir)
+    path = index.lookup(test_id, cycle)
+    if path is not None:
+        return path
+    if not fallback and test_id is not None and cycle is not None:
+        log_message(f'No image for test {test_id} cycle {cycle} in {img_dir}/')
+        return None
+    path = index.latest()
+    if path is None:
+        log_message(f'No image files found in {img_dir}/')
+        return None
+    index.tag(path, test_id, cycle)
+    return path
+
+
+def publish_image(path, test_id=None, cycle=None, material=None, variant=None):
+    """Publish metadata + one variant of an image file on IMAGE_TOPIC(/raw)"""
+    variant = variant or IMAGE_SEND_VARIANT
+    full_size = os.path.getsize(path)
+    variants = image_cache.available(path)
+    img_bytes = None
+    if variant != "original":
+        encoded = image_cache.get(path, timeout=IMAGE_VARIANT_WAIT)
+        if encoded and variant in encoded:
+            img_bytes = encoded[variant]
+            variants = ["original", *encoded]
+        else:
+            log_message(f"Variant '{variant}' of {path} not ready, sending original")
+            variant = "original"
+    if img_bytes is None:
+        with open(path, 'rb') as img_file:
+            img_bytes = img_file.read()
+    publish_image_bytes(img_bytes, os.path.basename(path), test_id=test_id, cycle=cycle, material=material,
+                        variant=variant, variants=variants, full_size=full_size,
+                        content_type='image/png' if variant == "original" else 'image/jpeg')
+
+
+def publish_image_bytes(img_bytes, filename, test_id=None, cycle=None, material=None,
+                        variant="original", variants=("original",), full_size=None, content_type='image/png'):
+    """Publish metadata + image bytes on IMAGE_TOPIC(/raw), wherever the bytes came from"""
+    full_size = len(img_bytes) if full_size is None else full_size
+    # Send metadata first
+    image_metadata = {
+        'testId': test_id,
+        'cycle': cycle,
+        'filename': filename,
+        'size': len(img_bytes),
+        'material': material,
+        'timestamp': datetime.now().isoformat(),
+        'variant': variant,
+        'variants': list(variants),
+        'full_size': full_size,
+        'content_type': content_type,
+    }
+    key = f"{test_id}|{cycle}|{material}"
+    get_outbox().publish(IMAGE_TOPIC, json.dumps(image_metadata), key="image|" + key)
+    get_outbox().publish(IMAGE_TOPIC + '/raw', img_bytes, key="image_raw|" + key)  # Send raw bytes to a subtopic
+    log_message(f"Image bytes sent over MQTT for test {test_id}, cycle {cycle}, file {filename}, "
+                f"material {material}, variant {variant} ({len(img_bytes)}/{full_size} bytes)")
+
+
+def publish_image_raw(raw, filename, test_id=None, cycle=None, material=None, variant=None, content_type='image/png'):
+    """publish_image for an original held in memory (a captured frame); variants come from image_cache"""
+    variant = variant or IMAGE_SEND_VARIANT
+    img_bytes, variants = raw, ["original"]
+    if variant != "original":
+        encoded = image_cache.get_bytes(raw, filename, timeout=IMAGE_VARIANT_WAIT) or {}
+        if variant in encoded:
+            img_bytes, variants = encoded[variant], ["original", *encoded]
+        else:
+            log_message(f"Variant '{variant}' of {filename} not ready, sending original")
+            variant = "original"
+    publish_image_bytes(img_bytes, filename, test_id=test_id, cycle=cycle, material=material,
+                        variant=variant, variants=variants, full_size=len(raw),
+                        content_type=content_type if variant == "original" else 'image/jpeg')
+
+
+@instrumented("image_send", _image_labels)
+def send_img_to_web(test_id=None, cycle=None, material=None):
+    """Send image over MQTT after script 3."""
+    try:
+        latest_img = find_image(test_id, cycle, material)
+        if latest_img is None:
+            return
+        analysis = None
+        if ANALYSIS_ENABLED:
+            # Pillow decodes straight from the file; no second copy of the bytes next to the chunked reader
+            analysis = publish_analysis(latest_img, os.path.basename(latest_img), test_id=test_id, cycle=cycle, material=material)
+        if IMAGE_TRANSFER_MODE == "chunked":
+            send_img_chunked(latest_img, test_id=test_id, cycle=cycle, material=material)
+        else:
+            publish_image(latest_img, test_id=test_id, cycle=cycle, material=material)
+        get_archive().record_image(test_id, cycle, material, os.path.basename(latest_img), os.path.getsize(latest_img),
+                             analysis and analysis.get("concentration"))
+    except Exception as e:
+        log_message(f"Failed to send image: {e}")
+
+
+def handle_image_request(data):
+    """Serve {"testId", "cycle", "material", "variant"} from IMAGE_REQUEST_TOPIC"""
+    try:
+        recent = capture_pipeline.recent(data.get("testId"), data.get("cycle"), data.get("material"))
+        if recent is not None:
+            filename, raw, content_type = recent
+            publish_image_raw(raw, filename, test_id=data.get("testId"), cycle=data.get("cycle"),
+                              material=data.get("material"), variant=data.get("variant", "original"),
+                              content_type=content_type)
+            return
+        # a named test/cycle gets its own capture or an error, never someone else's
+        path = find_image(data.get("testId"), data.get("cycle"), data.get("material"), fallback=False)
+        if path is None:
+            get_outbox().publish(IMAGE_TOPIC, json.dumps({
+                'testId': data.get("testId"),
+                'cycle': data.get("cycle"),
+                'material': data.get("material"),
+                'timestamp': datetime.now().isoformat(),
+                'error': "no image for this test/cycle" if data.get("testId") is not None else "no image",
+            }), durable=False)
+            return
+        publish_image(path, test_id=data.get("testId"), cycle=data.get("cycle"),
+                      material=data.get("material"), variant=data.get("variant", "original"))
+    except Exception as e:
+        log_message(f"Failed to serve image request: {e}")
+
+
+# --- encoded image variants ---
+class ImageVariantCache:
+    """
+    LRU cache of encoded preview/thumbnail variants, keyed by content hash
+    and looked up by (path, mtime), or by the bytes themselves for frames
+    that never touch the disk. Encoding runs on one background worker,
+    never on the publishing thread; total cached bytes stay under max_bytes.
+    Needs Pillow; without it only the original is offered.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # sha256 -> {variant: bytes}
+        self._bytes = 0
+        self._hash_of = {}    # (path, mtime_ns) -> sha256
+        self._building = {}   # (path, mtime_ns) or sha256 -> Future
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ur2-img")
+
+    @functools.cached_property
+    def enabled(self):
+        """Pillow is importable (checked, and logged if not, on first use rather than at import)"""
+        try:
+            from PIL import Image  # noqa: F401
+            return True
+        except ImportError:
+            log_message("Pillow not installed, image previews disabled (sending originals)")
+            return False
+
+    @staticmethod
+    def _file_key(path):
+        return (path, os.stat(path).st_mtime_ns)
+
+    def _lookup(self, key):
+        sha = self._hash_of.get(key)
+        if sha is None or sha not in self._entries:
+            return None
+        self._entries.move_to_end(sha)
+        return self._entries[sha]
+
+    def available(self, path):
+        """Variant names that can be sent right now without encoding"""
+        with self._lock:
+            encoded = self._lookup(self._file_key(path))
+        return ["original", *(encoded or {})]
+
+    def prefetch(self, path):
+        """Start encoding path in the background (no-op if cached or running)"""
+        if not self.enabled:
+            return None
+        key = self._file_key(path)
+        with self._lock:
+            if self._lookup(key) is not None:
+                return None
+            fut = self._building.get(key)
+            if fut is None:
+                fut = self._building[key] = self._executor.submit(self._build, key)
+            return fut
+
+    def get(self, path, timeout=None):
+        """Encoded variants for path, waiting up to timeout for the worker"""
+        if not self.enabled:
+            return None
+        key = self._file_key(path)
+        with self._lock:
+            encoded = self._lookup(key)
+        if encoded is not None:
+            return encoded
+        fut = self.prefetch(path)
+        if fut is None:
+            with self._lock:
+                return self._lookup(key)
+        try:
+            return fut.result(timeout)
+        except Exception as e:
+            log_message(f"Image variant encoding failed for {path}: {e}")
+            return None
+
+    def get_bytes(self, raw, name=None, timeout=None):
+        """Encoded variants for image bytes already in memory, waiting up to timeout"""
+        if not self.enabled:
+            return None
+        sha = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            encoded = self._entries.get(sha)
+            if encoded is not None:
+                self._entries.move_to_end(sha)
+                return encoded
+            fut = self._building.get(sha)
+            if fut is None:
+                fut = self._building[sha] = self._executor.submit(self._build_bytes, sha, raw, name)
+        try:
+            return fut.result(timeout)
+        except Exception as e:
+            log_message(f"Image variant encoding failed for {name or sha[:12]}: {e}")
+            return None
+
+    def _build(self, key):
+        path = key[0]
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            sha = hashlib.sha256(raw).hexdigest()
+            with self._lock:
+                self._hash_of[key] = sha
+                if sha in self._entries:  # same content under another path/mtime
+                    return self._lookup(key)
+            return self._encode(sha, raw, os.path.basename(path))
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+
+    def _build_bytes(self, sha, raw, name):
+        try:
+            return self._encode(sha, raw, name or sha[:12])
+        finally:
+            with self._lock:
+                self._building.pop(sha, None)
+
+    def _encode(self, sha, raw, name):
+        encoded = encode_variants(raw)
+        size = sum(len(b) for b in encoded.values())
+        with self._lock:
+            self._entries[sha] = encoded
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sum(len(b) for b in evicted.values())
+            live = set(self._entries)
+            self._hash_of = {k: v for k, v in self._hash_of.items() if v in live}
+        log_message(f"Encoded variants for {name}: "
+                    + ", ".join(f"{n}={len(b)}B" for n, b in encoded.items()) + f" (original {len(raw)}B)")
+        return encoded
+
+
+def encode_variants(raw):
+    """JPEG preview/thumbnail bytes for an encoded image (needs Pillow)"""
+    from PIL import Image
+
+    encoded = {}
+    with Image.open(io.BytesIO(raw)) as img:
+        img = img.convert("RGB")
+        for name, (max_px, quality) in IMAGE_VARIANTS.items():
+            variant = img.copy()
+            variant.thumbnail((max_px, max_px))
+            out = io.BytesIO()
+            variant.save(out, format="JPEG", quality=quality, optimize=True)
+            encoded[name] = out.getvalue()
+    return encoded
+
+
+image_cache = ImageVariantCache()
+
+
+# --- latest-image index ---
+_IN_ATTRIB, _IN_CLOSE_WRITE, _IN_MOVED_FROM, _IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+_IN_DELETE, _IN_Q_OVERFLOW, _IN_NONBLOCK, _IN_CLOEXEC = 0x200, 0x4000, 0o4000, 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class ImageIndex:
+    """
+    Newest-file and per-(test, cycle) index for one capture directory.
+    On Linux it is kept current from inotify events, drained without
+    blocking on each lookup; elsewhere it rescans only when the directory
+    mtime changes or IMAGE_INDEX_POLL_SECONDS have passed.
+    """
+
+    def __init__(self, img_dir):
+        self.img_dir = img_dir
+        self._lock = threading.Lock()
+        self._files = {}      # path -> mtime
+        self._latest = None
+        self._by_run = {}     # (test_id, cycle) -> path
+        self._run_of = {}     # path -> (test_id, cycle)
+        self._fd = None
+        self._dir_mtime = None
+        self._scanned_at = 0.0
+        self._open_inotify()  # before the scan so nothing slips in between
+        self._rescan()
+
+    def _open_inotify(self):
+        if not sys.platform.startswith("linux") or not os.path.isdir(self.img_dir):
+            return
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+            if fd < 0:
+                return
+            mask = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(self.img_dir), mask) < 0:
+                os.close(fd)
+                return
+            self._fd = fd
+        except (OSError, AttributeError) as e:
+            log_message(f"image index: inotify unavailable for {self.img_dir} ({e}), polling instead")
+
+    def _set(self, path, mtime):
+        self._files[path] = mtime
+        if self._latest is None or mtime >= self._files.get(self._latest, float("-inf")):
+            self._latest = path
+        m = IMAGE_RUN_PATTERN.match(os.path.basename(path))
+        if m:
+            self._link(path, m.group("test_id"), int(m.group("cycle")))
+
+    def _drop(self, path):
+        self._files.pop(path, None)
+        key = self._run_of.pop(path, None)
+        if key and self._by_run.get(key) == path:
+            del self._by_run[key]
+        if path == self._latest:
+            # only O(N) when the newest file itself goes away
+            self._latest = max(self._files, key=self._files.get) if self._files else None
+
+    def _link(self, path, test_id, cycle):
+        old = self._run_of.get(path)
+        if old and self._by_run.get(old) == path:
+            del self._by_run[old]  # one run per file keeps the map bounded by the directory
+        self._by_run[(str(test_id), cycle)] = path
+        self._run_of[path] = (str(test_id), cycle)
+
+    def _refresh(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._drop(path)
+            return
+        if os.path.isfile(path):
+            self._set(path, st.st_mtime)
+
+    def _rescan(self):
+        seen = {}
+        try:
+            self._dir_mtime = os.stat(self.img_dir).st_mtime
+            with os.scandir(self.img_dir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        seen[entry.path] = entry.stat().st_mtime
+        except FileNotFoundError:
+            self._dir_mtime = None
+        for path in list(self._files):
+            if path not in seen:
+                self._drop(path)
+        for path, mtime in seen.items():
+            self._set(path, mtime)
+        self._scanned_at = time.monotonic()
+
+    def _sync(self):
+        if self._fd is None:
+            try:
+                dir_mtime = os.stat(self.img_dir).st_mtime
+            except FileNotFoundError:
+                dir_mtime = None
+            if dir_mtime != self._dir_mtime or time.monotonic() - self._scanned_at > IMAGE_INDEX_POLL_SECONDS:
+                self._rescan()
+            return
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, name_len = _INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += _INOTIFY_EVENT.size
+                name = os.fsdecode(buf[offset:offset + name_len].rstrip(b"\0"))
+                offset += name_len
+                if mask & _IN_Q_OVERFLOW:
+                    self._rescan()
+                elif name:
+                    self._refresh(os.path.join(self.img_dir, name))
+
+    def latest(self):
+        with self._lock:
+            self._sync()
+            return self._latest
+
+    def lookup(self, test_id, cycle):
+        if test_id is None or cycle is None:
+            return None
+        with self._lock:
+            self._sync()
+            return self._by_run.get((str(test_id), cycle))
+
+    def tag(self, path, test_id, cycle):
+        """Remember which test/cycle a file was sent for; False if another run already has it"""
+        if test_id is None or cycle is None:
+            return False
+        with self._lock:
+            if path not in self._files:
+                return False
+            owner = self._run_of.get(path)
+            if owner is not None and owner != (str(test_id), cycle):
+                return False
+            self._link(path, test_id, cycle)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return len(self._files)
+
+
+image_indexes = {}
+image_indexes_lock = threading.Lock()
+
+
+def get_image_index(img_dir):
+    with image_indexes_lock:
+        index = image_indexes.get(img_dir)
+        if index is None:
+            index = image_indexes[img_dir] = ImageIndex(img_dir)
+        return index
+
+
+# --- chunked image transfer ---
+# chunk payload = CHUNK_HEADER (transfer id, sequence number, chunk count) + bytes
+CHUNK_HEADER = struct.Struct("!16sII")
+
+image_transfers = collections.OrderedDict()  # transfer id hex -> manifest (+ path, mtime, pending)
+image_transfers_lock = threading.Lock()
+
+
+def _publish_chunks(manifest, seqs):
+    """
+    Publish the given chunk numbers, keeping at most IMAGE_MAX_INFLIGHT_CHUNKS
+    unacked. If the link goes down the transfer is marked pending and all its
+    chunks go out again from resume_img_transfers() on reconnect.
+    """
+    tid = uuid.UUID(manifest["transferId"]).bytes
+    size = manifest["size"]
+    chunk_size = manifest["chunk_size"]
+    inflight = collections.deque()
+    with open(manifest["_path"], 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for seq in seqs:
+                start = seq * chunk_size
+                body = mm[start:min(start + chunk_size, size)]
+                info = client.publish(IMAGE_CHUNK_TOPIC,
+                                      CHUNK_HEADER.pack(tid, seq, manifest["chunks"]) + body,
+                                      qos=IMAGE_CHUNK_QOS)
+                if info is not None and info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    manifest["_pending"] = True
+                    return False
+                if info is None or IMAGE_CHUNK_QOS == 0:
+                    continue
+                inflight.append(info)
+                if len(inflight) >= IMAGE_MAX_INFLIGHT_CHUNKS:
+                    try:
+                        inflight.popleft().wait_for_publish(timeout=30)
+                    except (RuntimeError, ValueError):  # dropped from the queue on disconnect
+                        manifest["_pending"] = True
+                        return False
+    return True
+
+
+def send_img_chunked(path, test_id=None, cycle=None, material=None):
+    """
+    Send an image as a manifest (size, sha256, chunk count) followed by
+    fixed-size chunks read through mmap, so the whole file is never held
+    in memory and a lost chunk can be re-requested on IMAGE_RESEND_TOPIC.
+    Offline, the manifest is spooled in the outbox and the chunks follow
+    from the file once the link is back.
+    """
+    st = os.stat(path)
+    if st.st_size == 0:
+        log_message(f"Image {path} is empty, not sending")
+        return None
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            digest = hashlib.sha256(mm).hexdigest()
+
+    manifest = {
+        'transferId': uuid.uuid4().hex,
+        'testId': test_id,
+        'cycle': cycle,
+        'filename': os.path.basename(path),
+        'material': material,
+        'size': st.st_size,
+        'sha256': digest,
+        'chunk_size': IMAGE_CHUNK_SIZE,
+        'chunks': (st.st_size + IMAGE_CHUNK_SIZE - 1) // IMAGE_CHUNK_SIZE,
+        'timestamp': now_iso(),
+    }
+    entry = dict(manifest, _path=path, _mtime=st.st_mtime, _pending=False)
+    with image_transfers_lock:
+        image_transfers[manifest['transferId']] = entry
+        while len(image_transfers) > IMAGE_TRANSFERS_KEPT:
+            _, evicted = image_transfers.popitem(last=False)
+            if evicted["_pending"]:
+                log_message(f"Image transfer {evicted['transferId']} never got its chunks out, dropped")
+
+    get_outbox().publish(IMAGE_MANIFEST_TOPIC, json.dumps(manifest), qos=IMAGE_CHUNK_QOS,
+                   key=f"image_manifest|{manifest['transferId']}")
+    # chunks must not overtake a manifest still in the spool
+    if get_outbox().backlog() or client is None or not client.is_connected() or not _publish_chunks(entry, range(manifest['chunks'])):
+        entry["_pending"] = True
+        log_message(f"Image {manifest['filename']} for test {test_id}, cycle {cycle} queued, "
+                    f"chunks follow on reconnect")
+        return manifest['transferId']
+    log_message(f"Image {manifest['filename']} sent in {manifest['chunks']} chunks "
+                f"for test {test_id}, cycle {cycle}, material {material}")
+    return manifest['transferId']
+
+
+def resume_img_transfers(timeout=30):
+    """On reconnect: once the spooled manifests are out, send the chunks of every pending transfer"""
+    with image_transfers_lock:
+        pending = [entry for entry in image_transfers.values() if entry["_pending"]]
+    if not pending:
+        return
+    deadline = time.monotonic() + timeout
+    while get_outbox().backlog() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for entry in pending:
+        entry["_pending"] = False
+        resend_img_chunks(entry["transferId"])
+
+
+def resend_img_chunks(transfer_id, missing=None):
+    """Re-publish the requested chunks (all of them if missing is empty)"""
+    with image_transfers_lock:
+        manifest = image_transfers.get(transfer_id)
+    if manifest is None:
+        log_message(f"Resend for unknown/expired image transfer {transfer_id}")
+        return
+    try:
+        if os.stat(manifest["_path"]).st_mtime != manifest["_mtime"]:
+            log_message(f"Image for transfer {transfer_id} changed on disk, not resending")
+            return
+    except FileNotFoundError:
+        log_message(f"Image for transfer {transfer_id} is gone, not resending")
+        return
+    if missing:
+        if not isinstance(missing, list):
+            log_message(f"Resend for image transfer {transfer_id}: 'missing' must be a list, got {type(missing).__name__}")
+            return
+        seqs, rejected = set(), []
+        for n in missing:
+            seq = int(n) if isinstance(n, str) and n.isdigit() else n
+            if isinstance(seq, int) and not isinstance(seq, bool) and 0 <= seq < manifest["chunks"]:
+                seqs.add(seq)
+            else:
+                rejected.append(n)
+        if rejected:
+            log_message(f"Resend for image transfer {transfer_id}: ignoring {len(rejected)} invalid chunk number(s) "
+                        f"{rejected[:5]} (transfer has {manifest['chunks']})")
+        if not seqs:
+            return
+        seqs = sorted(seqs)
+    else:
+        seqs = range(manifest["chunks"])
+    log_message(f"Resending {len(seqs)} chunk(s) of image transfer {transfer_id}")
+    _publish_chunks(manifest, seqs)
+
+
+# --- image analysis ---
+def _region_pixels(np, rgb, box):
+    """Pixels of a fractional (x0, y0, x1, y1) box as an (n, 3) float array"""
+    h, w = rgb.shape[:2]
+    x0, y0, x1, y1 = box
+    r0, r1 = int(round(y0 * h)), max(int(round(y1 * h)), int(round(y0 * h)) + 1)
+    c0, c1 = int(round(x0 * w)), max(int(round(x1 * w)), int(round(x0 * w)) + 1)
+    return rgb[r0:r1, c0:c1].reshape(-1, 3).astype(np.float64)
+
+
+def _hsv_means(np, px):
+    """Mean hue (circular, degrees), saturation and value of (n, 3) RGB pixels in 0..255"""
+    px = px / 255.0
+    maxc = px.max(axis=1)
+    delta = maxc - px.min(axis=1)
+    r, g, b = px[:, 0], px[:, 1], px[:, 2]
+    safe = np.where(delta > 0, delta, 1.0)
+    hue = np.select([delta == 0, maxc == r, maxc == g],
+                    [0.0, ((g - b) / safe) % 6.0, (b - r) / safe + 2.0],
+                    (r - g) / safe + 4.0) * (math.pi / 3.0)
+    sat = np.where(maxc > 0, delta / np.where(maxc > 0, maxc, 1.0), 0.0)
+    # average hue as an angle so 359 and 1 degrees give 0, not 180
+    mean_hue = round(math.degrees(math.atan2(np.sin(hue).mean(), np.cos(hue).mean())), 2) % 360.0
+    return [mean_hue, round(float(sat.mean()), 4), round(float(maxc.mean()), 4)]
+
+
+@functools.lru_cache(maxsize=None)
+def _analysis_backend():
+    """(numpy, PIL.Image), or None (logged once) if either is missing"""
+    np = _load_numpy()
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if np is None or Image is None:
+        log_message("NumPy/Pillow not installed, image analysis disabled")
+        return None
+    return np, Image
+
+
+def analyze_panel(source, material=None):
+    """
+    Colorimetric statistics of an encoded panel image (bytes or a file
+    path, which Pillow reads itself): per ANALYSIS_REGIONS
+    mean/std RGB and mean HSV, and for materials in ANALYSIS_CALIBRATION
+    the absorbance of the sample against the blank region and the
+    concentration interpolated from the calibration points. Returns None
+    without NumPy/Pillow.
+    """
+    backend = _analysis_backend()
+    if backend is None:
+        return None
+    np, Image = backend
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        rgb = np.asarray(img.convert("RGB"))
+    regions = {}
+    means = {}
+    for name, box in ANALYSIS_REGIONS.items():
+        px = _region_pixels(np, rgb, box)
+        means[name] = px.mean(axis=0)
+        regions[name] = {
+            "pixels": int(px.shape[0]),
+            "rgb": [round(float(v), 2) for v in means[name]],
+            "rgb_std": [round(float(v), 2) for v in px.std(axis=0)],
+            "hsv": _hsv_means(np, px),
+        }
+    result = {"width": int(rgb.shape[1]), "height": int(rgb.shape[0]), "regions": regions}
+
+    cal = ANALYSIS_CALIBRATION.get(material)
+    if cal:
+        ch = "RGB".index(cal["channel"])
+        sample = max(float(means[cal.get("sample", "sample")][ch]), 1.0)
+        blank = max(float(means[cal.get("blank", "blank")][ch]), 1.0)
+        absorbance = math.log10(blank / sample)
+        xs, ys = zip(*cal["points"])
+        result["concentration"] = {
+            "value": round(float(np.interp(absorbance, xs, ys)), 4),
+            "unit": cal.get("unit", "mg/L"),
+            "absorbance": round(absorbance, 4),
+            "channel": cal["channel"],
+            "in_range": xs[0] <= absorbance <= xs[-1],
+        }
+    return result
+
+
+@instrumented("image_analysis", _image_labels)
+def publish_analysis(source, filename, test_id=None, cycle=None, material=None, content_type='image/png'):
+    """Analyze a captured panel (bytes or path) and publish the numbers with its image metadata on ANALYSIS_TOPIC"""
+    if not ANALYSIS_ENABLED:
+        return None
+    try:
+        size = os.path.getsize(source) if isinstance(source, str) else len(source)
+        result = analyze_panel(source, material)
+    except Exception as e:
+        log_message(f"Image analysis failed for {filename}: {e}")
+        return None
+    if result is None:
+        return None
+    message = {
+        'testId': test_id,
+        'cycle': cycle,
+        'material': material,
+        'filename': filename,
+        'size': size,
+        'content_type': content_type,
+        'timestamp': now_iso(),
+        **result,
+    }
+    get_outbox().publish(ANALYSIS_TOPIC, json.dumps(message), key=f"analysis|{test_id}|{cycle}|{material}")
+    conc = result.get("concentration")
+    if conc:
+        log_message(f"Test {test_id} cycle {cycle} {material}: {conc['value']} {conc['unit']} "
+                    f"(A={conc['absorbance']})", test_id=test_id, cycle=cycle)
+    return message
+
+
+# --- in-memory capture ---
+class CaptureFrame:
+    """One encoded camera frame (bytes or a shared-memory view) on its way to MQTT"""
+
+    __slots__ = ("test_id", "cycle", "material", "data", "content_type", "captured_at", "_release")
+
+    def __init__(self, data, test_id=None, cycle=None, material=None, content_type="image/png", release=None):
+        self.data = data
+        self.test_id = test_id
+        self.cycle = cycle
+        self.material = material
+        self.content_type = content_type
+        self.captured_at = datetime.now()
+        self._release = release
+
+    @property
+    def filename(self):
+        short = os.path.basename(image_dir(self.material)) or "img"
+        run = f"{self.test_id}_cycle{self.cycle}" if self.cycle is not None else f"{self.test_id}_{self.captured_at:%Y%m%d%H%M%S}"
+        return f"{run}_{short}.png"
+
+    def release(self):
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+
+class FrameSlot:
+    """
+    Shared-memory segment an image stage writes its frame into instead of
+    a file: UR2_FRAME_SHM / UR2_FRAME_SHM_SIZE in the script's environment,
+    8-byte little-endian length followed by the encoded image. We own and
+    unlink the segment (a script's own resource tracker may unlink it too,
+    which the open mapping survives).
+    """
+
+    HEADER = struct.Struct("<Q")
+
+    def __init__(self, size=CAPTURE_SHM_BYTES):
+        from multiprocessing import shared_memory
+
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.HEADER.pack_into(self.shm.buf, 0, 0)
+        self._view = None
+
+    @property
+    def env(self):
+        return {"UR2_FRAME_SHM": self.shm.name, "UR2_FRAME_SHM_SIZE": str(self.shm.size)}
+
+    def take(self, test_id=None, cycle=None, material=None):
+        """The frame the script wrote as a CaptureFrame owning the segment, or None"""
+        n = self.HEADER.unpack_from(self.shm.buf, 0)[0]
+        if not 0 < n <= self.shm.size - self.HEADER.size:
+            return None
+        self._view = self.shm.buf[self.HEADER.size:self.HEADER.size + n]
+        return CaptureFrame(self._view, test_id=test_id, cycle=cycle, material=material, release=self.close)
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+_camera_frames = {}  # material -> sample frame bytes, read once
+
+
+def simulated_frame(material):
+    """Frame from the simulated camera: the newest sample image for the material, kept in memory"""
+    frame = _camera_frames.get(material)
+    if frame is None:
+        path = get_image_index(image_dir(material)).latest()
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            frame = _camera_frames[material] = f.read()
+    return frame
+
+
+class CapturePipeline:
+    """
+    Frames from the image stages go straight from memory to MQTT: stages
+    submit() into a bounded queue (a full queue drops the frame after
+    CAPTURE_PUT_TIMEOUT rather than stalling the test, and says so on
+    IMAGE_TOPIC), CAPTURE_WORKERS threads encode and publish, analysis
+    runs on its own threads and CAPTURE_PERSIST writes a copy into the
+    capture directory afterwards on a separate writer thread. The asyncio
+    orchestrator hands frames over through `executor`, so a full queue
+    never ties up the loop's default executor.
+    """
+
+    def __init__(self, maxsize=CAPTURE_QUEUE_SIZE, workers=CAPTURE_WORKERS,
+                 analysis_workers=CAPTURE_ANALYSIS_WORKERS):
+        self._queue = queue.Queue(maxsize)
+        self._workers = workers
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._analysis = ThreadPoolExecutor(max_workers=analysis_workers, thread_name_prefix="ur2-capture-analysis")
+        self._analyzing = set()
+        self._disk = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ur2-capture-disk")
+        self.executor = ThreadPoolExecutor(max_workers=maxsize + workers, thread_name_prefix="ur2-capture-put")
+        self._recent = collections.OrderedDict()  # (test_id, cycle, material) -> (filename, raw, content_type)
+        self._recent_lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def _start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                t = threading.Thread(target=self._run, name=f"ur2-capture-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, frame, timeout=CAPTURE_PUT_TIMEOUT):
+        """Queue a frame for publishing; False (and the frame released) if the queue stayed full"""
+        self._start()
+        try:
+            self._queue.put(frame, timeout=timeout)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            log_message(f"Capture queue full, dropped {frame.material} frame for test {frame.test_id} cycle {frame.cycle}",
+                        test_id=frame.test_id, cycle=frame.cycle)
+            frame.release()
+            get_outbox().publish(IMAGE_TOPIC, json.dumps({
+                'testId': frame.test_id,
+                'cycle': frame.cycle,
+                'filename': frame.filename,
+                'material': frame.material,
+                'timestamp': datetime.now().isoformat(),
+                'dropped': True,
+                'reason': f"capture queue full for {timeout}s",
+            }), key=f"image_dropped|{frame.test_id}|{frame.cycle}|{frame.material}")
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            try:
+                self._handle(frame)
+            except Exception as e:
+                self.stats["failed"] += 1
+                log_message(f"Failed to send captured frame: {e}")
+            finally:
+                frame.release()
+                self._queue.task_done()
+
+    def _handle(self, frame):
+        raw = bytes(frame.data)  # the MQTT payload; the shared-memory segment can go after this
+        frame.release()
+        fut = self._analysis.submit(self._analyze, frame, raw)
+        self._analyzing.add(fut)
+        fut.add_done_callback(self._analyzing.discard)
+        if IMAGE_TRANSFER_MODE == "chunked":
+            # chunks are resent from the file, so this mode needs it on disk first
+            send_img_chunked(self._persist(frame, raw), test_id=frame.test_id, cycle=frame.cycle, material=frame.material)
+            self.stats["published"] += 1
+            return
+        self._remember(frame, raw)  # before publishing, so a request prompted by it finds the frame
+        publish_image_raw(raw, frame.filename, test_id=frame.test_id, cycle=frame.cycle,
+                          material=frame.material, content_type=frame.content_type)
+        self.stats["published"] += 1
+        if CAPTURE_PERSIST:
+            self._disk.submit(self._persist, frame, raw)
+
+    def _remember(self, frame, raw):
+        key = (str(frame.test_id), str(frame.cycle), frame.material)
+        with self._recent_lock:
+            self._recent[key] = (frame.filename, raw, frame.content_type)
+            self._recent.move_to_end(key)
+            while len(self._recent) > CAPTURE_RECENT_FRAMES:
+                self._recent.popitem(last=False)
+
+    def recent(self, test_id, cycle, material):
+        """(filename, original bytes, content type) of a recently captured frame, or None"""
+        with self._recent_lock:
+            return self._recent.get((str(test_id), str(cycle), material))
+
+    def _analyze(self, frame, raw):
+        """Publish the panel analysis and archive the image with its concentration"""
+        try:
+            analysis = publish_analysis(raw, frame.filename, test_id=frame.test_id, cycle=frame.cycle,
+                                        material=frame.material, content_type=frame.content_type)
+            get_archive().record_image(frame.test_id, frame.cycle, frame.material, frame.filename, len(raw),
+                                 analysis and analysis.get("concentration"))
+        except Exception as e:
+            self.stats["analysis_failed"] += 1
+            log_message(f"Failed to analyze captured frame {frame.filename}: {e}")
+            return
+        self.stats["analyzed"] += 1
+
+    def _persist(self, frame, raw):
+        """Write the frame into its capture directory (tmp + rename, so the image index sees it whole)"""
+        img_dir = image_dir(frame.material)
+        os.makedirs(img_dir, exist_ok=True)
+        path = os.path.join(img_dir, frame.filename)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp, path)
+        except OSError as e:
+            self.stats["persist_failed"] += 1
+            log_message(f"Could not save captured frame {path}: {e}")
+            raise
+        self.stats["persisted"] += 1
+        return path
+
+    def join(self):
+        """Wait until every queued frame is published, analyzed (and persisted)"""
+        self._queue.join()
+        futures_wait(list(self._analyzing))
+        self._disk.submit(lambda: None).result()
+
+    def snapshot(self):
+        return {**self.stats, "queued": self._queue.qsize()}
+
+
+capture_pipeline = CapturePipeline()
+
+
+def capture_frame(name, test_id=None, cycle=None):
+    """Hand the simulated camera's frame for an image stage to the capture pipeline"""
+    if not (SIMULATE_IMAGES and CAPTURE_MODE == "memory" and PIPELINE.get(name, {}).get("image")):
+        return
+    data = simulated_frame(name)
+    if data is None:
+        log_message(f"No sample image for {name} in {image_dir(name)}/")
+        return
+    capture_pipeline.submit(CaptureFrame(data, test_id=test_id, cycle=cycle, material=name))
+
+
+# --- pipeline definition ---
+def _build_pipeline(pipeline):
+    """
+    Validate PIPELINE and derive the per-stage views the rest of the code
+    uses: script paths, reported stage titles/numbers, per-cycle stages
+    in dependency order and each one's enabled dependencies.
+    """
+    enabled = {name for name, spec in pipeline.items() if spec.get("enabled", True)}
+
+    def deps(name, path=()):
+        out = set()
+        for dep in pipeline[name].get("after", []):
+            if dep not in pipeline:
+                raise ValueError(f"pipeline: {name} depends on unknown stage {dep}")
+            if dep in path:
+                raise ValueError(f"pipeline: dependency cycle {' -> '.join(path + (dep,))}")
+            if dep in enabled:
+                out.add(dep)
+            else:
+                out |= deps(dep, path + (dep,))
+        return out
+
+    scripts = {name: {"path": f"{RPI_TO_PARTS_PATH}/{spec['script']}",
+                      "timeout": spec.get("timeout"),
+                      "args": spec.get("args", [])}
+               for name, spec in pipeline.items() if name in enabled}
+    reported = [name for name, spec in pipeline.items() if name in enabled and spec.get("title")]
+    numbers = {name: i + 1 for i, name in enumerate(reported)}
+    per_cycle = [name for name, spec in pipeline.items() if name in enabled and spec.get("per_cycle")]
+    stage_deps = {name: deps(name, (name,)) & set(per_cycle) for name in per_cycle}
+
+    ordered = []
+    while len(ordered) < len(per_cycle):
+        ready = [n for n in per_cycle if n not in ordered and stage_deps[n] <= set(ordered)]
+        if not ready:
+            raise ValueError(f"pipeline: dependency cycle among {sorted(set(per_cycle) - set(ordered))}")
+        ordered += ready
+    return (scripts, [pipeline[n]["title"] for n in reported], numbers,
+            [(name, numbers.get(name, 0)) for name in ordered], stage_deps)
+
+
+SCRIPT_PY, PROCESS_STAGES, STAGE_NUMBERS, PER_CYCLE_STEPS, STAGE_DEPS = _build_pipeline(PIPELINE)
+
+
+def run_with_retries(name, fn, test_id=None, cycle=None):
+    """Run stage `name` through fn (run_external_py or run_external_py2) with its PIPELINE timeout/retries"""
+    spec = PIPELINE[name]
+    retries = spec.get("retries", 0)
+    for attempt in range(retries + 1):
+        try:
+            return fn(name, timeout=spec.get("timeout"), test_id=test_id, cycle=cycle)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            log_message(f"{name} failed ({e}), retry {attempt + 1}/{retries}", test_id=test_id, cycle=cycle, stage=name)
+
+
+async def run_with_retries_async(name, fn, test_id=None, cycle=None):
+    """Coroutine version of run_with_retries (fn is a coroutine function)"""
+    spec = PIPELINE[name]
+    retries = spec.get("retries", 0)
+    for attempt in range(retries + 1):
+        try:
+            return await fn(name, timeout=spec.get("timeout"), test_id=test_id, cycle=cycle)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            log_message(f"{name} failed ({e}), retry {attempt + 1}/{retries}", test_id=test_id, cycle=cycle, stage=name)
+
+
+def _ready_stages(todo, done, slots):
+    return [name for name in todo if STAGE_DEPS[name] <= done][:max(0, slots)]
+
+
+def run_cycle_stages(run_one, skip=()):
+    """
+    Run one cycle's stages, calling run_one(name) for each once its
+    dependencies are done. Independent stages run concurrently on up to
+    PIPELINE_MAX_PARALLEL threads. `skip` = stages already done (resume).
+    A failing stage lets the running ones finish, then raises.
+    """
+    done = set(skip)
+    todo = [name for name, _ in PER_CYCLE_STEPS if name not in done]
+    if PIPELINE_MAX_PARALLEL <= 1:
+        for name in todo:
+            run_one(name)
+        return
+    running = {}
+    with ThreadPoolExecutor(max_workers=PIPELINE_MAX_PARALLEL, thread_name_prefix="ur2-stage") as pool:
+        while todo or running:
+            for name in _ready_stages(todo, done, PIPELINE_MAX_PARALLEL - len(running)):
+                todo.remove(name)
+                running[pool.submit(run_one, name)] = name
+            finished, _ = futures_wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                done.add(running.pop(fut))
+                fut.result()
+
+
+async def run_cycle_stages_async(run_one, skip=()):
+    """Coroutine version of run_cycle_stages (run_one is a coroutine function)"""
+    done = set(skip)
+    todo = [name for name, _ in PER_CYCLE_STEPS if name not in done]
+    running = {}
+    try:
+        while todo or running:
+            for name in _ready_stages(todo, done, PIPELINE_MAX_PARALLEL - len(running)):
+                todo.remove(name)
+                running[asyncio.ensure_future(run_one(name))] = name
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            errors = []
+            for task in finished:  # retrieve every outcome, not just the first failure
+                done.add(running.pop(task))
+                if task.exception() is not None:
+                    errors.append(task.exception())
+            if errors:
+                raise errors[0]
+    except asyncio.CancelledError:
+        for task in running:
+            task.cancel()
+        raise
+    except Exception:
+        if running:
+            await asyncio.wait(running)
+            for task in running:
+                if not task.cancelled():
+                    task.exception()  # already failing, but mark it retrieved
+        raise
+
+
+# --- helper to run python scripts ---
+@instrumented("stage", _stage_labels)
+def run_external_py(name: str, timeout=None, test_id=None, cycle=None):
+    print("#"*30)
+    time.sleep(SIMULATED_SCRIPT_SECONDS)  # Simulate script execution time
+    print(f"Simulating {name} script...")
+    print("#"*30)
+    capture_frame(name, test_id=test_id, cycle=cycle)
+
+
+## deployment code
+class StageResult:
+    """Outcome of one external stage script, with bounded output tails"""
+
+    def __init__(self, name, tail_lines):
+        self.name = name
+        self.returncode = None
+        self.duration = 0.0
+        self.stdout = collections.deque(maxlen=tail_lines)
+        self.stderr = collections.deque(maxlen=tail_lines)
+
+
+async def _pump_stream(reader, tail, name, stream, test_id, cycle):
+    """Read a child pipe line by line into a ring buffer, forwarding progress"""
+    while True:
+        try:
+            raw = await reader.readline()
+        except ValueError:
+            # line longer than the reader limit, the buffer was dropped
+            raw = b"[line too long, truncated]\n"
+        if not raw:
+            break
+        line = raw.decode(errors="replace").rstrip()[:STAGE_LINE_MAX_CHARS]
+        if not line:
+            continue
+        tail.append(line)
+        if test_id is not None:
+            get_outbox().publish(PROGRESS_TOPIC, json.dumps({
+                "testId": test_id,
+                "cycle": cycle,
+                "stage_name": name,
+                "stream": stream,
+                "line": line,
+                "timestamp": now_iso(),
+            }), durable=False)
+
+
+async def run_stage_async(name: str, timeout=None, test_id=None, cycle=None):
+    """
+    Launch SCRIPT_PY[name] without blocking the caller's event loop.
+    stdout/stderr are streamed into ring buffers of STAGE_OUTPUT_TAIL_LINES
+    and forwarded to PROGRESS_TOPIC while the script runs. The timeout is
+    enforced by waiting on the process, never by polling. Image stages get
+    a FrameSlot in memory capture mode; the frame they leave there goes to
+    capture_pipeline when the script succeeds.
+    """
+    cfg = SCRIPT_PY[name]
+    args = cfg.get("args", [])
+    cmd = [PYTHON_BIN, cfg["path"], *args]
+    actual_timeout = timeout if timeout is not None else cfg.get("timeout")
+    result = StageResult(name, STAGE_OUTPUT_TAIL_LINES)
+    slot = FrameSlot() if CAPTURE_MODE == "memory" and PIPELINE[name].get("image") else None
+    try:
+        await _run_stage_process(name, cmd, actual_timeout, result, test_id, cycle,
+                                 env={**os.environ, **slot.env} if slot else None)
+    except BaseException:
+        if slot:
+            slot.close()
+        raise
+    if slot:
+        frame = slot.take(test_id=test_id, cycle=cycle, material=name) if result.returncode == 0 else None
+        if frame is None:
+            slot.close()
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, capture_pipeline.submit, frame)
+    return result
+
+
+async def _run_stage_process(name, cmd, actual_timeout, result, test_id, cycle, env=None):
+    log_message(f"{name}: launching -> {cmd}")
+    t0 = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env,
+    )
+    pumps = asyncio.gather(
+        _pump_stream(proc.stdout, result.stdout, name, "stdout", test_id, cycle),
+        _pump_stream(proc.stderr, result.stderr, name, "stderr", test_id, cycle),
+    )
+    try:
+        await asyncio.wait_for(proc.wait(), actual_timeout)
+    except asyncio.TimeoutError:
+        log_message(f"{name}: TIMEOUT after {actual_timeout}s, terminating")
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 10)
+        except asyncio.TimeoutError:
+            log_message(f"{name}: killing")
+            proc.kill()
+            await proc.wait()
+        await pumps
+        raise subprocess.TimeoutExpired(cmd, actual_timeout, output="\n".join(result.stdout),
+                                        stderr="\n".join(result.stderr))
+    await pumps
+    result.returncode = proc.returncode
+    result.duration = time.monotonic() - t0
+
+
+def run_stage(name: str, timeout=None, test_id=None, cycle=None):
+    """Blocking wrapper around run_stage_async for thread-per-test callers"""
+    coro = run_stage_async(name, timeout=timeout, test_id=test_id, cycle=cycle)
+    if orchestrator is not None:
+        return asyncio.run_coroutine_threadsafe(coro, orchestrator.loop).result()
+    return asyncio.run(coro)
+
+
+def _check_stage_result(res):
+    if res.stdout:
+        log_message(f"{res.name} stdout (last {len(res.stdout)} lines):\n" + "\n".join(res.stdout))
+    if res.stderr:
+        log_message(f"{res.name} stderr (last {len(res.stderr)} lines):\n" + "\n".join(res.stderr))
+
+    if res.returncode != 0:
+        raise RuntimeError(f"{res.name} failed with code {res.returncode}")
+
+    log_message(f"{res.name}: finished successfully (code 0) in {res.duration:.1f}s")
+
+
+@instrumented("stage", _stage_labels)
+def run_external_py2(name: str, timeout=None, test_id=None, cycle=None):
+    """Run the real script for a stage (swap in for run_external_py on the Pi)"""
+    try:
+        res = run_stage(name, timeout=timeout, test_id=test_id, cycle=cycle)
+    except FileNotFoundError:
+        log_message(f"{name}: file not found -> {SCRIPT_PY[name]['path']}")
+        raise
+    _check_stage_result(res)
+
+
+@instrumented("stage", _stage_labels)
+async def run_external_py2_async(name: str, timeout=None, test_id=None, cycle=None):
+    """Coroutine version of run_external_py2 for the asyncio orchestrator"""
+    try:
+        res = await run_stage_async(name, timeout=timeout, test_id=test_id, cycle=cycle)
+    except FileNotFoundError:
+        log_message(f"{name}: file not found -> {SCRIPT_PY[name]['path']}")
+        raise
+    _check_stage_result(res)
+
+
+
+# --- heat controller ---
+def _load_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+
+class ThermalModel:
+    """
+    State of many simulated heaters as parallel arrays (NumPy when
+    installed, plain lists otherwise), advanced together by step().
+    Slots are dense: remove() moves the last heater into the freed slot.
+    """
+
+    def __init__(self, params=None, capacity=16):
+        self.params = dict(HEAT_PARAMS, **(params or {}))
+        self.np = _load_numpy()
+        self.n = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        old = (self.temp[:self.n], self.setpoint[:self.n], self.power[:self.n]) if self.n else None
+        if self.np is not None:
+            self.temp, self.setpoint, self.power = (self.np.zeros(capacity) for _ in range(3))
+        else:
+            self.temp, self.setpoint, self.power = ([0.0] * capacity for _ in range(3))
+        if old:
+            for arr, values in zip((self.temp, self.setpoint, self.power), old):
+                arr[:self.n] = values
+        self.capacity = capacity
+
+    def add(self, setpoint, temp=None):
+        if self.n == self.capacity:
+            self._alloc(self.capacity * 2)
+        slot = self.n
+        self.temp[slot] = self.params["ambient_c"] if temp is None else temp
+        self.setpoint[slot] = setpoint
+        self.power[slot] = 0.0
+        self.n += 1
+        return slot
+
+    def remove(self, slot):
+        """Free a slot; returns the old index of the heater moved into it (or None)"""
+        last = self.n - 1
+        self.n -= 1
+        if slot == last:
+            return None
+        for arr in (self.temp, self.setpoint, self.power):
+            arr[slot] = arr[last]
+        return last
+
+    def step(self, dt):
+        p = self.params
+        n = self.n
+        if n == 0:
+            return
+        steps = max(1, int(math.ceil(dt / HEAT_MAX_STEP_SECONDS)))
+        h = dt / steps / p["capacity_j_per_k"]
+        if self.np is not None:
+            temp, setpoint = self.temp[:n], self.setpoint[:n]
+            for _ in range(steps):
+                u = self.np.clip((setpoint - temp) * p["gain_per_k"], 0.0, 1.0)
+                temp += (u * p["max_power_w"] - p["loss_w_per_k"] * (temp - p["ambient_c"])) * h
+            self.power[:n] = u
+            return
+        for i in range(n):
+            t = self.temp[i]
+            for _ in range(steps):
+                u = min(1.0, max(0.0, (self.setpoint[i] - t) * p["gain_per_k"]))
+                t += (u * p["max_power_w"] - p["loss_w_per_k"] * (t - p["ambient_c"])) * h
+            self.temp[i] = t
+            self.power[i] = u
+
+
+class Heater:
+    """One test's heater inside the HeatController"""
+
+    __slots__ = ("name", "setpoint", "slot", "started_at", "next_sample", "proc", "kill_at", "failed")
+
+    def __init__(self, name, setpoint):
+        self.name = name
+        self.setpoint = setpoint
+        self.slot = None      # index in the ThermalModel (simulated heaters)
+        self.started_at = time.monotonic()
+        self.next_sample = 0.0
+        self.proc = None      # ur2_heat.py subprocess (HEAT_BACKEND = "script")
+        self.kill_at = None
+        self.failed = False
+
+
+class HeatController:
+    """
+    Runs every active heater from a single scheduler thread.
+    "simulated" heaters live in one ThermalModel stepped each tick and
+    publish decimated telemetry on HEAT_TELEMETRY_TOPIC; "script" heaters
+    each get the real ur2_heat.py in a subprocess, which the same loop
+    watches and reaps. stop() takes effect immediately, nothing joins.
+    """
+
+    def __init__(self, tick=HEAT_TICK_SECONDS, time_scale=None, params=None):
+        self.tick = tick
+        self.time_scale = HEAT_TIME_SCALE if time_scale is None else time_scale
+        self.model = ThermalModel(params)
+        self.sim_time = 0.0
+        self._cond = threading.Condition()
+        self._heaters = []
+        self._by_slot = []    # model slot -> Heater
+        self._reaping = []    # stopped script heaters waiting to exit
+        self._thread = None
+
+    def start(self, name, setpoint=None):
+        heater = Heater(name, HEAT_SETPOINT_C if setpoint is None else setpoint)
+        if HEAT_BACKEND == "script":
+            heater.proc = subprocess.Popen([PYTHON_BIN, SCRIPT_PY["heat"]["path"]])
+        with self._cond:
+            if heater.proc is None:
+                heater.slot = self.model.add(heater.setpoint)
+                self._by_slot.append(heater)
+                heater.next_sample = self.sim_time
+            self._heaters.append(heater)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ur2-heat", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        log_message(f"heat[{name}]: on, setpoint {heater.setpoint:.1f}C ({HEAT_BACKEND})")
+        return heater
+
+    def set_setpoint(self, heater, setpoint):
+        with self._cond:
+            heater.setpoint = setpoint
+            if heater.slot is not None:
+                self.model.setpoint[heater.slot] = setpoint
+
+    def temperature(self, heater):
+        with self._cond:
+            return None if heater.slot is None else float(self.model.temp[heater.slot])
+
+    def _release_slot(self, heater):
+        moved = self.model.remove(heater.slot)
+        self._by_slot[heater.slot] = self._by_slot[-1]
+        self._by_slot.pop()
+        if moved is not None:
+            self._by_slot[heater.slot].slot = heater.slot
+        heater.slot = None
 
+    def stop(self, heater):
+        """Turn a heater off; safe to call more than once"""
+        with self._cond:
+            if heater not in self._heaters:
+                return
+            self._heaters.remove(heater)
+            if heater.slot is not None:
+                self._release_slot(heater)
+            if heater.proc is not None and heater.proc.poll() is None:
+                heater.proc.terminate()
+                heater.kill_at = time.monotonic() + 10
+                self._reaping.append(heater)
+            self._cond.notify()
+        log_message(f"heat[{heater.name}]: off after {time.monotonic() - heater.started_at:.0f}s")
 
-# MQTT Configuration
-# prod URL
-# BROKER = "04e8fe793a8947ad8eda947204522088.s1.eu.hivemq.cloud"
-# testing url
-BROKER = "69fd2157960d4f39950410b17ba9d85c.s1.eu.hivemq.cloud"
-PORT = 8883
-USERNAME = "ur2gglab"
-PASSWORD = "Ur2gglab"
+    def active(self):
+        with self._cond:
+            return len(self._heaters)
 
+    def _step(self):
+        """Advance the model; returns due telemetry samples and script heaters to poll"""
+        dt = self.tick * self.time_scale
+        self.model.step(dt)
+        self.sim_time += dt
+        samples = []
+        for heater in self._by_slot:
+            if self.sim_time >= heater.next_sample:
+                samples.append((heater.name, float(self.model.temp[heater.slot]),
+                                heater.setpoint, float(self.model.power[heater.slot])))
+                heater.next_sample = self.sim_time + HEAT_TELEMETRY_SECONDS  # a tick may span several
+        return samples, [h for h in self._heaters if h.proc is not None]
 
-# Topics
-TEST_PUB_TOPIC = 'ur2/test/init'  # Listen for commands from frontend
-TEST_SUB_TOPIC = 'ur2/test/stage'  # Send responses to frontend
-CONFIRMATION_TOPIC = 'ur2/test/confirm'  # Handle user confirmations
-IMAGE_TOPIC = 'ur2/test/image'  # New topic for sending images
+    def _publish(self, samples):
+        for name, temp_c, setpoint_c, power in samples:
+            log_message(f"heat[{name}]: temp={temp_c:.1f}C target={setpoint_c:.1f}C")
+            if client is not None:
+                get_outbox().publish(HEAT_TELEMETRY_TOPIC, json.dumps({
+                    "testId": name,
+                    "temp_c": round(temp_c, 2),
+                    "setpoint_c": setpoint_c,
+                    "power": round(power, 3),
+                    "sim_time_s": round(self.sim_time, 1),
+                    "timestamp": now_iso(),
+                }), durable=False)
 
-# Test Stages (5 stages workflow)
-PROCESS_STAGES = [
-    'Sample Preparation',
-    'Dissolution',
-    'Filtration & Dilution',
-    # 'Color Agent Addition',
-    # "Image Capture"
-    'Aluminum Concentration Analysis',
-    'Silicon Concentration Analysis'
-]
+    def _poll_scripts(self, scripts):
+        for heater in scripts:
+            if heater.proc.poll() is not None:
+                log_message(f"heat[{heater.name}]: process exited unexpectedly!")
+                heater.failed = True
+                with self._cond:
+                    if heater in self._heaters:
+                        self._heaters.remove(heater)
 
-# Global variables
-client = None
-active_tests = {}
-user_confirmations = {}  # Store user confirmation responses
+    def _reap(self, now):
+        for heater in list(self._reaping):
+            if heater.proc.poll() is not None:
+                self._reaping.remove(heater)
+            elif now >= heater.kill_at:
+                log_message(f"heat[{heater.name}]: killing heat process...")
+                heater.proc.kill()
+                self._reaping.remove(heater)
 
-###################################
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heaters and not self._reaping:
+                    self._cond.wait()
+                samples, scripts = self._step()
+            self._publish(samples)
+            self._poll_scripts(scripts)
+            with self._cond:
+                self._reap(time.monotonic())
+                self._cond.wait(self.tick)
 
 
-def log_message(message):
-    """Print timestamped log message"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
+def replay_heat_profiles(profiles, dt=1.0, sample_every=60.0, params=None):
+    """
+    Run setpoint profiles through the thermal model as fast as possible.
+    profiles: one list of (duration_s, setpoint_c) segments per heater.
+    Returns {"t": [...], "temp": [[temp per heater] per sample]}.
+    """
+    model = ThermalModel(params, capacity=max(1, len(profiles)))
+    changes = []  # (time, heater index, setpoint)
+    for i, profile in enumerate(profiles):
+        model.add(profile[0][1] if profile else model.params["ambient_c"])
+        t = 0.0
+        for duration, setpoint in profile:
+            changes.append((t, i, setpoint))
+            t += duration
+    changes.sort()
+    end = max((sum(d for d, _ in profile) for profile in profiles), default=0.0)
 
+    out = {"t": [], "temp": []}
+    t = 0.0
+    next_change = 0
+    next_sample = 0.0
+    while t <= end:
+        while next_change < len(changes) and changes[next_change][0] <= t:
+            _, i, setpoint = changes[next_change]
+            model.setpoint[i] = setpoint
+            next_change += 1
+        if t >= next_sample:
+            out["t"].append(t)
+            out["temp"].append([float(x) for x in model.temp[:model.n]])
+            next_sample += sample_every
+        model.step(dt)
+        t += dt
+    return out
 
-def now_iso():
-    return datetime.now().isoformat()
 
-def pub(test_id, **fields):
-    payload = {"testId": test_id, "timestamp": now_iso(), **fields}
-    client.publish(TEST_SUB_TOPIC, json.dumps(payload))
+heat_controller = HeatController()
 
-def send_img_to_web(test_id=None, cycle=None, material=None):
-    """Send image over MQTT after script 3."""
-    try:
-        import os
-        import glob
-        
-        # Determine the image directory based on material
-        if material == 'aluminum':
-            img_dir = 'test_img/al'
-        elif material == 'silicon':
-            img_dir = 'test_img/si'
-        else:
-            # Fallback to general test_img directory
-            img_dir = 'test_img'
-        
-        # Find all files in the directory, sort by modified time descending
-        img_files = glob.glob(os.path.join(img_dir, '*'))
-        if not img_files:
-            log_message(f'No image files found in {img_dir}/')
+
+def start_heat(test_id=None, setpoint=None):
+    heater = heat_controller.start(test_id or "heat", setpoint)
+    log_message("Heat process started in background.")
+    return heater
+
+def stop_heat(heater):
+    if heater:
+        heat_controller.stop(heater)
+
+
+
+# --- shared instruments ---
+class ResourceRequest:
+    """One stage of one test asking for its instruments"""
+
+    __slots__ = ("test_id", "stage", "needs", "enqueued_at", "granted_at", "bypassed",
+                 "position", "cancelled", "event", "_callbacks")
+
+    def __init__(self, test_id, stage, needs):
+        self.test_id = test_id
+        self.stage = stage
+        self.needs = needs
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.bypassed = 0     # later requests served first
+        self.position = 0     # 1-based place in the queue while waiting
+        self.cancelled = False
+        self.event = threading.Event()
+        self._callbacks = []
+
+    def add_callback(self, fn):
+        self._callbacks.append(fn)
+        if self.event.is_set():
+            fn()
+
+    def _wake(self):
+        self.event.set()
+        for fn in list(self._callbacks):
+            fn()
+
+
+class ResourceScheduler:
+    """
+    The Pi's instruments (RESOURCES: name -> units) shared by every test.
+    A stage gets all the resources PIPELINE lists for it at once or waits,
+    so stages of different tests can't deadlock each other. Waiters are
+    served in FIFO order, except that a later request whose resources are
+    free may go ahead (the camera keeps working while the pumps are busy)
+    until the request it passes has been bypassed RESOURCE_MAX_BYPASS times.
+    Stages of one test share the units that test already holds (aluminum
+    and silicon read the same panel through the one camera), so a test
+    never queues behind its own parallel stages.
+    """
+
+    def __init__(self, capacities=None, notify=None):
+        self.capacities = dict(RESOURCES if capacities is None else capacities)
+        self.in_use = collections.Counter()
+        self._held = collections.Counter()  # (resource, test_id) -> stages of that test using its unit
+        self._queue = []
+        self._lock = threading.Lock()
+        self._notify = notify  # fn(request, busy resources) on queue position changes and late grants
+        self.stats = collections.Counter()
+
+    def _free(self, req, r):
+        return self._held[(r, req.test_id)] > 0 or self.in_use[r] < self.capacities.get(r, 1)
+
+    def _fits(self, req):
+        return all(self._free(req, r) for r in req.needs)
+
+    def _dispatch(self):
+        """Grant what fits; returns (granted, requests whose queue position changed)"""
+        granted = []
+        waiting = []
+        reserved = set()  # resources held back for a request that was passed too often
+        for req in self._queue:
+            if not reserved.intersection(req.needs) and self._fits(req):
+                for r in req.needs:
+                    if not self._held[(r, req.test_id)]:
+                        self.in_use[r] += 1
+                    self._held[(r, req.test_id)] += 1
+                req.granted_at = time.monotonic()
+                granted.append(req)
+                for earlier in waiting:
+                    if set(earlier.needs) & set(req.needs):
+                        earlier.bypassed += 1
+                        self.stats["bypasses"] += 1
+            else:
+                waiting.append(req)
+                if req.bypassed >= RESOURCE_MAX_BYPASS:
+                    reserved.update(req.needs)
+        self._queue = waiting
+        moved = []
+        for pos, req in enumerate(self._queue, 1):
+            if req.position != pos:
+                req.position = pos
+                moved.append(req)
+        return granted, moved
+
+    def _after(self, granted, moved):
+        for req in granted:
+            waited = req.granted_at - req.enqueued_at
+            for r in req.needs:
+                metrics.observe("ur2_resource_wait_seconds", waited, help="Time stages waited for an instrument", resource=r)
+            self.stats["granted"] += 1
+            if req.position:  # had to queue, tell the frontend it is running again
+                self.stats["queued"] += 1
+                req.position = 0
+                if self._notify:
+                    self._notify(req, [])
+            req._wake()
+        for req in moved:
+            if self._notify:
+                self._notify(req, [r for r in req.needs if not self._free(req, r)])
+
+    def request(self, test_id, stage, needs):
+        req = ResourceRequest(test_id, stage, tuple(needs))
+        with self._lock:
+            self._queue.append(req)
+            granted, moved = self._dispatch()
+        self._after(granted, moved)
+        return req
+
+    def acquire(self, test_id, stage):
+        """Block until the stage's resources are free; None if the test was stopped meanwhile"""
+        needs = PIPELINE.get(stage, {}).get("resources", [])
+        if active_tests.get(test_id) is None:
+            return None
+        req = self.request(test_id, stage, needs)
+        req.event.wait()
+        return None if req.cancelled else req
+
+    async def acquire_async(self, test_id, stage):
+        """Same as acquire() but suspends the coroutine instead of a thread"""
+        needs = PIPELINE.get(stage, {}).get("resources", [])
+        if active_tests.get(test_id) is None:
+            return None
+        req = self.request(test_id, stage, needs)
+        if not req.event.is_set():
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            req.add_callback(lambda: loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None)))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                self._withdraw(req)
+                raise
+        return None if req.cancelled else req
+
+    def _withdraw(self, req):
+        """Task cancelled while queued: leave the queue, or hand back a grant nobody will use"""
+        with self._lock:
+            queued = req in self._queue
+            if queued:
+                self._queue.remove(req)
+                req.cancelled = True
+        if not queued:
+            self.release(req)
+
+    def release(self, req):
+        if req is None or req.cancelled:
             return
-        latest_img = max(img_files, key=os.path.getmtime)
-        with open(latest_img, 'rb') as img_file:
-            img_bytes = img_file.read()
-        filename = os.path.basename(latest_img)
-        # Send metadata first
-        image_metadata = {
-            'testId': test_id,
-            'cycle': cycle,
-            'filename': filename,
-            'size': len(img_bytes),
-            'material': material,
-            'timestamp': datetime.now().isoformat()
-        }
-        client.publish(IMAGE_TOPIC, json.dumps(image_metadata))
-        client.publish(IMAGE_TOPIC + '/raw', img_bytes)  # Send raw bytes to a subtopic
-        log_message(f"Image bytes sent over MQTT for test {test_id}, cycle {cycle}, file {filename}, material {material}")
-    except Exception as e:
-        log_message(f"Failed to send image: {e}")
+        with self._lock:
+            for r in req.needs:
+                key = (r, req.test_id)
+                self._held[key] -= 1
+                if not self._held[key]:
+                    del self._held[key]
+                    self.in_use[r] -= 1
+            granted, moved = self._dispatch()
+        self._after(granted, moved)
 
+    def cancel(self, test_id):
+        """Drop a stopped test's queued requests (their acquire returns None)"""
+        with self._lock:
+            dropped = [req for req in self._queue if req.test_id == test_id]
+            for req in dropped:
+                self._queue.remove(req)
+            granted, moved = self._dispatch()
+        for req in dropped:
+            req.cancelled = True
+            req._wake()
+        self._after(granted, moved)
+        return len(dropped)
 
-# --- helper to run python scripts ---
-def run_external_py(name: str, timeout=None):
-    print("#"*30)
-    time.sleep(3)  # Simulate script execution time
-    print(f"Simulating {name} script...")
-    print("#"*30)
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {
+                    "capacity": cap,
+                    "in_use": self.in_use[name],
+                    "queued": sum(name in req.needs for req in self._queue),
+                }
+                for name, cap in self.capacities.items()
+            }
 
 
-## deployment code
-# def run_external_py2(name: str, timeout=None):
-#     cfg = SCRIPT_PY[name]
-#     args = cfg.get("args", [])
-#     cmd = [PYTHON_BIN, cfg["path"], *args]
-#     actual_timeout = timeout if timeout is not None else cfg.get("timeout")
-
-#     log_message(f"{name}: launching -> {cmd}")
-#     try:
-#         res = subprocess.run(
-#             cmd,
-#             capture_output=True,
-#             text=True,
-#             timeout=actual_timeout,
-#             check=False,
-#         )
-#     except subprocess.TimeoutExpired:
-#         log_message(f"{name}: TIMEOUT after {actual_timeout}s")
-#         raise
-#     except FileNotFoundError:
-#         log_message(f"{name}: file not found -> {cfg['path']}")
-#         raise
-
-#     if res.stdout:
-#         log_message(f"{name} stdout:\n{res.stdout.strip()[-300:]}")
-#     if res.stderr:
-#         log_message(f"{name} stderr:\n{res.stderr.strip()[-300:]}")
-
-#     if res.returncode != 0:
-#         raise RuntimeError(f"{name} failed with code {res.returncode}")
-
-#     log_message(f"{name}: finished successfully (code 0)")
-
-
-
-#debug code
-import threading, time, math
-
-def _simulated_heat_process(run_event):
-    """
-    Fake long-running heater loop.
-    Replace the internals with your real control logic later.
-    Must exit promptly when run_event.clear() is called.
-    """
-    log_message("heat[sim]: process started")
-    try:
-        target_c = 60.0
-        temp_c   = 22.0
-        t0 = time.time()
-        while run_event.is_set():
-            # toy thermal model: temp moves toward target
-            temp_c += (target_c - temp_c) * 0.08
-            # log every ~5s
-            if int(time.time() - t0) % 5 == 0:
-                log_message(f"heat[sim]: temp={temp_c:.1f}C target={target_c:.1f}C")
-            time.sleep(0.25)  # keep the loop responsive and low-CPU
-    finally:
-        log_message("heat[sim]: process exiting (heater off)")
+def _publish_queue_position(req, busy):
+    """Queued/position updates for the frontend, and "running" once a queued stage starts"""
+    record = active_tests.get(req.test_id)
+    if record is None:
+        return
+    if req.position:
+        pub(req.test_id,
+            run_status="queued",
+            run_stage=record.stage,
+            cycle=record.cycle,
+            queue_position=req.position,
+            waiting_for=busy,
+            message=f"{req.stage} waiting for {', '.join(busy) or 'instruments'} (position {req.position})")
+    else:
+        pub(req.test_id,
+            run_status="running",
+            run_stage=record.stage,
+            cycle=record.cycle,
+            message=f"{req.stage} started after {req.granted_at - req.enqueued_at:.0f}s in queue")
+
+
+resource_scheduler = ResourceScheduler(notify=_publish_queue_position)
+
+
+class PendingConfirmation:
+    """One test waiting for the user to confirm a cycle"""
+
+    def __init__(self, test_id, cycle):
+        self.test_id = test_id
+        self.cycle = cycle
+        self.requested_at = time.monotonic()
+        self.response = None
+        self.cancelled = False
+        self.event = threading.Event()
+        self._callbacks = []
+
+    def add_callback(self, fn):
+        """Call fn() once the entry is resolved or cancelled (maybe right away)"""
+        self._callbacks.append(fn)
+        if self.event.is_set():
+            fn()
+
+    def _wake(self):
+        self.event.set()
+        for fn in list(self._callbacks):
+            fn()
 
-def heat_worker(stop_event):
+
+class ConfirmationRegistry:
     """
-    Start a simulated long-running 'heat' process and keep it alive until:
-      - stop_event is set  (normal shutdown), or
-      - the simulated process dies unexpectedly (error path).
+    Pending user confirmations keyed by (test_id, cycle).
+    on_message resolves the exact waiter as soon as the answer arrives,
+    a "stop" command cancels it.
     """
-    # internal event the simulated process uses to decide whether to keep running
-    run_event = threading.Event()
-    run_event.set()
 
-    try:
-        log_message("heat: starting simulated background heat process")
-        th = threading.Thread(target=_simulated_heat_process, args=(run_event,), daemon=True)
-        th.start()
-
-        # monitor loop (mirrors your subprocess .poll() check)
-        while not stop_event.is_set():
-            if not th.is_alive():
-                log_message("heat: simulated process exited unexpectedly!")
-                break
-            time.sleep(1)
+    def __init__(self, max_samples=1000):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.latencies = collections.deque(maxlen=max_samples)  # round-trip seconds
 
-        # request the simulated "process" to stop
-        if th.is_alive():
-            log_message("heat: requesting simulated heat process to stop...")
-            run_event.clear()
-            th.join(timeout=10)
+    def open(self, test_id, cycle):
+        entry = PendingConfirmation(test_id, cycle)
+        with self._lock:
+            self._pending[(test_id, cycle)] = entry
+        return entry
 
-            if th.is_alive():
-                # Can't force-kill threads; ensure your loop respects run_event to exit promptly.
-                log_message("heat: simulated heat process didn't stop in time (still alive).")
+    def _find(self, test_id, cycle):
+        if cycle is not None:
+            return self._pending.get((test_id, cycle))
+        # frontend does not send the cycle, so take the oldest waiter for the test
+        waiting = [e for (tid, _), e in self._pending.items() if tid == test_id]
+        return min(waiting, key=lambda e: e.requested_at) if waiting else None
 
-        log_message("heat: background heat process stopped")
+    def resolve(self, test_id, confirmed, cycle=None):
+        """Deliver a user answer. Returns False if nobody was waiting for it."""
+        with self._lock:
+            entry = self._find(test_id, cycle)
+            if entry is None:
+                return False
+            del self._pending[(entry.test_id, entry.cycle)]
+            entry.response = bool(confirmed)
+            self.latencies.append(time.monotonic() - entry.requested_at)
+        entry._wake()
+        return True
 
-    except Exception as e:
-        log_message(f"heat: error in heat_worker: {e}")
-
-# deployment Code
-# --- Heat script as background process ---
-# def heat_worker_original(stop_event):
-#     try:
-#         log_message("heat: starting background heat script")
-#         proc = subprocess.Popen([PYTHON_BIN, SCRIPT_PY["heat"]["path"]])
-#         while not stop_event.is_set():
-#             if proc.poll() is not None:
-#                 log_message("heat: process exited unexpectedly!")
-#                 break
-#             time.sleep(1)
-#         if proc.poll() is None:
-#             log_message("heat: terminating heat process...")
-#             proc.terminate()
-#             try:
-#                 proc.wait(timeout=10)
-#             except subprocess.TimeoutExpired:
-#                 log_message("heat: killing heat process...")
-#                 proc.kill()
-#         log_message("heat: background heat script stopped")
-#     except Exception as e:
-#         log_message(f"heat: error in heat_worker: {e}")
-
-
-def start_heat():
-    ev = multiprocessing.Event()
-    proc = multiprocessing.Process(target=heat_worker, args=(ev,))
-    proc.start()
-    log_message("Heat process started in background.")
-    return ev, proc
+    def cancel(self, test_id):
+        """Wake every waiter of a test with a negative answer (test stopped)"""
+        with self._lock:
+            keys = [k for k in self._pending if k[0] == test_id]
+            entries = [self._pending.pop(k) for k in keys]
+        for entry in entries:
+            entry.cancelled = True
+            entry.response = False
+            entry._wake()
+        return len(entries)
 
-def stop_heat(ev, proc, timeout=20):
-    try:
-        if ev: ev.set()
-        if proc: proc.join(timeout=timeout)
-    finally:
-        log_message("Heat process stopped.")
+    def discard(self, entry):
+        with self._lock:
+            if self._pending.get((entry.test_id, entry.cycle)) is entry:
+                del self._pending[(entry.test_id, entry.cycle)]
+
+    def wait(self, entry, timeout=None):
+        """Block until resolved/cancelled. Returns the response or None on timeout."""
+        if not entry.event.wait(timeout):
+            self.discard(entry)
+            return None
+        return entry.response
 
+    async def wait_async(self, entry, timeout=None):
+        """Same as wait() but suspends the coroutine instead of a thread"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
 
+        def _set():
+            if not fut.done():
+                fut.set_result(None)
 
-def wait_for_user_confirmation(test_id, cycle_number):
+        def _wake():
+            try:
+                loop.call_soon_threadsafe(_set)
+            except RuntimeError:
+                pass  # loop already closed
+
+        entry.add_callback(_wake)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self.discard(entry)
+            return None
+        return entry.response
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def latency_stats(self):
+        """Confirmation round-trip latency summary in seconds"""
+        with self._lock:
+            last = self.latencies[-1] if self.latencies else None
+            samples = sorted(self.latencies)
+        if not samples:
+            return {"count": 0}
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        return {
+            "count": len(samples),
+            "last": last,
+            "avg": sum(samples) / len(samples),
+            "p50": pick(0.50),
+            "p95": pick(0.95),
+            "max": samples[-1],
+        }
+
+
+confirmations = ConfirmationRegistry()
+
+
+@instrumented("confirmation_wait", _confirm_labels)
+def wait_for_user_confirmation(test_id, cycle_number, timeout=CONFIRMATION_TIMEOUT):
     """Send confirmation request to frontend and wait for response"""
-    log_message(f"Test {test_id}: Requesting user confirmation after cycle {cycle_number}/5...")
+    log_message(f"Test {test_id}: Requesting user confirmation after cycle {cycle_number}/5...", test_id=test_id, cycle=cycle_number)
 
     conf_msg = f"Cycle {cycle_number}/5 completed"
-    
+
+    # register before publishing so a fast answer can't be missed
+    entry = confirmations.open(test_id, cycle_number)
+    record = active_tests.get(test_id)
+    if record is None:
+        # Test was stopped before we started waiting
+        confirmations.discard(entry)
+        return False
+
     pub(test_id, 
         run_status="waiting_confirmation", 
         message=conf_msg, 
         cycle=cycle_number)
-    
-    # Wait for user response indefinitely
-    confirmation_key = f"{test_id}_confirmation"
-    user_confirmations[confirmation_key] = None
-    
-    # Wait indefinitely for user response
-    while user_confirmations.get(confirmation_key) is None:
-        if test_id not in active_tests:
-            # Test was stopped, clean up and return False
-            if confirmation_key in user_confirmations:
-                del user_confirmations[confirmation_key]
-            return False
-        time.sleep(0.5)  # Check every 500ms
-    
-    response = user_confirmations[confirmation_key]
-    del user_confirmations[confirmation_key]  # Clean up
-    log_message(f"Test {test_id}: User {'confirmed' if response else 'declined'} to continue after cycle {cycle_number}")
+    journal.waiting(test_id, cycle_number, run=record.run_id)
+
+    response = confirmations.wait(entry, timeout)
+    if response is None:
+        log_message(f"Test {test_id}: No user confirmation within {timeout}s after cycle {cycle_number}", test_id=test_id, cycle=cycle_number)
+        return False
+    if entry.cancelled:
+        return False
+
+    log_message(f"Test {test_id}: User {'confirmed' if response else 'declined'} to continue after cycle {cycle_number}", test_id=test_id, cycle=cycle_number)
+    if response:
+        journal.confirmed(test_id, cycle_number, run=record.run_id)
     return response
 
 
 
-def simulate_test_process(test_id: str, max_cycles: int = 5):
+# --- checkpoint journal ---
+class TestJournal:
+    """
+    Append-only JSON-lines log of test starts, finished stages,
+    confirmation requests/answers and test ends. Folding it gives the
+    state of every test that never ended, which resume_tests() restarts.
+    Events carry the run id of the TestRecord that wrote them; events of
+    an older run of the same test id (a stopped test's thread finishing
+    its stage) are ignored.
+    The file is rewritten as one snapshot line per live test once it
+    grows past CHECKPOINT_COMPACT_BYTES.
+    """
+
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._states = {}  # test_id -> {"run", "max_cycles", "done", "confirmed", "waiting", "last"}
+        self._file = None
+        self._size = 0
+        self._frozen = False
+
+    @staticmethod
+    def _apply(states, entry):
+        test_id, event = entry["t"], entry["e"]
+        if event == "start":
+            states[test_id] = {"run": entry.get("r"), "max_cycles": entry["max_cycles"], "done": [],
+                               "confirmed": [], "waiting": None, "last": None}
+        elif event == "snapshot":
+            states[test_id] = entry["state"]
+        elif test_id not in states or entry.get("r") not in (None, states[test_id].get("run")):
+            return  # not running, or written by an earlier run of this test id
+        elif event == "end":
+            del states[test_id]
+        else:
+            state = states[test_id]
+            if event == "stage":
+                step = [entry.get("cycle"), entry["stage"]]
+                state["done"].append(step)
+                state["last"] = step
+            elif event == "wait":
+                state["waiting"] = entry["cycle"]
+            elif event == "confirmed":
+                state["confirmed"].append(entry["cycle"])
+                state["waiting"] = None
+
+    def _append(self, entry):
+        with self._lock:
+            if self._frozen:
+                return
+            self._apply(self._states, entry)
+            if not self.path:
+                return
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._size = self._file.tell()
+            line = json.dumps(entry, separators=(",", ":")) + "\n"
+            self._file.write(line)
+            self._file.flush()
+            if CHECKPOINT_FSYNC:
+                os.fsync(self._file.fileno())
+            self._size += len(line)
+            if self._size > CHECKPOINT_COMPACT_BYTES:
+                self._compact()
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for test_id, state in self._states.items():
+                f.write(json.dumps({"t": test_id, "e": "snapshot", "state": state}, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """Fold the journal on disk; returns {test_id: state} of unfinished tests"""
+        states = {}
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(states, json.loads(line))
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue  # torn last line after a crash
+        with self._lock:
+            self._states = states
+            if self.path:
+                self._compact()
+        return {test_id: json.loads(json.dumps(state)) for test_id, state in states.items()}
+
+    def started(self, test_id, max_cycles, run=None):
+        self._append({"t": test_id, "r": run, "e": "start", "max_cycles": max_cycles})
+
+    def stage_done(self, test_id, stage, cycle=None, run=None):
+        self._append({"t": test_id, "r": run, "e": "stage", "stage": stage, "cycle": cycle})
+
+    def waiting(self, test_id, cycle, run=None):
+        self._append({"t": test_id, "r": run, "e": "wait", "cycle": cycle})
+
+    def confirmed(self, test_id, cycle, run=None):
+        self._append({"t": test_id, "r": run, "e": "confirmed", "cycle": cycle})
+
+    def ended(self, test_id, run=None):
+        state = self._states.get(test_id)
+        if state is not None and run in (None, state.get("run")):
+            self._append({"t": test_id, "r": run, "e": "end"})
+
+    def freeze(self):
+        """Stop recording (shutdown), so tests torn down now still resume next start"""
+        with self._lock:
+            self._frozen = True
+
+    def active(self):
+        return len(self._states)
+
+
+journal = TestJournal()
+
+
+# --- run archive ---
+def _archive_time(value):
+    """Epoch seconds from a number or an ISO timestamp (None passes through)"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)  # query strings carry epoch seconds as text
+    except ValueError:
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def _archive_iso(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+
+
+class RunArchive:
+    """
+    SQLite history of every test run: one row per run (start/end, final
+    status and reason, cycles reached, image count, timing summary), its
+    status events and the images sent for it. Writes are queued from the
+    publishing threads and committed in batches by one writer thread.
+    Queries page through runs newest first with an opaque keyset cursor
+    and optional testId/status/time-range filters. Keeps the newest
+    ARCHIVE_MAX_RUNS runs.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH):
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                test_id TEXT NOT NULL,
+                started REAL NOT NULL,
+                ended REAL,
+                status TEXT,
+                message TEXT,
+                cycles INTEGER NOT NULL DEFAULT 0,
+                stage INTEGER,
+                images INTEGER NOT NULL DEFAULT 0,
+                timing TEXT);
+            CREATE INDEX IF NOT EXISTS runs_started ON runs (started, id);
+            CREATE INDEX IF NOT EXISTS runs_test ON runs (test_id, started);
+            CREATE TABLE IF NOT EXISTS events (
+                run_id INTEGER NOT NULL,
+                ts REAL NOT NULL,
+                status TEXT,
+                stage INTEGER,
+                cycle INTEGER,
+                message TEXT);
+            CREATE INDEX IF NOT EXISTS events_run ON events (run_id, ts);
+            CREATE TABLE IF NOT EXISTS images (
+                run_id INTEGER NOT NULL,
+                ts REAL NOT NULL,
+                cycle INTEGER,
+                material TEXT,
+                filename TEXT,
+                size INTEGER,
+                analysis TEXT);
+            CREATE INDEX IF NOT EXISTS images_run ON images (run_id, ts);
+        """)
+        self._open = {}  # test_id -> run id, for runs not ended yet
+        self._rows = {}  # TestRecord.run_id -> run id, so late writes land on their own run
+        self._queue = queue.Queue(ARCHIVE_QUEUE_SIZE)
+        self.stats = collections.Counter()
+        self._thread = threading.Thread(target=self._run, name="ur2-archive", daemon=True)
+        self._thread.start()
+
+    # writes (any thread)
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def record_status(self, payload, run=None):
+        self._put(("status", time.time(), (payload, run)))
+
+    def record_image(self, test_id, cycle, material, filename, size, analysis=None):
+        self._put(("image", time.time(), (test_id, cycle, material, filename, size, analysis)))
+
+    def record_timing(self, test_id, summary, run=None):
+        self._put(("timing", time.time(), (test_id, summary, run)))
+
+    # writer thread
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._lock:
+                    self._db.execute("BEGIN")
+                    for kind, ts, data in batch:
+                        getattr(self, "_write_" + kind)(ts, data)
+                    self._db.execute("COMMIT")
+                self.stats["written"] += len(batch)
+            except Exception as e:
+                with self._lock:
+                    if self._db.in_transaction:
+                        self._db.execute("ROLLBACK")
+                self.stats["failed"] += len(batch)
+                log_message(f"Run archive write failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _run_id(self, test_id, ts, status):
+        """Open run for test_id; "started" begins a new one, a restart picks up the unfinished one"""
+        run_id = self._open.get(test_id)
+        if status == "started":
+            if run_id is not None:  # never saw it end (e.g. stopped while we were down)
+                self._db.execute("UPDATE runs SET ended = ? WHERE id = ?", (ts, run_id))
+            run_id = self._open[test_id] = self._db.execute(
+                "INSERT INTO runs (test_id, started) VALUES (?, ?)", (test_id, ts)).lastrowid
+            self._prune()
+        elif run_id is None:
+            row = self._db.execute(
+                "SELECT id FROM runs WHERE test_id = ? AND ended IS NULL ORDER BY started DESC LIMIT 1",
+                (test_id,)).fetchone()
+            if row is not None:
+                run_id = self._open[test_id] = row[0]
+        return run_id
+
+    def _write_status(self, ts, data):
+        payload, run = data
+        test_id, status = payload.get("testId"), payload.get("run_status")
+        if status in REPLY_STATUSES:
+            return  # a reply to another start command, not this run's history
+        run_id = self._run_id(test_id, ts, status)
+        if run_id is None and status == "stopped":
+            # the user's stop wins over whatever ended the run just before it
+            row = self._db.execute("SELECT id FROM runs WHERE test_id = ? ORDER BY started DESC LIMIT 1",
+                                   (test_id,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE runs SET status = ?, message = ? WHERE id = ?",
+                                 (status, payload.get("message"), row[0]))
+                self._db.execute("INSERT INTO events (run_id, ts, status, message) VALUES (?, ?, ?, ?)",
+                                 (row[0], ts, status, payload.get("message")))
+            return
+        if run_id is None:
+            return  # e.g. a status for a test that was never admitted
+        if run is not None:
+            self._rows.setdefault(run, run_id)
+        stage, cycle, message = payload.get("run_stage"), payload.get("cycle"), payload.get("message")
+        self._db.execute("INSERT INTO events (run_id, ts, status, stage, cycle, message) VALUES (?, ?, ?, ?, ?, ?)",
+                         (run_id, ts, status, stage, cycle, message))
+        self._db.execute(
+            "UPDATE runs SET status = coalesce(?, status), stage = coalesce(?, stage), "
+            "cycles = max(cycles, coalesce(?, 0)), message = coalesce(?, message) WHERE id = ?",
+            (status, stage, cycle, message, run_id))
+        if status in TERMINAL_STATUSES:
+            self._db.execute("UPDATE runs SET ended = ? WHERE id = ?", (ts, run_id))
+            del self._open[test_id]
+
+    def _write_image(self, ts, data):
+        test_id, cycle, material, filename, size, analysis = data
+        run_id = self._run_id(test_id, ts, None)
+        if run_id is None:
+            return
+        self._db.execute(
+            "INSERT INTO images (run_id, ts, cycle, material, filename, size, analysis) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (run_id, ts, cycle, material, filename, size, json.dumps(analysis) if analysis else None))
+        self._db.execute("UPDATE runs SET images = images + 1 WHERE id = ?", (run_id,))
+
+    def _write_timing(self, ts, data):
+        test_id, summary, run = data
+        if run is not None:
+            row = (self._rows.pop(run),) if run in self._rows else None  # timing is the run's last write
+        else:
+            row = self._db.execute("SELECT id FROM runs WHERE test_id = ? ORDER BY started DESC LIMIT 1",
+                                   (test_id,)).fetchone()
+        if row is not None:
+            self._db.execute("UPDATE runs SET timing = ? WHERE id = ?", (json.dumps(summary), row[0]))
+
+    def _prune(self):
+        cutoff = self._db.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?",
+                                  (ARCHIVE_MAX_RUNS,)).fetchone()
+        if cutoff is None:
+            return
+        for table in ("events", "images"):
+            self._db.execute(f"DELETE FROM {table} WHERE run_id <= ?", cutoff)
+        self._db.execute("DELETE FROM runs WHERE id <= ?", cutoff)
+        self._open = {t: r for t, r in self._open.items() if r > cutoff[0]}
+        self._rows = {k: r for k, r in self._rows.items() if r > cutoff[0]}
+
+    # queries (any thread)
+    @staticmethod
+    def _summary(row):
+        run_id, test_id, started, ended, status, message, cycles, stage, images = row[:9]
+        return {
+            "runId": run_id,
+            "testId": test_id,
+            "started": _archive_iso(started),
+            "ended": _archive_iso(ended),
+            "duration_s": round(ended - started, 3) if ended is not None else None,
+            "status": status,
+            "message": message,
+            "cycles": cycles,
+            "stage": stage,
+            "images": images,
+        }
+
+    def runs(self, test_id=None, status=None, since=None, until=None, limit=ARCHIVE_PAGE_SIZE, cursor=None):
+        """One page of run summaries, newest first, and the cursor for the next page (or None)"""
+        where, args = [], []
+        if test_id is not None:
+            where.append("test_id = ?")
+            args.append(test_id)
+        if status is not None:
+            where.append("status = ?")
+            args.append(status)
+        if since is not None:
+            where.append("started >= ?")
+            args.append(_archive_time(since))
+        if until is not None:
+            where.append("started < ?")
+            args.append(_archive_time(until))
+        if cursor:
+            started, run_id = cursor.split(":")
+            where.append("(started < ? OR (started = ? AND id < ?))")
+            args += [float(started), float(started), int(run_id)]
+        limit = max(1, min(int(limit), ARCHIVE_PAGE_MAX))
+        sql = ("SELECT id, test_id, started, ended, status, message, cycles, stage, images FROM runs"
+               + (" WHERE " + " AND ".join(where) if where else "")
+               + " ORDER BY started DESC, id DESC LIMIT ?")
+        with self._lock:
+            rows = self._db.execute(sql, args + [limit + 1]).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "runs": [self._summary(r) for r in rows],
+            "next": f"{rows[-1][2]!r}:{rows[-1][0]}" if more else None,
+        }
+
+    def run(self, run_id, events_limit=ARCHIVE_PAGE_MAX):
+        """One run with its timing summary, images and (first events_limit) status events"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, test_id, started, ended, status, message, cycles, stage, images, timing "
+                "FROM runs WHERE id = ?", (int(run_id),)).fetchone()
+            if row is None:
+                return None
+            events = self._db.execute(
+                "SELECT ts, status, stage, cycle, message FROM events WHERE run_id = ? ORDER BY ts LIMIT ?",
+                (row[0], int(events_limit))).fetchall()
+            images = self._db.execute(
+                "SELECT ts, cycle, material, filename, size, analysis FROM images WHERE run_id = ? ORDER BY ts",
+                (row[0],)).fetchall()
+        run = self._summary(row)
+        run["timing"] = json.loads(row[9]) if row[9] else None
+        run["events"] = [{"timestamp": _archive_iso(ts), "run_status": s, "run_stage": st, "cycle": c, "message": m}
+                         for ts, s, st, c, m in events]
+        run["images_sent"] = [{"timestamp": _archive_iso(ts), "cycle": c, "material": mat, "filename": f,
+                               "size": size, "analysis": json.loads(a) if a else None}
+                              for ts, c, mat, f, size, a in images]
+        return run
+
+    def query(self, request):
+        """Answer an archive request dict ({"query": "runs" | "run", ...filters}); raises ValueError on bad input"""
+        kind = request.get("query", "runs")
+        try:
+            if kind == "runs":
+                return self.runs(test_id=request.get("testId"), status=request.get("status"),
+                                 since=request.get("since"), until=request.get("until"),
+                                 limit=request.get("limit", ARCHIVE_PAGE_SIZE), cursor=request.get("cursor"))
+            if kind == "run":
+                return {"run": self.run(request["runId"], request.get("events", ARCHIVE_PAGE_MAX))}
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"bad archive request: {e}") from e
+        raise ValueError(f"unknown archive query {kind!r}")
+
+    def flush(self):
+        """Wait until everything recorded so far is written"""
+        self._queue.join()
+
+    def snapshot(self):
+        return {**self.stats, "queued": self._queue.qsize(), "open_runs": len(self._open)}
+
+
+archive = None  # opened by get_archive() on first use
+archive_lock = threading.Lock()
+
+
+def get_archive():
+    global archive
+    with archive_lock:
+        if archive is None:
+            archive = RunArchive()
+        return archive
+
+
+def handle_archive_request(data):
+    """Serve an archive query from ARCHIVE_REQUEST_TOPIC on ARCHIVE_REPLY_TOPIC + clientId"""
+    reply = {"requestId": data.get("requestId"), "timestamp": now_iso()}
+    try:
+        reply.update(get_archive().query(data))
+    except ValueError as e:
+        reply["error"] = str(e)
+    client.publish(ARCHIVE_REPLY_TOPIC + data["clientId"], json.dumps(reply))
+
+
+def publish_resumed(test_id, state):
+    """Republish where a resumed test stands so the frontend resynchronizes"""
+    cycle, name = state.get("last") or (None, None)
+    stage = STAGE_NUMBERS.get(name, 0)
     pub(test_id, 
-        run_status="started", 
-        run_stage=0)
+        run_status="running", 
+        run_stage=stage, 
+        cycle=cycle, 
+        message="resumed after restart")
+
+
+def resume_tests():
+    """Restart every test the journal says was still running when the process stopped"""
+    states = journal.load()
+    for test_id, state in states.items():
+        record = active_tests.add(test_id)
+        if record is None:
+            continue
+        record.run_id = state.get("run") or record.run_id  # the same run, carried on
+        done = len(state["done"])
+        log_message(f"Resuming test {test_id}: {done} stages done, last {state['last']}"
+                    + (f", waiting for confirmation of cycle {state['waiting']}" if state["waiting"] else ""),
+                    test_id=test_id)
+        start_test(test_id, state["max_cycles"], resume=state)
+    return len(states)
+
+
+def publish_timing_summary(record):
+    """Publish where a finished test spent its time on TIMING_TOPIC"""
+    if record is None:
+        return
+    summary = record.timing_summary()
+    get_archive().record_timing(record.test_id, summary, run=record.run_id)
+    get_outbox().publish(TIMING_TOPIC, json.dumps(summary), key=f"timing|{record.test_id}")
+    log_message(f"Test {record.test_id}: timing " + ", ".join(
+        f"{name}={agg['total_s']:.1f}s" for name, agg in summary["stages"].items()))
+
+
+def simulate_test_process(test_id: str, max_cycles: int = 5, resume=None):
+    record = active_tests.get(test_id)
+    if record is None:
+        return  # stopped before the thread got going
+    done = resume["done"] if resume else []  # [cycle, stage] pairs finished before a restart
+    confirmed = resume["confirmed"] if resume else []
+    if resume:
+        publish_resumed(test_id, resume)
+    else:
+        pub(test_id, 
+            run_status="started", 
+            run_stage=0)
     
-    heat_ev = heat_proc = None
+    heater = None
+    heat_grant = None
 
     try:
         # 1) prepare once
-        log_message(f"Test {test_id}: Running prepare script")
-        run_external_py("prepare")
-        pub(test_id, 
-            run_status="running", 
-            run_stage=1)
+        if [None, "prepare"] not in done:
+            log_message(f"Test {test_id}: Running prepare script", test_id=test_id, stage="prepare")
+            grant = resource_scheduler.acquire(test_id, "prepare")
+            if grant is None:
+                return  # stopped while waiting for the pumps
+            try:
+                run_with_retries("prepare", run_external_py, test_id=test_id)
+            finally:
+                resource_scheduler.release(grant)
+            journal.stage_done(test_id, "prepare", run=record.run_id)
+            pub(test_id, 
+                run_status="running", 
+                run_stage=1)
 
         # 2) heat in background for entire test
-        heat_ev, heat_proc = start_heat()
+        if SIMULATE_HEAT:
+            heat_grant = resource_scheduler.acquire(test_id, "heat")
+            if heat_grant is not None:
+                heater = start_heat(test_id)
+                active_tests.set_heat(test_id, heater)
 
         user_stopped = False
-        per_cycle_steps = [("dissolution", 2), 
-                           ("dilution", 3), 
-                           # ("color_agents", 4),
-                           ("aluminum", 4),
-                           ("silicon", 5)
-                        ]
 
         for cycle in range(1, max_cycles + 1):
-            if test_id not in active_tests:
+            if active_tests.get(test_id) is not record:
                 break
+            if cycle in confirmed:
+                continue
 
-            log_message(f"Test {test_id} - Starting Cycle {cycle}/{max_cycles}")
-            pub(test_id, 
-                run_status="cycle_start", 
-                cycle=cycle, 
-                run_stage=2)
+            if not any(c == cycle for c, _ in done):
+                log_message(f"Test {test_id} - Starting Cycle {cycle}/{max_cycles}", test_id=test_id, cycle=cycle)
+                pub(test_id, 
+                    run_status="cycle_start", 
+                    cycle=cycle, 
+                    run_stage=2)
 
-            for step_name, stage in per_cycle_steps:
-                log_message(f"Test {test_id} - Cycle {cycle}: Running {step_name}")
-                run_external_py(step_name)
+            def run_step(step_name, cycle=cycle):
+                log_message(f"Test {test_id} - Cycle {cycle}: Running {step_name}", test_id=test_id, cycle=cycle, stage=step_name)
+                grant = resource_scheduler.acquire(test_id, step_name)
+                if grant is None:
+                    return
+                try:
+                    run_with_retries(step_name, run_external_py, test_id=test_id, cycle=cycle)
+                finally:
+                    resource_scheduler.release(grant)
+                journal.stage_done(test_id, step_name, cycle, run=record.run_id)
                 
-                if step_name in ['aluminum', 'silicon']:
+                if SIMULATE_IMAGES and CAPTURE_MODE == "files" and PIPELINE[step_name].get("image"):
                     send_img_to_web(test_id=test_id, cycle=cycle, material=step_name)
 
                 pub(test_id, 
                     run_status="running", 
-                    run_stage=stage, 
+                    run_stage=STAGE_NUMBERS[step_name], 
                     cycle=cycle)
 
-            log_message(f"Test {test_id} - Cycle {cycle}/{max_cycles} completed")
+            # independent stages (aluminum/silicon) run side by side
+            run_cycle_stages(run_step, skip=[name for c, name in done if c == cycle])
+
+            log_message(f"Test {test_id} - Cycle {cycle}/{max_cycles} completed", test_id=test_id, cycle=cycle)
 
             # confirm continuation
             if not wait_for_user_confirmation(test_id, cycle):
+                if active_tests.get(test_id) is not record:
+                    user_stopped = True  # stop command, "stopped" is already out
+                    break
+                msg = f"test interrupted after cycle {cycle}"
+                log_message(f"Test {test_id} - {msg}", test_id=test_id)
+                pub(test_id, 
+                    run_status="failed", 
+                    message=msg, 
+                    run_stage=5, 
+                    cycle=cycle)
+                user_stopped = True
+                break
+
+        # wrap up (only if not user-stopped and still active)
+        if not user_stopped and active_tests.get(test_id) is record:
+            pub(test_id, 
+                run_status="completed", 
+                run_stage=len(PROCESS_STAGES), 
+                cycle=None)
+            log_message(f"Test {test_id} completed successfully!", test_id=test_id)
+
+    except Exception as e:
+        log_message(f"Error in test {test_id}: {e}")
+        pub(test_id, run_status="error", message=str(e))
+    finally:
+        stop_heat(heater)  # every exit, including the early returns
+        resource_scheduler.release(heat_grant)
+        journal.ended(test_id, run=record.run_id)
+        publish_timing_summary(record)
+        active_tests.remove(test_id, record)
+
+
+###################################
+# asyncio orchestrator
+
+
+@instrumented("stage", _stage_labels)
+async def run_external_py_async(name: str, timeout=None, test_id=None, cycle=None):
+    print("#"*30)
+    await asyncio.sleep(SIMULATED_SCRIPT_SECONDS)  # Simulate script execution time
+    print(f"Simulating {name} script...")
+    print("#"*30)
+    # a full capture queue waits up to CAPTURE_PUT_TIMEOUT, keep that off the loop
+    await asyncio.get_running_loop().run_in_executor(
+        capture_pipeline.executor, functools.partial(capture_frame, name, test_id=test_id, cycle=cycle))
+
+
+@instrumented("confirmation_wait", _confirm_labels)
+async def wait_for_user_confirmation_async(test_id, cycle_number, timeout=CONFIRMATION_TIMEOUT):
+    """Coroutine version of wait_for_user_confirmation"""
+    log_message(f"Test {test_id}: Requesting user confirmation after cycle {cycle_number}/5...", test_id=test_id, cycle=cycle_number)
+
+    entry = confirmations.open(test_id, cycle_number)
+    record = active_tests.get(test_id)
+    if record is None:
+        confirmations.discard(entry)
+        return False
+
+    pub(test_id, 
+        run_status="waiting_confirmation", 
+        message=f"Cycle {cycle_number}/5 completed", 
+        cycle=cycle_number)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, functools.partial(journal.waiting, test_id, cycle_number, run=record.run_id))
+
+    response = await confirmations.wait_async(entry, timeout)
+    if response is None:
+        log_message(f"Test {test_id}: No user confirmation within {timeout}s after cycle {cycle_number}", test_id=test_id, cycle=cycle_number)
+        return False
+    if entry.cancelled:
+        return False
+
+    log_message(f"Test {test_id}: User {'confirmed' if response else 'declined'} to continue after cycle {cycle_number}", test_id=test_id, cycle=cycle_number)
+    if response:
+        await loop.run_in_executor(None, functools.partial(journal.confirmed, test_id, cycle_number, run=record.run_id))
+    return response
+
+
+async def simulate_test_process_async(test_id: str, max_cycles: int = 5, resume=None):
+    """Same pipeline as simulate_test_process, run as a coroutine"""
+    loop = asyncio.get_running_loop()
+    record = active_tests.get(test_id)
+    if record is None:
+        return
+    done = resume["done"] if resume else []
+    confirmed = resume["confirmed"] if resume else []
+    if resume:
+        publish_resumed(test_id, resume)
+    else:
+        pub(test_id, 
+            run_status="started", 
+            run_stage=0)
+
+    heater = None
+    heat_grant = None
+
+    try:
+        if [None, "prepare"] not in done:
+            log_message(f"Test {test_id}: Running prepare script", test_id=test_id, stage="prepare")
+            grant = await resource_scheduler.acquire_async(test_id, "prepare")
+            if grant is None:
+                return
+            try:
+                await run_with_retries_async("prepare", run_external_py_async, test_id=test_id)
+            finally:
+                resource_scheduler.release(grant)
+            await loop.run_in_executor(  # fsync off the loop
+                None, functools.partial(journal.stage_done, test_id, "prepare", run=record.run_id))
+            pub(test_id, 
+                run_status="running", 
+                run_stage=1)
+
+        if SIMULATE_HEAT:
+            heat_grant = await resource_scheduler.acquire_async(test_id, "heat")
+            if heat_grant is not None:
+                heater = start_heat(test_id)
+                active_tests.set_heat(test_id, heater)
+
+        user_stopped = False
+
+        for cycle in range(1, max_cycles + 1):
+            if active_tests.get(test_id) is not record:
+                break
+            if cycle in confirmed:
+                continue
+
+            if not any(c == cycle for c, _ in done):
+                log_message(f"Test {test_id} - Starting Cycle {cycle}/{max_cycles}", test_id=test_id, cycle=cycle)
+                pub(test_id, 
+                    run_status="cycle_start", 
+                    cycle=cycle, 
+                    run_stage=2)
+
+            async def run_step(step_name, cycle=cycle):
+                log_message(f"Test {test_id} - Cycle {cycle}: Running {step_name}", test_id=test_id, cycle=cycle, stage=step_name)
+                grant = await resource_scheduler.acquire_async(test_id, step_name)
+                if grant is None:
+                    return
+                try:
+                    await run_with_retries_async(step_name, run_external_py_async, test_id=test_id, cycle=cycle)
+                finally:
+                    resource_scheduler.release(grant)
+                await loop.run_in_executor(
+                    None, functools.partial(journal.stage_done, test_id, step_name, cycle, run=record.run_id))
+
+                if SIMULATE_IMAGES and CAPTURE_MODE == "files" and PIPELINE[step_name].get("image"):
+                    # file read + publish is blocking, keep it off the loop
+                    await loop.run_in_executor(
+                        None, functools.partial(send_img_to_web, test_id=test_id, cycle=cycle, material=step_name))
+
+                pub(test_id, 
+                    run_status="running", 
+                    run_stage=STAGE_NUMBERS[step_name], 
+                    cycle=cycle)
+
+            await run_cycle_stages_async(run_step, skip=[name for c, name in done if c == cycle])
+
+            log_message(f"Test {test_id} - Cycle {cycle}/{max_cycles} completed", test_id=test_id, cycle=cycle)
+
+            if not await wait_for_user_confirmation_async(test_id, cycle):
+                if active_tests.get(test_id) is not record:
+                    user_stopped = True  # stop command, "stopped" is already out
+                    break
                 msg = f"test interrupted after cycle {cycle}"
-                log_message(f"Test {test_id} - {msg}")
+                log_message(f"Test {test_id} - {msg}", test_id=test_id)
                 pub(test_id, 
                     run_status="failed", 
                     message=msg, 
@@ -370,24 +3838,109 @@ def simulate_test_process(test_id: str, max_cycles: int = 5):
                 user_stopped = True
                 break
 
-        # always stop heat
-        stop_heat(heat_ev, heat_proc)
+        if not user_stopped and active_tests.get(test_id) is record:
+            pub(test_id, 
+                run_status="completed", 
+                run_stage=len(PROCESS_STAGES), 
+                cycle=None)
+            log_message(f"Test {test_id} completed successfully!", test_id=test_id)
+
+    except Exception as e:
+        log_message(f"Error in test {test_id}: {e}")
+        pub(test_id, run_status="error", message=str(e))
+    finally:
+        stop_heat(heater)
+        resource_scheduler.release(heat_grant)
+        journal.ended(test_id, run=record.run_id)
+        publish_timing_summary(record)
+        active_tests.remove(test_id, record)
+
+
+class AsyncOrchestrator:
+    """
+    Runs every test as a coroutine on one event loop in a background thread.
+    The paho network thread hands commands over with submit(); publishing
+    back goes through client.publish, which is thread-safe.
+    """
+
+    def __init__(self, blocking_workers=ASYNC_BLOCKING_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="ur2-io"))
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop.run_forever, name="ur2-orchestrator", daemon=True)
+            self._thread.start()
+            log_message("Async orchestrator started")
+        return self
+
+    def submit(self, test_id, max_cycles=5, resume=None):
+        """Schedule a test from any thread, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(simulate_test_process_async(test_id, max_cycles, resume), self.loop)
+
+    def stop(self, timeout=5):
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+        log_message("Async orchestrator stopped")
+
+
+orchestrator = None
+
+
+def get_orchestrator():
+    global orchestrator
+    if orchestrator is None:
+        orchestrator = AsyncOrchestrator().start()
+    return orchestrator
 
-        # wrap up (only if not user-stopped and still active)
-        if not user_stopped and test_id in active_tests:
-            pub(test_id, 
-                run_status="completed", 
-                run_stage=len(PROCESS_STAGES), 
-                cycle=None)
-            log_message(f"Test {test_id} completed successfully!")
-            del active_tests[test_id]
 
-    except Exception as e:
-        log_message(f"Error in test {test_id}: {e}")
-        stop_heat(heat_ev, heat_proc, timeout=10)
-        pub(test_id, run_status="error", message=str(e))
-        if test_id in active_tests:
-            del active_tests[test_id]
+def start_test(test_id, max_cycles=5, resume=None):
+    """Launch a test in the configured orchestrator mode (resume = journal state to continue from)"""
+    if resume is None:
+        record = active_tests.get(test_id)
+        journal.started(test_id, max_cycles, run=record.run_id if record is not None else None)
+    if ORCHESTRATOR_MODE == "asyncio":
+        get_orchestrator().submit(test_id, max_cycles, resume)
+    else:
+        test_thread = threading.Thread(
+            target=simulate_test_process, 
+            args=(test_id, max_cycles, resume),
+            daemon=True
+        )
+        test_thread.start()
+
+
+metrics.gauge("ur2_active_tests", lambda: len(active_tests), "Tests currently registered")
+metrics.gauge("ur2_pending_confirmations", lambda: confirmations.pending_count(), "Tests waiting for the user")
+metrics.gauge("ur2_active_heaters", lambda: heat_controller.active(), "Heaters currently on")
+metrics.gauge("ur2_confirmation_roundtrip_seconds",
+              lambda: {(("quantile", q),): confirmations.latency_stats().get(k, 0)
+                       for q, k in (("0.5", "p50"), ("0.95", "p95"))},
+              "Confirmation round-trip latency")
+metrics.gauge("ur2_outbox",
+              lambda: {(("counter", k),): v for k, v in get_outbox().snapshot().items()},
+              "Durable outbox spool size and counters")
+metrics.gauge("ur2_status_publisher",
+              lambda: {(("counter", k),): v for k, v in status_publisher.snapshot().items()},
+              "Status publish pipeline counters")
+metrics.gauge("ur2_capture",
+              lambda: {(("counter", k),): v for k, v in capture_pipeline.snapshot().items()},
+              "In-memory image capture queue and counters")
+metrics.gauge("ur2_archive",
+              lambda: {(("counter", k),): v for k, v in get_archive().snapshot().items()},
+              "Run archive writer counters")
+metrics.gauge("ur2_ingest",
+              lambda: {(("state", "queued"),): command_ingest.depth(), (("state", "capacity"),): command_ingest.maxsize},
+              "Command ingestion queue depth")
+metrics.gauge("ur2_resource",
+              lambda: {(("resource", name), ("state", k)): v
+                       for name, counts in resource_scheduler.snapshot().items() for k, v in counts.items()},
+              "Shared instrument capacity, units in use and stages queued")
 
 
 def on_connect(client, userdata, flags, rc):
@@ -397,7 +3950,14 @@ def on_connect(client, userdata, flags, rc):
         log_message(f"Session present: {flags['session present']}")
         client.subscribe(TEST_PUB_TOPIC)
         client.subscribe(CONFIRMATION_TOPIC)
-        log_message(f"📡 Subscribed to topics: {TEST_PUB_TOPIC}, {CONFIRMATION_TOPIC}")
+        client.subscribe(IMAGE_RESEND_TOPIC)
+        client.subscribe(IMAGE_REQUEST_TOPIC)
+        client.subscribe(FORMAT_HELLO_TOPIC)
+        client.subscribe(ARCHIVE_REQUEST_TOPIC)
+        get_outbox().wake()  # replay whatever was spooled while offline
+        command_ingest.workers.submit(resume_img_transfers)
+        log_message(f"📡 Subscribed to topics: {TEST_PUB_TOPIC}, {CONFIRMATION_TOPIC}, "
+                    f"{IMAGE_RESEND_TOPIC}, {IMAGE_REQUEST_TOPIC}, {FORMAT_HELLO_TOPIC}, {ARCHIVE_REQUEST_TOPIC}")
     else:
         error_messages = {
             1: "Connection refused - incorrect protocol version",
@@ -419,11 +3979,11 @@ def on_disconnect(client, userdata, rc):
 
 def on_log(client, userdata, level, buf):
     """Callback for MQTT client logging"""
-    log_message(f"MQTT Log: {buf}")
+    log_message(f"MQTT Log: {buf}", level="debug", rate_key="on_log")
 
 def on_publish(client, userdata, mid):
     """Callback for when message is published"""
-    log_message(f"Message published with ID: {mid}")
+    log_message(f"Message published with ID: {mid}", level="debug", rate_key="on_publish")
 
 def on_subscribe(client, userdata, mid, granted_qos):
     """Callback for when subscription is confirmed"""
@@ -433,11 +3993,90 @@ def on_unsubscribe(client, userdata, mid):
     """Callback for when unsubscription is confirmed"""
     log_message(f"Unsubscription confirmed with ID: {mid}")
 
+# --- command ingestion ---
+class CommandIngest:
+    """
+    on_message only puts (topic, payload) into a bounded queue, so the paho
+    network thread never parses JSON, touches test state or starts threads.
+    One dispatcher thread drains it in arrival order through handle_message;
+    slow work (image requests, chunk resends) goes to a fixed worker pool.
+    A full queue drops the message. COMMAND_RATE_LIMITS token buckets and
+    MAX_CONCURRENT_TESTS are checked by the handlers through allow().
+    """
+
+    def __init__(self, maxsize=INGEST_QUEUE_SIZE, workers=INGEST_WORKERS):
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._buckets = {}  # kind -> [tokens, last refill]
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ur2-cmd")
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ur2-ingest", daemon=True)
+                self._thread.start()
+
+    def submit(self, topic, payload):
+        """Called on the network thread: enqueue or drop, never block"""
+        self._start()
+        try:
+            self._queue.put_nowait((topic, payload, time.monotonic()))
+        except queue.Full:
+            self.drop(topic, "queue_full")
+            return False
+        return True
+
+    def drop(self, topic, reason):
+        metrics.inc("ur2_ingest_dropped_total", help="Incoming messages not handled", topic=topic, reason=reason)
+        log_message(f"Dropped message on '{topic}' ({reason})", rate_key="ingest_drop")
+
+    def allow(self, kind):
+        """Take a token from kind's COMMAND_RATE_LIMITS bucket (rate/s, burst); True if unlimited"""
+        limit = COMMAND_RATE_LIMITS.get(kind)
+        if not limit:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        state = self._buckets.setdefault(kind, [burst, now])  # only the dispatcher thread gets here
+        state[0] = min(burst, state[0] + (now - state[1]) * rate)
+        state[1] = now
+        if state[0] < 1:
+            return False
+        state[0] -= 1
+        return True
+
+    def _run(self):
+        while True:
+            topic, payload, queued_at = self._queue.get()
+            metrics.observe("ur2_ingest_wait_seconds", time.monotonic() - queued_at,
+                            help="Time commands waited in the ingestion queue")
+            try:
+                handle_message(topic, payload.decode(errors="replace"))
+            except Exception as e:
+                log_message(f"Error handling message on '{topic}': {e}")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until everything queued so far has been handled"""
+        self._queue.join()
+
+    def depth(self):
+        return self._queue.qsize()
+
+
+command_ingest = CommandIngest()
+
+
 def on_message(client, userdata, msg):
-    """Handle incoming messages from frontend"""
-    topic = msg.topic
-    message = msg.payload.decode()
-    
+    """Handle incoming messages from frontend (queued for the dispatcher, see CommandIngest)"""
+    command_ingest.submit(msg.topic, msg.payload)
+
+
+def handle_message(topic, message):
+    """Handle one message from the frontend on the dispatcher thread"""
     log_message(f"Received message on topic '{topic}'")
     
     if topic == TEST_PUB_TOPIC:
@@ -448,49 +4087,42 @@ def on_message(client, userdata, msg):
             
             if command == "start" and test_id:
                 if test_id in active_tests:
-                    log_message(f"Test {test_id} is already running")
-                    
-                    response = {
-                        "testId": test_id,
-                        "run_status": "already_running",
-                    }
-                    client.publish(TEST_SUB_TOPIC, json.dumps(response))
+                    log_message(f"Test {test_id} is already running", test_id=test_id)
+                    pub(test_id, run_status="already_running")
+                elif len(active_tests) >= MAX_CONCURRENT_TESTS or not command_ingest.allow("start"):
+                    reason = ("too many tests running" if len(active_tests) >= MAX_CONCURRENT_TESTS
+                              else "too many start commands")
+                    log_message(f"Rejecting test {test_id}: {reason}", test_id=test_id)
+                    metrics.inc("ur2_ingest_rejected_total", help="Start commands answered with busy", reason=reason)
+                    pub(test_id, run_status="busy", message=f"Simulator busy ({reason}), try again later")
+                elif active_tests.add(test_id) is None:
+                    pub(test_id, run_status="already_running")
                 else:
-                    # Start new test in background thread
                     log_message(f"Starting new test: {test_id}")
-                    active_tests[test_id] = {
-                        "start_time": datetime.now(),
-                        "current_stage": 0
-                    }
-                    
-                    # Start test process in separate thread
-                    test_thread = threading.Thread(
-                        target=simulate_test_process, 
-                        args=(test_id,),
-                        daemon=True
-                    )
-                    test_thread.start()
+                    start_test(test_id)
             
             elif command == "stop" and test_id:
-                if test_id in active_tests:
+                stopped = active_tests.remove(test_id)
+                if stopped is not None:
+                    stopped.status = "stopped"
                     log_message(f"Stopping test: {test_id}")
-                    del active_tests[test_id]
-                    
-                    # Send stopped response
-                    response = {
-                        "testId": test_id,
-                        "run_status": "stopped",
-                        "message": "Test stopped by user"
-                    }
-                    client.publish(TEST_SUB_TOPIC, json.dumps(response))
+                    # Send stopped response before waking the test's waiters
+                    pub(test_id, run_status="stopped", message="Test stopped by user")
+                    confirmations.cancel(test_id)
+                    resource_scheduler.cancel(test_id)
+                    journal.ended(test_id, run=stopped.run_id)
                 else:
-                    log_message(f"Test {test_id} is not running")
+                    log_message(f"Test {test_id} is not running", test_id=test_id)
+
+            elif command == "list":
+                tests = active_tests.snapshots()
+                client.publish(TEST_LIST_TOPIC, json.dumps({"timestamp": now_iso(), "count": len(tests), "tests": tests}))
             
             else:
                 log_message(f"Unknown command: {command}")
                 
         except json.JSONDecodeError:
-            log_message(f"Invalid JSON received: {message}")
+            command_ingest.drop(topic, "invalid")
         except Exception as e:
             log_message(f"Error processing message: {str(e)}")
     
@@ -501,41 +4133,243 @@ def on_message(client, userdata, msg):
             confirmed = data.get("confirmed", False)
             
             if test_id:
-                confirmation_key = f"{test_id}_confirmation"
-                user_confirmations[confirmation_key] = confirmed
                 log_message(f"Received user confirmation for test {test_id}: {'Yes' if confirmed else 'No'}")
+                if not confirmations.resolve(test_id, confirmed, cycle=data.get("cycle")):
+                    log_message(f"No pending confirmation for test {test_id}, ignoring")
+                else:
+                    stats = confirmations.latency_stats()
+                    log_message(f"Confirmation round-trip: last={stats['last']:.2f}s "
+                                f"p50={stats['p50']:.2f}s p95={stats['p95']:.2f}s (n={stats['count']})")
             
         except json.JSONDecodeError:
-            log_message(f"Invalid JSON received on confirmation topic: {message}")
+            command_ingest.drop(topic, "invalid")
         except Exception as e:
             log_message(f"Error processing confirmation message: {str(e)}")
 
-def main():
-    global client
-    
-    log_message("Initializing Fake RPI Simulator...")
-    log_message(f"Broker: {BROKER}:{PORT}")
-    log_message(f"Username: {USERNAME}")
-    log_message(f"Listening on: {TEST_PUB_TOPIC}")
-    log_message(f"Publishing to: {TEST_SUB_TOPIC}")
-    log_message(f"Confirmation topic: {CONFIRMATION_TOPIC}")
-    
-    # Create a more stable client ID based on machine info
-    import platform
-    import hashlib
-    
-    machine_info = f"{platform.node()}-{platform.system()}"
-    client_id_hash = hashlib.md5(machine_info.encode()).hexdigest()[:8]
-    client_id = f"ur2-rpi-{client_id_hash}"
-    log_message(f"Client ID: {client_id}")
-    
-    
+    elif topic == IMAGE_RESEND_TOPIC:
+        try:
+            data = json.loads(message)
+            transfer_id = data.get("transferId")
+            if transfer_id and not command_ingest.allow("resend"):
+                command_ingest.drop(topic, "rate_limited")
+            elif transfer_id:
+                # waiting on chunk acks here would block the dispatcher
+                command_ingest.workers.submit(resend_img_chunks, transfer_id, data.get("missing"))
+        except json.JSONDecodeError:
+            command_ingest.drop(topic, "invalid")
+
+    elif topic == FORMAT_HELLO_TOPIC:
+        try:
+            data = json.loads(message)
+            client_id = data.get("clientId")
+            if client_id and not command_ingest.allow("format_hello"):
+                command_ingest.drop(topic, "rate_limited")
+            elif client_id:
+                reply = format_negotiator.hello(client_id, data.get("formats"))
+                client.publish(FORMAT_REPLY_TOPIC + client_id, json.dumps(reply))
+                log_message(f"Client {client_id} negotiated status format '{reply['format']}'")
+        except json.JSONDecodeError:
+            command_ingest.drop(topic, "invalid")
+
+    elif topic == IMAGE_REQUEST_TOPIC:
+        try:
+            data = json.loads(message)
+            if command_ingest.allow("image_request"):
+                command_ingest.workers.submit(handle_image_request, data)
+            else:
+                command_ingest.drop(topic, "rate_limited")
+        except json.JSONDecodeError:
+            command_ingest.drop(topic, "invalid")
+
+    elif topic == ARCHIVE_REQUEST_TOPIC:
+        try:
+            data = json.loads(message)
+            if not isinstance(data, dict) or not data.get("clientId"):
+                command_ingest.drop(topic, "invalid")
+            elif command_ingest.allow("archive"):
+                command_ingest.workers.submit(handle_archive_request, data)
+            else:
+                command_ingest.drop(topic, "rate_limited")
+        except json.JSONDecodeError:
+            command_ingest.drop(topic, "invalid")
+
+# --- local broker stand-in ---
+class _BrokerSession:
+    __slots__ = ("writer", "client_id", "subs", "next_mid")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.subs = {}  # topic filter -> granted qos
+        self.next_mid = 0
+
+
+def _mqtt_len(n):
+    """MQTT variable-length 'remaining length' encoding"""
+    out = bytearray()
+    while True:
+        n, digit = divmod(n, 128)
+        out.append(digit | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+class LocalBroker:
+    """
+    Just enough MQTT 3.1.1 for air-gapped runs and benchmarks: CONNECT,
+    SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PUBLISH at QoS 0/1
+    (delivered at the lower of publish and subscription QoS), PING and
+    DISCONNECT. No auth, retained messages, persistent sessions or QoS 2.
+    Runs on its own event loop thread.
+    """
+
+    def __init__(self, host=LOCAL_BROKER_HOST, port=LOCAL_BROKER_PORT):
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._sessions = set()
+        self._server = None
+        self._thread = None
+        self.stats = collections.Counter()
+
+    def start(self):
+        ready = threading.Event()
+
+        def _run():
+            asyncio.set_event_loop(self.loop)
+            self._server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]  # port 0 = pick a free one
+            ready.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=_run, name="ur2-broker", daemon=True)
+        self._thread.start()
+        ready.wait()
+        log_message(f"Local broker listening on {self.host}:{self.port}")
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        async def _close():
+            self._server.close()
+            for session in list(self._sessions):
+                session.writer.close()
+            await self._server.wait_closed()
+            while self._sessions:  # handlers exit on EOF from the closed transports
+                await asyncio.sleep(0.01)
+
+        asyncio.run_coroutine_threadsafe(_close(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
+        self._thread = None
+        self.loop.close()
+
+    def wait_subscribed(self, client_id, topic_filter, timeout=10.0):
+        """Block until client_id holds a subscription to topic_filter"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if any(s.client_id == client_id and topic_filter in s.subs for s in list(self._sessions)):
+                return True
+            time.sleep(0.01)
+        return False
+
+    async def _handle(self, reader, writer):
+        session = _BrokerSession(writer)
+        self._sessions.add(session)
+        try:
+            while True:
+                head = await reader.readexactly(1)
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+                if not self._packet(session, head[0], body):
+                    break
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._sessions.discard(session)
+            writer.close()
+
+    def _packet(self, session, head, body):
+        """Handle one control packet; returns False to drop the connection"""
+        kind = head >> 4
+        write = session.writer.write
+        if kind == 1:  # CONNECT
+            proto_len = struct.unpack_from("!H", body)[0]
+            id_at = 2 + proto_len + 4  # protocol name, level, flags, keepalive
+            id_len = struct.unpack_from("!H", body, id_at)[0]
+            session.client_id = body[id_at + 2:id_at + 2 + id_len].decode()
+            write(b"\x20\x02\x00\x00")
+            self.stats["connects"] += 1
+        elif kind == 3:  # PUBLISH
+            qos = (head >> 1) & 0x03
+            topic_len = struct.unpack_from("!H", body)[0]
+            topic = body[2:2 + topic_len].decode()
+            offset = 2 + topic_len
+            if qos:
+                mid = body[offset:offset + 2]
+                offset += 2
+                write(b"\x40\x02" + mid)
+            self._route(topic, body[offset:], min(qos, 1))
+        elif kind == 8:  # SUBSCRIBE
+            mid, offset, granted = body[:2], 2, bytearray()
+            while offset < len(body):
+                flen = struct.unpack_from("!H", body, offset)[0]
+                topic_filter = body[offset + 2:offset + 2 + flen].decode()
+                qos = min(body[offset + 2 + flen], 1)
+                session.subs[topic_filter] = qos
+                granted.append(qos)
+                offset += 3 + flen
+            write(b"\x90" + _mqtt_len(2 + len(granted)) + mid + bytes(granted))
+        elif kind == 10:  # UNSUBSCRIBE
+            offset = 2
+            while offset < len(body):
+                flen = struct.unpack_from("!H", body, offset)[0]
+                session.subs.pop(body[offset + 2:offset + 2 + flen].decode(), None)
+                offset += 2 + flen
+            write(b"\xb0\x02" + body[:2])
+        elif kind == 12:  # PINGREQ
+            write(b"\xd0\x00")
+        elif kind == 14:  # DISCONNECT
+            return False
+        return True  # PUBACK from subscribers needs no bookkeeping (no redelivery)
+
+    def _route(self, topic, payload, qos):
+        self.stats["published"] += 1
+        encoded_topic = topic.encode()
+        for session in list(self._sessions):
+            if session.writer.is_closing():
+                continue
+            granted = [q for f, q in session.subs.items() if mqtt.topic_matches_sub(f, topic)]
+            if not granted:
+                continue
+            out_qos = min(qos, max(granted))
+            var = struct.pack("!H", len(encoded_topic)) + encoded_topic
+            if out_qos:
+                session.next_mid = session.next_mid % 65535 + 1
+                var += struct.pack("!H", session.next_mid)
+            session.writer.write(bytes([0x30 | out_qos << 1]) + _mqtt_len(len(var) + len(payload)) + var + payload)
+            self.stats["delivered"] += 1
+
+
+def create_client(client_id, tls=True):
+    """paho client with the simulator's callbacks and connection settings"""
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, clean_session=False)  # Changed to False
     client.username_pw_set(USERNAME, PASSWORD)
     
-    
-    client.tls_set()
-    client.tls_insecure_set(False) 
+    if tls:
+        client.tls_set()
+        client.tls_insecure_set(False) 
     client.max_inflight_messages_set(20) # Set keepalive and other connection parameters
     client.max_queued_messages_set(0)
     
@@ -553,11 +4387,41 @@ def main():
     
     # Enable reconnection
     client.reconnect_delay_set(min_delay=1, max_delay=60)
+    return client
+
+
+def main(broker=BROKER, port=PORT, tls=True):
+    global client
+    
+    log_message("Initializing Fake RPI Simulator...")
+    log_message(f"Broker: {broker}:{port}{'' if tls else ' (no TLS)'}")
+    log_message(f"Username: {USERNAME}")
+    log_message(f"Listening on: {TEST_PUB_TOPIC}")
+    log_message(f"Publishing to: {TEST_SUB_TOPIC}")
+    log_message(f"Confirmation topic: {CONFIRMATION_TOPIC}")
+    log_message(f"Orchestrator: {ORCHESTRATOR_MODE}")
+    start_metrics_server()
+    
+    # Create a more stable client ID based on machine info
+    import platform
+    import hashlib
+    
+    machine_info = f"{platform.node()}-{platform.system()}"
+    client_id_hash = hashlib.md5(machine_info.encode()).hexdigest()[:8]
+    client_id = f"ur2-rpi-{client_id_hash}"
+    log_message(f"Client ID: {client_id}")
+    
+    client = create_client(client_id, tls)
+    get_outbox()  # anything spooled by the last run replays once connected
+    get_archive()
+    resumed = resume_tests()  # state updates are spooled until the connection is up
+    if resumed:
+        log_message(f"Resumed {resumed} unfinished tests from {CHECKPOINT_PATH}")
     
     try:
         # Connect to broker with longer keepalive
-        log_message("Connecting to HiveMQ Cloud...")
-        client.connect(BROKER, PORT, 120) 
+        log_message(f"Connecting to {broker}...")
+        client.connect(broker, port, 120) 
         
         # Start the loop
         log_message("Starting MQTT loop... Press Ctrl+C to stop")
@@ -569,21 +4433,839 @@ def main():
         try:
             # Fallback: Try with less strict TLS
             client.tls_insecure_set(True)
-            client.connect(BROKER, PORT, 120)
+            client.connect(broker, port, 120)
             client.loop_forever()
         except Exception as fallback_err:
             log_message(f"Fallback connection failed: {fallback_err}")
             
     except KeyboardInterrupt:
         log_message("Stopping RPI simulator...")
+        journal.freeze()  # running tests resume on the next start
         
-        for test_id in list(active_tests.keys()): # Stop all active tests
-            del active_tests[test_id]
+        for test_id in active_tests.ids(): # Stop all active tests
+            active_tests.remove(test_id)
+            confirmations.cancel(test_id)
+        if orchestrator:
+            orchestrator.stop()
+        status_publisher.flush()
+        log_message(f"Status publishing: {status_publisher.snapshot()}")
+        log_message(f"Outbox: {get_outbox().snapshot()}")
         client.disconnect()
         log_message("RPI simulator stopped")
         
     except Exception as e:
         log_message(f"Error: {str(e)}")
 
+    finally:
+        logger.flush()  # every exit path, or the buffered tail of the log is lost
+
+###################################
+# fleet mode
+
+
+def device_topic(device_id, topic):
+    """ur2/test/... -> FLEET_TOPIC_ROOT/<device_id>/test/..."""
+    return f"{FLEET_TOPIC_ROOT}/{device_id}/{topic.split('/', 1)[1]}"
+
+
+class VirtualDevice:
+    """
+    One simulated RPi in fleet mode. Its paho client has no network thread:
+    the fleet's event loop reads and writes its socket, and its tests run
+    as coroutines on that same loop.
+    """
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.loop = fleet.loop
+        self.device_id = f"{FLEET_CLIENT_PREFIX}{index:04d}"
+        self.command_topic = device_topic(self.device_id, TEST_PUB_TOPIC)
+        self.confirm_topic = device_topic(self.device_id, CONFIRMATION_TOPIC)
+        self.status_topic = device_topic(self.device_id, TEST_SUB_TOPIC)
+        self.list_topic = device_topic(self.device_id, TEST_LIST_TOPIC)
+        self.tests = TestRegistry(stripes=1)
+        self._tasks = {}    # test_id -> asyncio.Task
+        self._confirm = {}  # test_id -> future answered by the user (or auto-confirm)
+        self._fd = None
+        self.connected = False
+        self.backoff = 1.0
+        self.next_auto_start = 0.0
+        self.started = 0
+
+        self.client = fleet.make_client(self.device_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.on_socket_open = self._socket_open
+        self.client.on_socket_close = self._socket_close
+        self.client.on_socket_register_write = self._register_write
+        self.client.on_socket_unregister_write = self._unregister_write
+
+    # socket callbacks: connect() runs in the executor, everything else on the loop
+    def _on_loop(self, fn, *args):
+        if self.fleet.in_loop():
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _socket_open(self, client, userdata, sock):
+        self._fd = sock.fileno()
+        self._on_loop(self.loop.add_reader, self._fd, self._readable)
+
+    def _socket_close(self, client, userdata, sock):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            self._on_loop(self.loop.remove_reader, fd)
+            self._on_loop(self.loop.remove_writer, fd)
+
+    def _register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock.fileno(), self.client.loop_write)
+
+    def _unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock.fileno())
+
+    def _readable(self):
+        self.client.loop_read()
+        # TLS may have decrypted more than one packet; the fd won't signal for those
+        sock = self.client.socket()
+        while sock is not None and getattr(sock, "pending", None) and sock.pending():
+            self.client.loop_read()
+            sock = self.client.socket()
+
+    def drop_connection(self):
+        """Failure injection: kill the socket without a DISCONNECT, like a network drop"""
+        sock = self.client.socket()
+        if sock is None:
+            return
+        self.fleet.stats["injected_disconnects"] += 1
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.fleet.stats["connect_refused"] += 1
+            log_message(f"Fleet: {self.device_id} refused by broker (rc={rc})", rate_key="fleet_connect")
+            return
+        self.connected = True
+        self.backoff = 1.0
+        self.fleet.stats["connects"] += 1
+        client.subscribe([(self.command_topic, 1), (self.confirm_topic, 1)])
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0 and not self.fleet.stopping:
+            self.fleet.stats["disconnects"] += 1
+            self.fleet.reconnect(self)
+
+    def on_message(self, client, userdata, msg):
+        try:
+            data = json.loads(msg.payload.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            log_message(f"Fleet: {self.device_id} invalid JSON on {msg.topic}", rate_key="fleet_message")
+            return
+        test_id = data.get("testId")
+        if msg.topic == self.confirm_topic:
+            fut = self._confirm.get(test_id)
+            if fut is not None and not fut.done():
+                fut.set_result(bool(data.get("confirmed", False)))
+            return
+        command = data.get("command")
+        if command == "start" and test_id:
+            self.start(test_id)
+        elif command == "stop" and test_id:
+            record = self.tests.remove(test_id)
+            if record is not None:
+                record.status = "stopped"
+                task = self._tasks.pop(test_id, None)
+                if task is not None:
+                    task.cancel()
+                self.pub(test_id, run_status="stopped", message="Test stopped by user")
+        elif command == "list":
+            tests = self.tests.snapshots()
+            client.publish(self.list_topic, json.dumps({"timestamp": now_iso(), "count": len(tests), "tests": tests}))
+
+    def start(self, test_id, max_cycles=5):
+        if self.tests.add(test_id) is None:
+            self.pub(test_id, run_status="already_running")
+            return
+        self.started += 1
+        self._tasks[test_id] = self.loop.create_task(self.run_test(test_id, max_cycles))
+
+    def pub(self, test_id, **fields):
+        payload = {"testId": test_id, "timestamp": now_iso(), **fields}
+        self.tests.note_status(payload)
+        qos = STATUS_PRIORITY_QOS if fields.get("run_status") in PRIORITY_STATUSES else STATUS_QOS
+        self.client.publish(self.status_topic, json.dumps(payload), qos=qos)
+        self.fleet.stats["published"] += 1
+
+    async def _stage(self, name, cycle=None):
+        rng = self.fleet.random
+        seconds = FLEET_STAGE_SECONDS.get(name, SIMULATED_SCRIPT_SECONDS)
+        await asyncio.sleep(seconds * (1 + rng.uniform(-FLEET_STAGE_JITTER, FLEET_STAGE_JITTER)))
+        if rng.random() < FLEET_DISCONNECT_RATE:
+            self.drop_connection()
+        if rng.random() < FLEET_FAILURE_RATE:
+            self.fleet.stats["injected_failures"] += 1
+            raise RuntimeError(f"injected failure in {name}" + (f" (cycle {cycle})" if cycle else ""))
+
+    async def _confirmation(self, test_id, cycle):
+        fut = self.loop.create_future()
+        self._confirm[test_id] = fut
+        self.pub(test_id,
+            run_status="waiting_confirmation",
+            message=f"Cycle {cycle}/5 completed",
+            cycle=cycle)
+        if FLEET_CONFIRM_SECONDS is not None:
+            self.loop.call_later(FLEET_CONFIRM_SECONDS, lambda: fut.done() or fut.set_result(True))
+        try:
+            return await asyncio.wait_for(fut, CONFIRMATION_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._confirm.pop(test_id, None)
+
+    async def run_test(self, test_id, max_cycles=5):
+        """The simulate_test_process stage sequence with fleet durations and failure injection"""
+        record = self.tests.get(test_id)
+        stats = self.fleet.stats
+        stats["tests_started"] += 1
+        self.pub(test_id, run_status="started", run_stage=0)
+        try:
+            await self._stage("prepare")
+            self.pub(test_id, run_status="running", run_stage=1)
+            for cycle in range(1, max_cycles + 1):
+                self.pub(test_id, run_status="cycle_start", cycle=cycle, run_stage=2)
+
+                async def run_step(step_name, cycle=cycle):
+                    await self._stage(step_name, cycle)
+                    self.pub(test_id, run_status="running", run_stage=STAGE_NUMBERS[step_name], cycle=cycle)
+
+                await run_cycle_stages_async(run_step)
+                if not await self._confirmation(test_id, cycle):
+                    self.pub(test_id,
+                        run_status="failed",
+                        message=f"test interrupted after cycle {cycle}",
+                        run_stage=5,
+                        cycle=cycle)
+                    stats["tests_failed"] += 1
+                    return
+            self.pub(test_id, run_status="completed", run_stage=len(PROCESS_STAGES), cycle=None)
+            stats["tests_completed"] += 1
+        except asyncio.CancelledError:
+            stats["tests_stopped"] += 1  # "stopped" was published by the stop command
+        except Exception as e:
+            stats["tests_errored"] += 1
+            self.pub(test_id, run_status="error", message=str(e))
+        finally:
+            if self._tasks.get(test_id) is asyncio.current_task():
+                del self._tasks[test_id]
+            self.tests.remove(test_id, record)
+
+    def cancel_tests(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+
+class Fleet:
+    """
+    N VirtualDevices sharing one event loop (all sockets and test coroutines),
+    one TLS context, one small connect pool and one keepalive task, instead
+    of a network thread and an SSL context per client.
+    """
+
+    def __init__(self, n_devices, host=BROKER, port=PORT, tls=True, username=USERNAME, password=PASSWORD):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_WORKERS, thread_name_prefix="ur2-fleet"))
+        self.host, self.port = host, port
+        self.username, self.password = username, password
+        self._ssl_context = ssl.create_default_context() if tls else None
+        self.stats = collections.Counter()
+        self.random = random.Random(FLEET_SEED)
+        self.stopping = False
+        self._loop_thread = None
+        self.devices = [VirtualDevice(self, i) for i in range(1, n_devices + 1)]
+
+    def in_loop(self):
+        return threading.get_ident() == self._loop_thread
+
+    def make_client(self, client_id):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, clean_session=True)
+        if self.username:
+            client.username_pw_set(self.username, self.password)
+        if self._ssl_context is not None:
+            client.tls_set_context(self._ssl_context)
+        client.max_inflight_messages_set(20)
+        return client
+
+    async def _connect(self, device, delay=0.0):
+        if delay:
+            await asyncio.sleep(delay)
+        if self.stopping:
+            return
+        try:
+            await self.loop.run_in_executor(None, device.client.connect, self.host, self.port, 60)
+        except OSError as e:  # includes ssl.SSLError
+            self.stats["connect_errors"] += 1
+            log_message(f"Fleet: {device.device_id} connect failed: {e}", rate_key="fleet_connect")
+            self.reconnect(device)
+
+    def reconnect(self, device):
+        """Retry with per-device exponential backoff (paho only does this in its own loop)"""
+        delay, device.backoff = device.backoff, min(device.backoff * 2, 60.0)
+        self.loop.create_task(self._connect(device, delay * (0.5 + self.random.random())))
+
+    async def _keepalive(self):
+        while True:
+            for device in self.devices:
+                if device.client.socket() is not None:
+                    device.client.loop_misc()
+            await asyncio.sleep(1)
+
+    async def _auto_start(self):
+        while True:
+            now = time.monotonic()
+            for device in self.devices:
+                if device.connected and not len(device.tests) and now >= device.next_auto_start:
+                    device.next_auto_start = now + FLEET_AUTO_START_SECONDS
+                    device.start(f"{device.device_id}-{device.started + 1}")
+            await asyncio.sleep(1)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(FLEET_STATS_SECONDS)
+            log_message(f"Fleet: {self.snapshot()}")
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats["devices"] = len(self.devices)
+        stats["connected"] = sum(d.connected for d in self.devices)
+        stats["active_tests"] = sum(len(d.tests) for d in self.devices)
+        return stats
+
+    async def run(self, duration=None):
+        """Connect every device (rate-limited) and serve until duration elapses or cancelled"""
+        self._loop_thread = threading.get_ident()
+        background = [self.loop.create_task(self._keepalive()), self.loop.create_task(self._report())]
+        if FLEET_AUTO_START_SECONDS:
+            background.append(self.loop.create_task(self._auto_start()))
+        for i, device in enumerate(self.devices):
+            self.loop.create_task(self._connect(device, i / FLEET_CONNECTS_PER_SECOND))
+        try:
+            if duration is None:
+                await asyncio.Event().wait()
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            for task in background:
+                task.cancel()
+
+    async def shutdown(self, timeout=5.0):
+        """Cancel tests, send DISCONNECT from every device and wait for the sockets to close"""
+        self._loop_thread = threading.get_ident()
+        self.stopping = True
+        for device in self.devices:
+            device.cancel_tests()
+            if device.client.socket() is not None:
+                device.client.disconnect()
+        deadline = time.monotonic() + timeout
+        while any(d.client.socket() is not None for d in self.devices) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+def run_fleet(n_devices, broker=None):
+    """
+    Simulate n_devices RPis until Ctrl+C. broker = "host:port" for a plain
+    TCP broker without credentials, default is BROKER over TLS.
+    """
+    if broker:
+        host, _, port = broker.rpartition(":")
+        fleet = Fleet(n_devices, host, int(port), tls=False, username=None)
+    else:
+        fleet = Fleet(n_devices)
+    log_message(f"Fleet: {n_devices} devices -> {fleet.host}:{fleet.port}, "
+                f"topics {device_topic(FLEET_CLIENT_PREFIX + '<n>', TEST_PUB_TOPIC)} ...")
+    metrics.gauge("ur2_fleet", lambda: {(("counter", k),): v for k, v in fleet.snapshot().items()},
+                  "Fleet mode devices, tests and connection events")
+    start_metrics_server()
+    try:
+        fleet.loop.run_until_complete(fleet.run())
+    except KeyboardInterrupt:
+        log_message("Stopping fleet...")
+    finally:
+        fleet.loop.run_until_complete(fleet.shutdown())
+        log_message(f"Fleet stopped: {fleet.snapshot()}")
+        fleet.loop.close()
+        logger.flush()
+
+
+###################################
+# benchmarks
+
+
+class _BenchInfo:
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+    def is_published(self):
+        return True
+
+
+class _BenchClient:
+    """Stand-in for the paho client that only counts publishes"""
+
+    def __init__(self):
+        self.published = 0
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        return _BenchInfo()
+
+
+def _auto_confirm(stop_event, interval=0.01):
+    """Answer every pending confirmation with yes (benchmark only)"""
+    while not stop_event.is_set():
+        with confirmations._lock:
+            waiting = list(confirmations._pending.values())
+        for entry in waiting:
+            confirmations.resolve(entry.test_id, True, cycle=entry.cycle)
+        time.sleep(interval)
+
+
+def benchmark_orchestrators(n_tests=200, max_cycles=2, script_seconds=0.05):
+    """
+    Run n_tests simulated tests through the threaded and the asyncio
+    orchestrator and compare wall time, peak threads and peak Python memory.
+    Heat is disabled so both runs measure only the stage pipeline.
+    """
+    import contextlib
+    import io
+    import tracemalloc
+
+    global client, ORCHESTRATOR_MODE, SIMULATED_SCRIPT_SECONDS, SIMULATE_HEAT, orchestrator, outbox, journal
+    global resource_scheduler, archive
+    saved = (client, ORCHESTRATOR_MODE, SIMULATED_SCRIPT_SECONDS, SIMULATE_HEAT, outbox, journal, resource_scheduler,
+             archive)
+    outbox = Outbox(None)  # bench statuses, checkpoints and history stay in memory
+    journal = TestJournal(None)
+    archive = RunArchive(None)
+    # one unit of each instrument per test, or the bench measures the pumps queue
+    resource_scheduler = ResourceScheduler({name: n_tests for name in RESOURCES}, notify=_publish_queue_position)
+    SIMULATED_SCRIPT_SECONDS = script_seconds
+    SIMULATE_HEAT = False
+    results = {}
+
+    try:
+        for mode in ("thread", "asyncio"):
+            ORCHESTRATOR_MODE = mode
+            capture_pipeline.join()  # the previous mode's frames are not this one's publishes
+            client = _BenchClient()
+            active_tests.clear()
+            stop = threading.Event()
+            confirmer = threading.Thread(target=_auto_confirm, args=(stop,), daemon=True)
+            confirmer.start()
+            base_threads = threading.active_count()
+            peak_threads = base_threads
+
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()) as sink:
+                for i in range(n_tests):
+                    test_id = f"bench-{mode}-{i}"
+                    active_tests.add(test_id)
+                    start_test(test_id, max_cycles)
+                while len(active_tests):
+                    peak_threads = max(peak_threads, threading.active_count())
+                    time.sleep(0.01)
+                    sink.seek(0)
+                    sink.truncate()
+                capture_pipeline.join()  # a test is done when its frames are out
+                logger.flush()
+            elapsed = time.perf_counter() - t0
+            _, peak_mem = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stop.set()
+            confirmer.join()
+            if orchestrator:
+                orchestrator.stop()
+                orchestrator = None
+
+            results[mode] = {
+                "wall_s": elapsed,
+                "extra_threads": peak_threads - base_threads,
+                "peak_kib": peak_mem / 1024,
+                "published": client.published,
+            }
+    finally:
+        client, ORCHESTRATOR_MODE, SIMULATED_SCRIPT_SECONDS, SIMULATE_HEAT, outbox, journal, resource_scheduler, archive = saved
+
+    print(f"{n_tests} tests x {max_cycles} cycles, {script_seconds}s per script")
+    print(f"{'mode':<8} {'wall_s':>8} {'threads':>8} {'peak_KiB':>10} {'publishes':>10}")
+    for mode, r in results.items():
+        print(f"{mode:<8} {r['wall_s']:>8.2f} {r['extra_threads']:>8} {r['peak_kib']:>10.0f} {r['published']:>10}")
+    return results
+
+
+def benchmark_status_encoding(n=50000):
+    """Encode/decode cost and payload size of each status format vs json.dumps"""
+    samples = [
+        {"testId": "trial_20240101_0042", "timestamp": now_iso(), "run_status": "running", "run_stage": 3, "cycle": 2},
+        {"testId": "trial_20240101_0042", "timestamp": now_iso(), "run_status": "waiting_confirmation",
+         "message": "Cycle 2/5 completed", "cycle": 2},
+        {"testId": "trial_20240101_0042", "timestamp": now_iso(), "run_status": "completed", "run_stage": 5, "cycle": None},
+    ]
+    formats = ["json"] + [f for f in STATUS_FORMATS if f == "struct" or _load_codec(f)]
+    print(f"{n} encodes/decodes per format over {len(samples)} sample payloads")
+    print(f"{'format':<8} {'enc_us':>8} {'dec_us':>8} {'avg_bytes':>10}")
+    results = {}
+    for fmt in formats:
+        encoded = [encode_status(p, fmt) for p in samples]
+        t0 = time.perf_counter()
+        for i in range(n):
+            encode_status(samples[i % len(samples)], fmt)
+        enc = (time.perf_counter() - t0) / n * 1e6
+        t0 = time.perf_counter()
+        for i in range(n):
+            decode_status(encoded[i % len(encoded)], fmt)
+        dec = (time.perf_counter() - t0) / n * 1e6
+        size = sum(len(e) for e in encoded) / len(encoded)
+        results[fmt] = {"encode_us": enc, "decode_us": dec, "avg_bytes": size}
+        print(f"{fmt:<8} {enc:>8.2f} {dec:>8.2f} {size:>10.1f}")
+    missing = [f for f in STATUS_FORMATS if f not in formats]
+    if missing:
+        print(f"(not installed: {', '.join(missing)})")
+    return results
+
+
+def benchmark_heat(n_heaters=500, seconds=2.0):
+    """Start n simulated heaters, report start latency and memory per heater"""
+    import contextlib
+    import io
+    import tracemalloc
+
+    controller = HeatController()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        heaters = [controller.start(f"bench-{i}") for i in range(n_heaters)]
+        start_s = time.perf_counter() - t0
+        time.sleep(seconds)
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        t0 = time.perf_counter()
+        for heater in heaters:
+            controller.stop(heater)
+        stop_s = time.perf_counter() - t0
+        logger.flush()
+    print(f"{n_heaters} heaters: start {start_s / n_heaters * 1e6:.0f}us each, "
+          f"stop {stop_s / n_heaters * 1e6:.0f}us each, ~{used / n_heaters:.0f} B each, "
+          f"threads={threading.active_count()}")
+    return {"start_us": start_s / n_heaters * 1e6, "stop_us": stop_s / n_heaters * 1e6,
+            "bytes_per_heater": used / n_heaters}
+
+
+def benchmark_heat_replay(n_heaters=100, hours=1.0):
+    """Replay an hour-long ramp/hold/cool profile for n heaters, report speedup over real time"""
+    seconds = hours * 3600
+    profile = [(seconds * 0.1, 40.0), (seconds * 0.6, HEAT_SETPOINT_C), (seconds * 0.3, HEAT_AMBIENT_C)]
+    t0 = time.perf_counter()
+    out = replay_heat_profiles([profile] * n_heaters, dt=1.0, sample_every=300.0)
+    elapsed = time.perf_counter() - t0
+    backend = "numpy" if _load_numpy() else "python"
+    print(f"{n_heaters} heaters x {hours:g}h replayed in {elapsed:.2f}s ({backend}), "
+          f"{seconds / elapsed:.0f}x real time")
+    for t, temps in zip(out["t"], out["temp"]):
+        print(f"  t={t / 60:5.0f}min  temp={temps[0]:.1f}C")
+    return {"wall_s": elapsed, "speedup": seconds / elapsed}
+
+
+class _LoadDriver:
+    """
+    Frontend stand-in for benchmark_load: sends start/confirm/stop commands
+    over MQTT and times each one to the first status it causes. Every test
+    is held at its first confirmation until release(), so all of them are
+    active at once for the memory measurement.
+    """
+
+    def __init__(self, broker, n_tests, seed):
+        rng = random.Random(seed)
+        self.n_tests = n_tests
+        self.plans = {}  # test_id -> ("confirm" | "decline" | "stop", at cycle)
+        for i in range(n_tests):
+            roll = rng.random()
+            action = "confirm" if roll < 0.7 else "decline" if roll < 0.85 else "stop"
+            self.plans[f"load-{seed}-{i}"] = (action, rng.randint(1, 5))
+        self.sent = {}  # test_id -> (command, perf_counter when sent)
+        self.latencies = {"start": [], "confirm": [], "stop": []}
+        self.commands = 0
+        self.statuses = 0
+        self.held = []
+        self.finished = set()
+        self.all_waiting = threading.Event()
+        self.all_done = threading.Event()
+        self._lock = threading.Lock()
+        self.client_id = f"ur2-bench-driver-{seed}"
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=self.client_id)
+        self.client.on_message = self._on_message
+        self.client.connect(broker.host, broker.port, 60)
+        self.client.subscribe(TEST_SUB_TOPIC, qos=1)
+        self.client.loop_start()
+        broker.wait_subscribed(self.client_id, TEST_SUB_TOPIC)
+
+    def _send(self, test_id, command, topic, payload):
+        with self._lock:
+            self.sent[test_id] = (command, time.perf_counter())
+            self.commands += 1
+        self.client.publish(topic, json.dumps(payload), qos=1)
+
+    def _answer(self, test_id, cycle):
+        action, at = self.plans[test_id]
+        if action == "stop" and cycle >= at:
+            self._send(test_id, "stop", TEST_PUB_TOPIC, {"command": "stop", "testId": test_id})
+        else:
+            confirmed = not (action == "decline" and cycle >= at)
+            self._send(test_id, "confirm", CONFIRMATION_TOPIC, {"testId": test_id, "confirmed": confirmed})
+
+    def _on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+        payload = json.loads(msg.payload)
+        test_id = payload.get("testId")
+        status = payload.get("run_status")
+        with self._lock:
+            self.statuses += 1
+            pending = self.sent.pop(test_id, None)
+            if pending is not None:
+                self.latencies[pending[0]].append(now - pending[1])
+            if test_id in self.finished or test_id not in self.plans:
+                return
+            if status in TERMINAL_STATUSES:
+                self.finished.add(test_id)
+                if len(self.finished) == self.n_tests:
+                    self.all_done.set()
+                return
+            if status != "waiting_confirmation":
+                return
+            if payload.get("cycle") == 1:
+                self.held.append(test_id)
+                if len(self.held) == self.n_tests:
+                    self.all_waiting.set()
+                return
+        self._answer(test_id, payload.get("cycle"))
+
+    def start_all(self):
+        for test_id in self.plans:
+            self._send(test_id, "start", TEST_PUB_TOPIC, {"command": "start", "testId": test_id})
+
+    def release(self):
+        for test_id in list(self.held):
+            self._answer(test_id, 1)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def _rss_bytes():
+    """Resident set size from /proc (None where unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _load_pass(broker, n_tests, seed, measure_memory, timeout):
+    import tracemalloc
+
+    driver = _LoadDriver(broker, n_tests, seed)
+    out = {}
+    if measure_memory:
+        rss0 = _rss_bytes()
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    driver.start_all()
+    if not driver.all_waiting.wait(timeout):
+        log_message(f"Load benchmark: only {len(driver.held)}/{n_tests} tests reached the first confirmation")
+    if measure_memory:
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss1 = _rss_bytes()
+        out["bytes_per_test"] = used / n_tests
+        out["rss_per_test"] = (rss1 - rss0) / n_tests if rss0 is not None else None
+    driver.release()
+    if not driver.all_done.wait(timeout):
+        log_message(f"Load benchmark: only {len(driver.finished)}/{n_tests} tests finished in time")
+    out["wall_s"] = time.perf_counter() - t0
+    driver.close()
+    out["finished"] = len(driver.finished)
+    out["commands"] = driver.commands
+    out["statuses"] = driver.statuses
+    out["latencies"] = driver.latencies
+    deadline = time.monotonic() + timeout
+    while len(active_tests) and time.monotonic() < deadline:
+        time.sleep(0.01)  # stopped tests still unwind after their terminal status
+    return out
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {"count": len(samples), "p50_ms": pick(0.50), "p95_ms": pick(0.95),
+            "p99_ms": pick(0.99), "max_ms": samples[-1] * 1000}
+
+
+# metric -> True if higher is better
+_LOAD_METRICS = {
+    "latency.start.p95_ms": False,
+    "latency.confirm.p95_ms": False,
+    "latency.stop.p95_ms": False,
+    "commands_per_s": True,
+    "statuses_per_s": True,
+    "bytes_per_test": False,
+}
+
+
+def _load_metric(result, path):
+    value = result
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def _compare_load_history(result, path=LOAD_BENCH_HISTORY, tolerance=LOAD_BENCH_TOLERANCE):
+    """Print deltas against the last run with the same params, then append this run"""
+    previous = None
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("params") == result["params"]:
+                    previous = entry
+    regressions = []
+    if previous is not None:
+        print(f"vs {previous['timestamp']}:")
+        for name, higher_better in _LOAD_METRICS.items():
+            old, new = _load_metric(previous, name), _load_metric(result, name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_better else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            if flag:
+                regressions.append(name)
+            print(f"  {name:<24} {old:>10.2f} -> {new:>10.2f} ({change:+.0%}){flag}")
+    if path:
+        with open(path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    return regressions
+
+
+def benchmark_load(n_tests=200, script_seconds=0.01, mode="thread", seed=1, timeout=120):
+    """
+    End-to-end load test through an embedded LocalBroker. A driver client
+    sends start/confirm/stop commands that reach on_message over MQTT and
+    times each to the first run_status it causes. Pass 1 measures latency
+    and throughput, pass 2 repeats it under tracemalloc for memory per
+    active test. Results are appended to LOAD_BENCH_HISTORY and compared
+    with the last run that used the same parameters.
+    """
+    import contextlib
+    import io
+    import platform
+
+    global client, ORCHESTRATOR_MODE, SIMULATED_SCRIPT_SECONDS, SIMULATE_IMAGES, orchestrator, outbox, journal
+    global MAX_CONCURRENT_TESTS, COMMAND_RATE_LIMITS, resource_scheduler, archive
+    saved = (client, ORCHESTRATOR_MODE, SIMULATED_SCRIPT_SECONDS, SIMULATE_IMAGES, outbox, journal,
+             MAX_CONCURRENT_TESTS, COMMAND_RATE_LIMITS, resource_scheduler, archive)
+    outbox = Outbox(None)  # bench statuses, checkpoints and history stay in memory
+    journal = TestJournal(None)
+    archive = RunArchive(None)
+    # measure the pipeline, not admission control; every test is held at its first
+    # confirmation, so each needs its own heater
+    MAX_CONCURRENT_TESTS, COMMAND_RATE_LIMITS = n_tests, {}
+    resource_scheduler = ResourceScheduler({name: n_tests for name in RESOURCES}, notify=_publish_queue_position)
+    SIMULATED_SCRIPT_SECONDS = script_seconds
+    SIMULATE_IMAGES = False  # control plane only, image payloads would dominate
+    ORCHESTRATOR_MODE = mode
+    params = {"n_tests": n_tests, "script_seconds": script_seconds, "mode": mode, "seed": seed}
+
+    broker = LocalBroker(port=0).start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            client = create_client("ur2-bench-rpi", tls=False)
+            client.connect(broker.host, broker.port, 60)
+            client.loop_start()
+            broker.wait_subscribed("ur2-bench-rpi", CONFIRMATION_TOPIC)
+            timing = _load_pass(broker, n_tests, seed, False, timeout)
+            memory = _load_pass(broker, n_tests, seed + 1, True, timeout)
+            client.loop_stop()
+            client.disconnect()
+            if orchestrator:
+                orchestrator.stop()
+                orchestrator = None
+            logger.flush()
+    finally:
+        broker.stop()
+        (client, ORCHESTRATOR_MODE, SIMULATED_SCRIPT_SECONDS, SIMULATE_IMAGES, outbox, journal,
+         MAX_CONCURRENT_TESTS, COMMAND_RATE_LIMITS, resource_scheduler, archive) = saved
+
+    result = {
+        "timestamp": now_iso(),
+        "params": params,
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "finished": timing["finished"],
+        "wall_s": round(timing["wall_s"], 3),
+        "commands_per_s": timing["commands"] / timing["wall_s"],
+        "statuses_per_s": timing["statuses"] / timing["wall_s"],
+        "latency": {cmd: _percentiles(v) for cmd, v in timing["latencies"].items()},
+        "bytes_per_test": memory["bytes_per_test"],
+        "rss_per_test": memory["rss_per_test"],
+    }
+
+    print(f"{n_tests} tests ({mode}), {script_seconds}s per script: "
+          f"{result['finished']}/{n_tests} finished in {result['wall_s']:.2f}s")
+    print(f"{'command':<8} {'count':>6} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'max_ms':>8}")
+    for cmd, p in result["latency"].items():
+        if p["count"]:
+            print(f"{cmd:<8} {p['count']:>6} {p['p50_ms']:>8.1f} {p['p95_ms']:>8.1f} "
+                  f"{p['p99_ms']:>8.1f} {p['max_ms']:>8.1f}")
+    rss = result["rss_per_test"]
+    print(f"throughput: {result['commands_per_s']:.0f} commands/s, {result['statuses_per_s']:.0f} statuses/s")
+    print(f"memory per active test: {result['bytes_per_test'] / 1024:.1f} KiB Python heap"
+          + (f", {rss / 1024:.1f} KiB RSS" if rss is not None else ""))
+    result["regressions"] = _compare_load_history(result)
+    return result
+
+
+BENCHMARKS = {
+    "replay": benchmark_heat_replay,
+    "heat": benchmark_heat,
+    "orchestrator": benchmark_orchestrators,
+    "encoding": benchmark_status_encoding,
+    "load": benchmark_load,
+}
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python OLD_enhanced_fake_rpi.py --bench orchestrator [n_tests]
+    # python OLD_enhanced_fake_rpi.py --fleet 200 [localhost:1883]
+    if len(sys.argv) > 2 and sys.argv[1] == "--bench":
+        BENCHMARKS[sys.argv[2]](*[json.loads(a) for a in sys.argv[3:]])
+    elif len(sys.argv) > 2 and sys.argv[1] == "--fleet":
+        run_fleet(int(sys.argv[2]), *sys.argv[3:4])
+    elif len(sys.argv) > 1 and sys.argv[1] == "--local-broker":
+        # python OLD_enhanced_fake_rpi.py --local-broker [port]: no cloud broker, no TLS
+        local = LocalBroker(port=int(sys.argv[2]) if len(sys.argv) > 2 else LOCAL_BROKER_PORT).start()
+        main(local.host, local.port, tls=False)
+    else:
+        main()
\ No newline at end of file
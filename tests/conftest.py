@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def rpi(tmp_path_factory):
+    """
+    The simulator module, with its outbox and archive in memory and its
+    log and journal in a scratch directory instead of the working one.
+    """
+    pytest.importorskip("paho.mqtt.client")
+    sys.path.insert(0, ROOT)
+    try:
+        import OLD_enhanced_fake_rpi as module
+    finally:
+        sys.path.remove(ROOT)
+    scratch = tmp_path_factory.mktemp("rpi")
+    module.logger.path = str(scratch / "fake_rpi.log")
+    module.journal.path = str(scratch / "fake_rpi_journal.jsonl")
+    module.outbox = module.Outbox(None)
+    module.archive = module.RunArchive(None)
+    return module
+
+
+class FakeInfo:
+    rc = 0
+
+    def is_published(self):
+        return True
+
+
+class FakeClient:
+    """Stand-in for the paho client that records publishes"""
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.published = []
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return FakeInfo()
+
+
+@pytest.fixture
+def fake_client(rpi, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(rpi, "client", client)
+    return client
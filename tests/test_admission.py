@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def dispatcher(rpi, monkeypatch):
+    """handle_message with fresh test state; returns (statuses sent, tests started)"""
+    statuses, started = [], []
+    monkeypatch.setattr(rpi, "active_tests", rpi.TestRegistry())
+    monkeypatch.setattr(rpi, "command_ingest", rpi.CommandIngest())
+    monkeypatch.setattr(rpi, "COMMAND_RATE_LIMITS", {})
+    monkeypatch.setattr(rpi, "pub", lambda test_id, **fields: statuses.append((test_id, fields.get("run_status"))))
+    monkeypatch.setattr(rpi, "start_test", lambda test_id, *args, **kwargs: started.append(test_id))
+    return statuses, started
+
+
+def start(rpi, test_id):
+    rpi.handle_message(rpi.TEST_PUB_TOPIC, json.dumps({"command": "start", "testId": test_id}))
+
+
+def test_start_admitted(rpi, dispatcher):
+    statuses, started = dispatcher
+    start(rpi, "T1")
+    assert started == ["T1"]
+    assert "T1" in rpi.active_tests
+    assert statuses == []
+
+
+def test_duplicate_start_already_running(rpi, dispatcher):
+    statuses, started = dispatcher
+    start(rpi, "T1")
+    start(rpi, "T1")
+    assert started == ["T1"]
+    assert statuses == [("T1", "already_running")]
+
+
+def test_busy_at_max_concurrent_tests(rpi, dispatcher, monkeypatch):
+    statuses, started = dispatcher
+    monkeypatch.setattr(rpi, "MAX_CONCURRENT_TESTS", 2)
+    for test_id in ("T1", "T2", "T3"):
+        start(rpi, test_id)
+    assert started == ["T1", "T2"]
+    assert statuses == [("T3", "busy")]
+    assert "T3" not in rpi.active_tests
+
+
+def test_busy_when_start_rate_exceeded(rpi, dispatcher, monkeypatch):
+    statuses, started = dispatcher
+    monkeypatch.setattr(rpi, "COMMAND_RATE_LIMITS", {"start": (0.001, 2)})
+    for test_id in ("T1", "T2", "T3"):
+        start(rpi, test_id)
+    assert started == ["T1", "T2"]
+    assert statuses == [("T3", "busy")]
+
+
+def test_full_ingest_queue_drops_without_blocking(rpi, monkeypatch):
+    ingest = rpi.CommandIngest(maxsize=1)
+    monkeypatch.setattr(ingest, "_start", lambda: None)  # no dispatcher, the queue stays full
+    assert ingest.submit(rpi.TEST_PUB_TOPIC, b"{}")
+    assert not ingest.submit(rpi.TEST_PUB_TOPIC, b"{}")
+    assert ingest.depth() == 1
+
+
+def test_start_replies_leave_running_test_status(rpi):
+    tests = rpi.TestRegistry()
+    tests.add("T1")
+    tests.note_status({"testId": "T1", "run_status": "running", "run_stage": 2})
+    for reply in ("already_running", "busy"):
+        tests.note_status({"testId": "T1", "run_status": reply})
+    assert tests.get("T1").status == "running"
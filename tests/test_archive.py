@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+import pytest
+
+
+def _run(archive, test_id, *statuses):
+    archive.record_status({"testId": test_id, "run_status": "started", "run_stage": 0})
+    for status in statuses:
+        archive.record_status({"testId": test_id, "run_status": status, "message": f"{test_id} {status}"})
+
+
+@pytest.fixture
+def archive(rpi):
+    """T1 completed, T2 failed then stopped by the user, T3 still running; `mid` falls between T1 and T2"""
+    archive = rpi.RunArchive(None)
+    _run(archive, "T1", "completed")
+    archive.flush()
+    time.sleep(0.02)
+    archive.mid = time.time()
+    time.sleep(0.02)
+    _run(archive, "T2", "failed", "stopped")
+    _run(archive, "T3", "running")
+    archive.flush()
+    return archive
+
+
+def ids(page):
+    return [run["testId"] for run in page["runs"]]
+
+
+def test_newest_first(archive):
+    assert ids(archive.runs()) == ["T3", "T2", "T1"]
+
+
+def test_filter_by_test_and_status(archive):
+    assert ids(archive.runs(test_id="T1")) == ["T1"]
+    assert ids(archive.runs(status="running")) == ["T3"]
+    assert archive.runs(test_id="nope")["runs"] == []
+
+
+def test_user_stop_replaces_earlier_terminal_status(archive):
+    (run,) = archive.runs(test_id="T2")["runs"]
+    assert run["status"] == "stopped"
+    assert run["ended"] is not None
+    events = archive.run(run["runId"])["events"]
+    assert [e["run_status"] for e in events] == ["started", "failed", "stopped"]
+
+
+@pytest.mark.parametrize("as_text", [False, True])
+def test_since_until_epoch_seconds(archive, as_text):
+    mid = str(archive.mid) if as_text else archive.mid
+    assert ids(archive.runs(since=mid)) == ["T3", "T2"]
+    assert ids(archive.runs(until=mid)) == ["T1"]
+
+
+def test_since_iso_timestamp(archive):
+    assert ids(archive.runs(since=datetime.fromtimestamp(archive.mid).isoformat())) == ["T3", "T2"]
+
+
+def test_keyset_pagination(archive):
+    first = archive.runs(limit=2)
+    assert ids(first) == ["T3", "T2"]
+    second = archive.runs(limit=2, cursor=first["next"])
+    assert ids(second) == ["T1"]
+    assert second["next"] is None
+
+
+def test_bad_query_raises_value_error(archive):
+    with pytest.raises(ValueError):
+        archive.query({"query": "runs", "since": "yesterday"})
+    with pytest.raises(ValueError):
+        archive.query({"query": "nope"})
+
+
+@pytest.fixture
+def http(rpi, archive, monkeypatch):
+    monkeypatch.setattr(rpi, "archive", archive)
+    server = rpi.http.server.ThreadingHTTPServer(("127.0.0.1", 0), rpi._MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+def test_http_runs_filters(archive, http):
+    assert ids(get(f"{http}/runs?since=1700000000")) == ["T3", "T2", "T1"]
+    assert ids(get(f"{http}/runs?since={archive.mid}")) == ["T3", "T2"]
+    assert ids(get(f"{http}/runs?until={archive.mid}")) == ["T1"]
+    assert ids(get(f"{http}/runs?since={archive.mid}&status=stopped")) == ["T2"]
+    assert ids(get(f"{http}/runs?testId=T1")) == ["T1"]
+    page = get(f"{http}/runs?limit=1")
+    assert ids(get(f"{http}/runs?limit=1&cursor={page['next']}")) == ["T2"]
+
+
+def test_http_single_run_and_errors(archive, http):
+    run_id = archive.runs(test_id="T1")["runs"][0]["runId"]
+    assert get(f"{http}/runs/{run_id}")["run"]["status"] == "completed"
+    for path, code in (("/runs/999999", 404), ("/runs?limit=x", 400), ("/runs?since=yesterday", 400)):
+        with pytest.raises(urllib.error.HTTPError) as err:
+            get(http + path)
+        assert err.value.code == code
+
+
+def test_start_replies_not_archived(rpi):
+    archive = rpi.RunArchive(None)
+    _run(archive, "T1", "running")
+    for reply in ("already_running", "busy"):
+        archive.record_status({"testId": "T1", "run_status": reply})
+    archive.flush()
+    (run,) = archive.runs()["runs"]
+    assert run["status"] == "running"
+    assert [e["run_status"] for e in archive.run(run["runId"])["events"]] == ["started", "running"]
+
+
+def test_late_timing_lands_on_its_own_run(rpi):
+    archive = rpi.RunArchive(None)
+    archive.record_status({"testId": "T1", "run_status": "started"}, run="old")
+    archive.record_status({"testId": "T1", "run_status": "stopped"}, run="old")
+    archive.record_status({"testId": "T1", "run_status": "started"}, run="new")
+    archive.record_timing("T1", {"final_status": "stopped"}, run="old")  # the stopped run's thread finishing
+    archive.flush()
+    new, old = archive.runs(test_id="T1")["runs"]
+    assert archive.run(old["runId"])["timing"] == {"final_status": "stopped"}
+    assert archive.run(new["runId"])["timing"] is None
@@ -0,0 +1,67 @@
+import hashlib
+
+import pytest
+
+from conftest import FakeClient
+
+
+@pytest.fixture
+def transfer(rpi, tmp_path, monkeypatch):
+    """A 3-chunk image sent over a recording client; returns (client, transfer id)"""
+    client = FakeClient()
+    monkeypatch.setattr(rpi, "client", client)
+    monkeypatch.setattr(rpi, "outbox", rpi.Outbox(None))
+    monkeypatch.setattr(rpi, "image_transfers", rpi.collections.OrderedDict())
+    monkeypatch.setattr(rpi, "IMAGE_CHUNK_SIZE", 4)
+    path = tmp_path / "T1_cycle1_al.png"
+    path.write_bytes(b"0123456789")
+    transfer_id = rpi.send_img_chunked(str(path), test_id="T1", cycle=1)
+    return client, transfer_id
+
+
+def chunks(rpi, client):
+    return [rpi.CHUNK_HEADER.unpack_from(p)[1] for t, p in client.published if t == rpi.IMAGE_CHUNK_TOPIC]
+
+
+def test_manifest_then_chunks(rpi, transfer):
+    client, _ = transfer
+    assert client.published[0][0] == rpi.IMAGE_MANIFEST_TOPIC
+    assert chunks(rpi, client) == [0, 1, 2]
+    body = b"".join(p[rpi.CHUNK_HEADER.size:] for t, p in client.published if t == rpi.IMAGE_CHUNK_TOPIC)
+    assert hashlib.sha256(body).hexdigest() == hashlib.sha256(b"0123456789").hexdigest()
+
+
+def test_resend_only_valid_chunk_numbers(rpi, transfer):
+    client, transfer_id = transfer
+    client.published.clear()
+    rpi.resend_img_chunks(transfer_id, [2, "1", 7, -1, "x", None, True])
+    assert chunks(rpi, client) == [1, 2]
+
+
+def test_resend_rejects_malformed_request(rpi, transfer):
+    client, transfer_id = transfer
+    client.published.clear()
+    rpi.resend_img_chunks(transfer_id, [9, "x"])
+    rpi.resend_img_chunks(transfer_id, {"0": 1})
+    rpi.resend_img_chunks("unknown", [0])
+    assert client.published == []
+    rpi.resend_img_chunks(transfer_id)
+    assert chunks(rpi, client) == [0, 1, 2]
+
+
+def test_offline_transfer_resumes_on_reconnect(rpi, tmp_path, monkeypatch):
+    client = FakeClient(connected=False)
+    monkeypatch.setattr(rpi, "client", client)
+    monkeypatch.setattr(rpi, "outbox", rpi.Outbox(None))
+    monkeypatch.setattr(rpi, "image_transfers", rpi.collections.OrderedDict())
+    monkeypatch.setattr(rpi, "IMAGE_CHUNK_SIZE", 4)
+    path = tmp_path / "T1_cycle1_al.png"
+    path.write_bytes(b"0123456789")
+    rpi.send_img_chunked(str(path), test_id="T1", cycle=1)
+    assert client.published == []
+    assert rpi.outbox.rows == 1  # the manifest waits in the spool
+    client.connected = True
+    rpi.outbox.wake()
+    rpi.resume_img_transfers(timeout=5)
+    assert [t for t, _ in client.published] == [rpi.IMAGE_MANIFEST_TOPIC] + [rpi.IMAGE_CHUNK_TOPIC] * 3
+    assert chunks(rpi, client) == [0, 1, 2]
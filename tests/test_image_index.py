@@ -0,0 +1,97 @@
+import json
+import os
+import time
+
+import pytest
+
+
+def _touch(path, mtime):
+    with open(path, "wb") as f:
+        f.write(b"png")
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+@pytest.fixture
+def captures(tmp_path):
+    now = time.time()
+    run = _touch(tmp_path / "T1_cycle1_al.png", now - 20)
+    latest = _touch(tmp_path / "panel.png", now - 10)
+    return tmp_path, run, latest
+
+
+def test_lookup_by_filename_and_latest(rpi, captures):
+    img_dir, run, latest = captures
+    index = rpi.ImageIndex(str(img_dir))
+    assert index.lookup("T1", 1) == run
+    assert index.lookup("T1", 2) is None
+    assert index.latest() == latest
+    assert len(index) == 2
+
+
+def test_tag_links_untagged_file(rpi, captures):
+    img_dir, _, latest = captures
+    index = rpi.ImageIndex(str(img_dir))
+    assert index.tag(latest, "T2", 3)
+    assert index.lookup("T2", 3) == latest
+    assert index.tag(latest, "T2", 3)  # same run again is fine
+
+
+def test_tag_never_moves_another_runs_file(rpi, captures):
+    img_dir, run, latest = captures
+    index = rpi.ImageIndex(str(img_dir))
+    assert not index.tag(run, "T2", 1)
+    assert index.lookup("T1", 1) == run
+    assert index.lookup("T2", 1) is None
+    index.tag(latest, "T3", 1)
+    assert not index.tag(latest, "T4", 1)
+    assert index.lookup("T3", 1) == latest
+
+
+def test_new_and_removed_files_are_seen(rpi, captures):
+    img_dir, run, _ = captures
+    index = rpi.ImageIndex(str(img_dir))
+    newer = _touch(img_dir / "T5_cycle2_al.png", time.time())
+    os.remove(run)
+    assert index.latest() == newer
+    assert index.lookup("T5", 2) == newer
+    assert index.lookup("T1", 1) is None
+
+
+@pytest.fixture
+def material_dir(rpi, captures, monkeypatch):
+    img_dir = captures[0]
+    monkeypatch.setattr(rpi, "image_dir", lambda material: str(img_dir))
+    monkeypatch.setattr(rpi, "image_indexes", {})
+    return captures
+
+
+def test_find_image_fallback_does_not_retag(rpi, material_dir):
+    _, run, latest = material_dir
+    assert rpi.find_image("T1", 1, "aluminum") == run
+    assert rpi.find_image("T9", 1, "aluminum") == latest
+    assert rpi.find_image("T9", 1, "aluminum", fallback=False) == latest  # tagged by the fallback
+    assert rpi.find_image("T8", 1, "aluminum", fallback=False) is None
+
+
+def test_image_request_for_unknown_run_gets_error(rpi, material_dir, fake_client, monkeypatch):
+    monkeypatch.setattr(rpi, "outbox", rpi.Outbox(None))
+    rpi.handle_image_request({"testId": "T8", "cycle": 4, "material": "aluminum"})
+    (topic, payload), = fake_client.published
+    reply = json.loads(payload)
+    assert topic == rpi.IMAGE_TOPIC
+    assert (reply["testId"], reply["cycle"]) == ("T8", 4)
+    assert "error" in reply
+
+
+def test_image_request_served_from_memory_without_persist(rpi, material_dir, fake_client, monkeypatch):
+    monkeypatch.setattr(rpi, "outbox", rpi.Outbox(None))
+    monkeypatch.setattr(rpi, "CAPTURE_PERSIST", False)
+    monkeypatch.setattr(rpi, "IMAGE_TRANSFER_MODE", "raw")
+    monkeypatch.setattr(rpi, "capture_pipeline", rpi.CapturePipeline())
+    rpi.capture_pipeline._handle(rpi.CaptureFrame(b"frame", "T7", 2, "aluminum"))
+    fake_client.published.clear()
+    rpi.handle_image_request({"testId": "T7", "cycle": "2", "material": "aluminum"})
+    (_, meta), (raw_topic, raw) = fake_client.published
+    assert json.loads(meta)["testId"] == "T7" and "error" not in json.loads(meta)
+    assert (raw_topic, raw) == (rpi.IMAGE_TOPIC + "/raw", b"frame")
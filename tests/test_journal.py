@@ -0,0 +1,85 @@
+import pytest
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "journal.jsonl")
+
+
+def _record_two_tests(journal):
+    journal.started("T1", 3)
+    journal.stage_done("T1", "prepare")
+    journal.stage_done("T1", "aluminum", cycle=1)
+    journal.waiting("T1", 1)
+    journal.started("T2", 5)
+    journal.ended("T2")
+
+
+def test_load_returns_unfinished_tests(rpi, path):
+    _record_two_tests(rpi.TestJournal(path))
+    states = rpi.TestJournal(path).load()
+    assert list(states) == ["T1"]
+    assert states["T1"] == {"run": None, "max_cycles": 3, "done": [[None, "prepare"], [1, "aluminum"]],
+                            "confirmed": [], "waiting": 1, "last": [1, "aluminum"]}
+
+
+def test_confirmation_clears_waiting(rpi, path):
+    journal = rpi.TestJournal(path)
+    journal.started("T1", 2)
+    journal.waiting("T1", 1)
+    journal.confirmed("T1", 1)
+    state = rpi.TestJournal(path).load()["T1"]
+    assert state["waiting"] is None
+    assert state["confirmed"] == [1]
+
+
+def test_torn_last_line_is_ignored(rpi, path):
+    _record_two_tests(rpi.TestJournal(path))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"t": "T1", "e": "sta')
+    assert list(rpi.TestJournal(path).load()) == ["T1"]
+
+
+def test_compaction_keeps_state(rpi, path, monkeypatch):
+    monkeypatch.setattr(rpi, "CHECKPOINT_COMPACT_BYTES", 200)
+    journal = rpi.TestJournal(path)
+    _record_two_tests(journal)
+    for cycle in range(1, 4):
+        journal.stage_done("T1", "silicon", cycle=cycle)
+    with open(path, encoding="utf-8") as f:
+        lines = f.readlines()
+    assert len(lines) < 9
+    state = rpi.TestJournal(path).load()["T1"]
+    assert state["done"][-1] == [3, "silicon"]
+    assert len(state["done"]) == 5
+
+
+def test_resumed_journal_keeps_recording(rpi, path):
+    _record_two_tests(rpi.TestJournal(path))
+    resumed = rpi.TestJournal(path)
+    resumed.load()
+    resumed.stage_done("T1", "silicon", cycle=1)
+    resumed.ended("T1")
+    assert rpi.TestJournal(path).load() == {}
+
+
+def test_frozen_journal_keeps_tests_resumable(rpi, path):
+    journal = rpi.TestJournal(path)
+    journal.started("T1", 2)
+    journal.freeze()
+    journal.ended("T1")
+    assert list(rpi.TestJournal(path).load()) == ["T1"]
+
+
+def test_events_of_an_earlier_run_are_ignored(rpi, path):
+    journal = rpi.TestJournal(path)
+    journal.started("T1", 3, run="old")
+    journal.ended("T1", run="old")  # stopped by the user
+    journal.started("T1", 2, run="new")
+    journal.stage_done("T1", "prepare", run="new")
+    journal.stage_done("T1", "aluminum", cycle=1, run="old")  # the stopped run's thread finishing
+    journal.ended("T1", run="old")
+    state = rpi.TestJournal(path).load()["T1"]
+    assert state["run"] == "new"
+    assert state["done"] == [[None, "prepare"]]
+    assert state["max_cycles"] == 2
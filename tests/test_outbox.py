@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+
+def _wait(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def offline(fake_client):
+    fake_client.connected = False
+    return fake_client
+
+
+def test_sends_directly_while_online(rpi, fake_client):
+    outbox = rpi.Outbox(None)
+    assert outbox.publish("t/a", "one", key="a")
+    assert fake_client.published == [("t/a", b"one")]
+    assert outbox.rows == 0
+
+
+def test_offline_spool_keeps_newest_per_key(rpi, offline):
+    outbox = rpi.Outbox(None)
+    outbox.publish("t/a", "a1", key="a")
+    outbox.publish("t/b", "b1", key="b")
+    outbox.publish("t/a", "a2", key="a")
+    outbox.publish("t/c", "c1")
+    assert outbox.rows == 3
+    assert outbox.stats["deduped"] == 1
+    assert offline.published == []
+
+
+def test_non_durable_dropped_offline(rpi, offline):
+    outbox = rpi.Outbox(None)
+    assert not outbox.publish("t/live", "x", durable=False)
+    assert outbox.rows == 0
+    assert outbox.stats["dropped_offline"] == 1
+
+
+def test_replay_in_order_after_reconnect(rpi, offline):
+    outbox = rpi.Outbox(None)
+    outbox.publish("t/a", "a1", key="a")
+    outbox.publish("t/b", "b1", key="b")
+    outbox.publish("t/a", "a2", key="a")
+    offline.connected = True
+    outbox.wake()
+    assert _wait(lambda: outbox.rows == 0)
+    assert offline.published == [("t/b", b"b1"), ("t/a", b"a2")]
+    assert outbox.stats["replayed"] == 2
+
+
+def test_spool_survives_restart(rpi, offline, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    first = rpi.Outbox(path)
+    first.publish("t/a", "a1", key="a", qos=1)
+    first.publish("t/b", "b1", priority=True)
+    restarted = rpi.Outbox(path)
+    assert restarted.rows == 2
+    offline.connected = True
+    restarted.wake()
+    assert _wait(lambda: restarted.rows == 0)
+    assert offline.published == [("t/a", b"a1"), ("t/b", b"b1")]
+
+
+def test_eviction_spares_priority_messages(rpi, offline, monkeypatch):
+    monkeypatch.setattr(rpi, "OUTBOX_MAX_ROWS", 101)
+    outbox = rpi.Outbox(None)
+    outbox.publish("t/prio", "p", priority=True)
+    for i in range(101):
+        outbox.publish("t/n", str(i))
+    # the oldest non-priority rows go in batches of 100
+    assert outbox.rows == 2
+    assert outbox.stats["evicted"] == 100
+    offline.connected = True
+    outbox.wake()
+    assert _wait(lambda: outbox.rows == 0)
+    assert offline.published == [("t/prio", b"p"), ("t/n", b"100")]
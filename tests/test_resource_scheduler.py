@@ -0,0 +1,86 @@
+import pytest
+
+
+@pytest.fixture
+def scheduler(rpi):
+    return rpi.ResourceScheduler({"pumps": 1, "camera": 1, "heater": 2})
+
+
+def granted(req):
+    return req.event.is_set() and not req.cancelled
+
+
+def test_fifo_grant_on_release(scheduler):
+    a = scheduler.request("A", "prepare", ["pumps"])
+    b = scheduler.request("B", "prepare", ["pumps"])
+    assert granted(a)
+    assert not granted(b)
+    assert b.position == 1
+    scheduler.release(a)
+    assert granted(b)
+    assert b.position == 0
+    assert scheduler.snapshot()["pumps"] == {"capacity": 1, "in_use": 1, "queued": 0}
+
+
+def test_all_or_nothing(scheduler):
+    scheduler.request("A", "prepare", ["pumps"])
+    b = scheduler.request("B", "aluminum", ["pumps", "camera"])
+    assert not granted(b)
+    assert scheduler.in_use["camera"] == 0
+
+
+def test_free_request_may_overtake(scheduler):
+    scheduler.request("A", "prepare", ["pumps"])
+    b = scheduler.request("B", "aluminum", ["pumps", "camera"])
+    c = scheduler.request("C", "silicon", ["camera"])
+    assert granted(c)
+    assert b.bypassed == 1
+
+
+def test_bypass_limit_reserves_resources(rpi, scheduler, monkeypatch):
+    monkeypatch.setattr(rpi, "RESOURCE_MAX_BYPASS", 1)
+    a = scheduler.request("A", "prepare", ["pumps"])
+    b = scheduler.request("B", "aluminum", ["pumps", "camera"])
+    c = scheduler.request("C", "silicon", ["camera"])
+    assert granted(c)
+    scheduler.release(c)
+    d = scheduler.request("D", "silicon", ["camera"])
+    assert not granted(d)  # the camera is held back for B now
+    scheduler.release(a)
+    assert granted(b)
+    assert not granted(d)
+    scheduler.release(b)
+    assert granted(d)
+
+
+def test_stages_of_one_test_share_its_units(scheduler):
+    al = scheduler.request("A", "aluminum", ["camera"])
+    si = scheduler.request("A", "silicon", ["camera"])
+    other = scheduler.request("B", "aluminum", ["camera"])
+    assert granted(al) and granted(si)
+    assert si.position == 0
+    assert scheduler.in_use["camera"] == 1
+    scheduler.release(al)
+    assert not granted(other)
+    scheduler.release(si)
+    assert granted(other)
+
+
+def test_cancel_wakes_queued_requests(scheduler):
+    a = scheduler.request("A", "prepare", ["pumps"])
+    b = scheduler.request("B", "prepare", ["pumps"])
+    assert scheduler.cancel("B") == 1
+    assert b.event.is_set() and b.cancelled
+    scheduler.release(b)  # a cancelled request holds nothing
+    assert scheduler.in_use["pumps"] == 1
+    scheduler.release(a)
+    assert scheduler.in_use["pumps"] == 0
+
+
+def test_notify_reports_queue_positions(rpi):
+    seen = []
+    scheduler = rpi.ResourceScheduler({"pumps": 1}, notify=lambda req, busy: seen.append((req.test_id, req.position, busy)))
+    a = scheduler.request("A", "prepare", ["pumps"])
+    scheduler.request("B", "prepare", ["pumps"])
+    scheduler.release(a)
+    assert seen == [("B", 1, ["pumps"]), ("B", 0, [])]